@@ -0,0 +1,124 @@
+# Benchmark of the two ways of serving local blobs: chunked (the app reads
+# the file and passes every chunk through the ASGI send loop) and pathsend
+# (the server sends the whole file with os.sendfile).
+#
+# Usage:
+#
+#     uv run python -m mirrorface.benchmarks.sendfile --size_mb=1024 --repeat=3
+#
+# Serves a blob with BlobResponse through a minimal ASGI server loop that
+# writes to a TCP socket on localhost, with a separate process reading and
+# discarding the data on the other end. The loop implements pathsend like
+# servers do, with loop.sock_sendfile (os.sendfile). The file is in the page
+# cache, so this measures the serving overhead and not the storage.
+#
+# Reports throughput and CPU time (user + system of this process, including
+# the threads reading the file) per GiB served.
+
+import asyncio
+import multiprocessing
+import os
+import resource
+import socket
+import tempfile
+import time
+
+from pydantic_settings import BaseSettings
+
+from mirrorface.server.responses import BlobResponse, FileBlobSource
+
+
+class Settings(BaseSettings, cli_parse_args=True):
+    size_mb: int = 512
+    repeat: int = 3
+    # Same default as the server, see local_chunk_size.
+    chunk_size: int = 1024 * 1024
+
+
+def read_until_eof(port: int):
+    with socket.create_connection(("127.0.0.1", port)) as sock:
+        buffer = bytearray(1024 * 1024)
+        while sock.recv_into(buffer):
+            pass
+
+
+async def serve(
+    sock: socket.socket, path: str, size: int, chunk_size: int, pathsend: bool
+):
+    loop = asyncio.get_running_loop()
+    response = BlobResponse(
+        FileBlobSource(path, size), headers={}, chunk_size=chunk_size, sendfile=True
+    )
+    scope = {
+        "type": "http",
+        "method": "GET",
+        "headers": [],
+        "extensions": {"http.response.pathsend": {}} if pathsend else {},
+    }
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            head = b"HTTP/1.1 200 OK\r\n" + b"".join(
+                k + b": " + v + b"\r\n" for k, v in message["headers"]
+            )
+            await loop.sock_sendall(sock, head + b"\r\n")
+        elif message["type"] == "http.response.body":
+            if message["body"]:
+                await loop.sock_sendall(sock, message["body"])
+        elif message["type"] == "http.response.pathsend":
+            with open(message["path"], "rb") as f:
+                await loop.sock_sendfile(sock, f)
+
+    await response(scope, receive, send)
+
+
+def cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def run_once(
+    path: str, size: int, chunk_size: int, pathsend: bool
+) -> tuple[float, float]:
+    # Returns wall and CPU seconds.
+    with socket.socket() as listener:
+        listener.bind(("127.0.0.1", 0))
+        listener.listen(1)
+        reader = multiprocessing.Process(
+            target=read_until_eof, args=(listener.getsockname()[1],)
+        )
+        reader.start()
+        sock, _ = listener.accept()
+        sock.setblocking(False)
+        started_at, started_cpu = time.perf_counter(), cpu_seconds()
+        with sock:
+            asyncio.run(serve(sock, path, size, chunk_size, pathsend))
+        reader.join()
+        return time.perf_counter() - started_at, cpu_seconds() - started_cpu
+
+
+def main(settings: Settings):
+    size = settings.size_mb * 1024 * 1024
+    with tempfile.NamedTemporaryFile() as f:
+        for _ in range(settings.size_mb):
+            f.write(os.urandom(1024 * 1024))
+        f.flush()
+        print(f"Serving {settings.size_mb} MiB, best of {settings.repeat}:")
+        for name, pathsend in [("chunked", False), ("pathsend", True)]:
+            runs = [
+                run_once(f.name, size, settings.chunk_size, pathsend)
+                for _ in range(settings.repeat)
+            ]
+            wall, cpu = min(runs)
+            gib = size / 2**30
+            print(
+                f"  {name:>8}: {size / wall / 2**20:8.0f} MiB/s, "
+                f"{cpu / gib:6.3f} CPU s/GiB"
+            )
+
+
+if __name__ == "__main__":
+    main(Settings())  # pyright: ignore[reportCallIssue], pydantic-settings will initialize or throw
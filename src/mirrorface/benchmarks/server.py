@@ -0,0 +1,513 @@
+# Load test of the whole server, running fully offline.
+#
+# Usage:
+#
+#     uv run python -m mirrorface.benchmarks.server \
+#       --workers=4 --concurrency=64 --duration_seconds=10 --output=run.json
+#
+# Generates synthetic mirrored repositories into a temporary storage root,
+# starts the fake HF Hub (see tools/fake_hub.py) as upstream and the server under
+# gunicorn (with the production gunicorn.conf.py), then drives every scenario
+# with a concurrent client for a fixed time:
+#
+#   small_files        GET of small mirrored files (config, tokenizer, ...).
+#   large_files        GET of a large mirrored file.
+#   head_storm         HEAD of mirrored files, like clients checking a cache.
+#   manifest_miss      GET of small files of a repository that isn't mirrored,
+#                      proxied to upstream.
+#   probe_404          GET of files that are not in a mirrored repository.
+#   upstream_fallback  GET of large files of a repository that isn't
+#                      mirrored, streamed from upstream.
+#
+# Reports throughput, latency percentiles and the CPU time of the server
+# processes (master and workers) per GiB and per request. Server settings
+# come from MIRRORFACE_* environment variables as usual, eg.
+# MIRRORFACE_LOCAL_CHUNK_SIZE, and are recorded in the results. The results
+# are written as JSON with --output, and --compare=previous.json prints the
+# change against an earlier run (eg. of another commit).
+#
+# The client is a single process, for high request rates it can be the
+# bottleneck, check its CPU usage. Data and request order are seeded, so
+# runs with the same settings send the same requests.
+
+import asyncio
+import importlib.util
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, Optional
+
+import aiohttp
+from pydantic import BaseModel
+from pydantic_settings import BaseSettings
+
+from mirrorface.common.hub import RepositoryRevision
+from mirrorface.common.storage import (
+    local_file_metadata,
+    move_local_blobs,
+    write_local_manifests,
+)
+from mirrorface.tools import fake_hub
+
+SCENARIOS = [
+    "small_files",
+    "large_files",
+    "head_storm",
+    "manifest_miss",
+    "probe_404",
+    "upstream_fallback",
+]
+MIRRORED_REPOSITORY = "bench/mirrored"
+UPSTREAM_REPOSITORY = "bench/upstream"
+REVISION_HASH = "0" * 40
+UPSTREAM_LARGE_FILES = 4
+
+
+class Settings(BaseSettings, cli_parse_args=True):
+    # Gunicorn worker processes (GUNICORN_WORKERS in production).
+    workers: int = 4
+    # Requests in flight at the same time.
+    concurrency: int = 64
+    duration_seconds: float = 10
+    # Not measured, fills the caches and opens the connections.
+    warmup_seconds: float = 2
+    # Subset of SCENARIOS, all if not set.
+    scenarios: Optional[list[str]] = None
+
+    small_files: int = 50
+    small_file_bytes: int = 16 * 1024
+    large_file_mb: int = 256
+    # Size of the files upstream serves for upstream_fallback.
+    upstream_file_mb: int = 16
+    # Added to every upstream request, see fake_hub.
+    upstream_latency_seconds: float = 0
+
+    seed: int = 0
+    # Where to write the results (JSON).
+    output: Optional[str] = None
+    # Results of an earlier run to compare with.
+    compare: Optional[str] = None
+
+
+class ScenarioResult(BaseModel):
+    scenario: str
+    requests: int
+    # Unexpected status codes and failed requests, not in the latencies.
+    errors: int
+    duration_seconds: float
+    requests_per_second: float
+    mib_per_second: float
+    latency_p50_ms: float
+    latency_p90_ms: float
+    latency_p99_ms: float
+    latency_max_ms: float
+    server_cpu_seconds: float
+    server_cpu_ms_per_request: float
+    # None if the scenario transfers (almost) no body bytes.
+    server_cpu_seconds_per_gib: Optional[float]
+
+
+class BenchmarkResults(BaseModel):
+    commit: Optional[str]
+    started_at: float
+    python: str
+    machine: str
+    cpu_count: int
+    settings: dict
+    # MIRRORFACE_* environment variables passed to the server.
+    environment: dict[str, str]
+    scenarios: list[ScenarioResult]
+
+
+# A request: method, path under /mirror/ and the expected status.
+Request = tuple[str, str, int]
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def generate_storage(settings: Settings, storage_root: str) -> list[str]:
+    # Mirrored repository with small files and one large file, returns the
+    # paths of the small files.
+    rng = random.Random(settings.seed)
+    snapshot = os.path.join(storage_root, "_snapshot")
+    small_paths = [f"config_{i}.json" for i in range(settings.small_files)]
+    os.makedirs(snapshot)
+    for path in small_paths:
+        with open(os.path.join(snapshot, path), "wb") as f:
+            f.write(rng.randbytes(settings.small_file_bytes))
+    with open(os.path.join(snapshot, "model.safetensors"), "wb") as f:
+        for _ in range(settings.large_file_mb):
+            f.write(rng.randbytes(1024 * 1024))
+    files = move_local_blobs(snapshot, storage_root)
+    shutil.rmtree(snapshot)
+    write_local_manifests(
+        RepositoryRevision(repository=MIRRORED_REPOSITORY, revision=REVISION_HASH),
+        RepositoryRevision(repository=MIRRORED_REPOSITORY, revision="main"),
+        files,
+        storage_root,
+        local_file_metadata(storage_root, files),
+    )
+    return small_paths
+
+
+def run_upstream(settings: Settings, port: int, cdn_port: int):
+    # Repository that isn't mirrored, served by the fake Hub: small files and
+    # large LFS files (redirected to the fake CDN) for upstream_fallback.
+    fake_hub.main(
+        fake_hub.Settings.model_construct(
+            host="127.0.0.1",
+            port=port,
+            cdn_port=cdn_port,
+            repositories=[UPSTREAM_REPOSITORY],
+            small_files=settings.small_files,
+            small_file_bytes=settings.small_file_bytes,
+            large_files=UPSTREAM_LARGE_FILES,
+            large_file_mb=settings.upstream_file_mb,
+            latency_seconds=settings.upstream_latency_seconds,
+            bytes_per_second=None,
+            error_rate=0,
+            error_status=503,
+            not_found_rate=0,
+            seed=settings.seed,
+        )
+    )
+
+
+def process_tree_cpu_seconds(pid: int) -> float:
+    # User and system time of the process and its children (the gunicorn
+    # workers), from /proc so it works while they are running.
+    ticks = os.sysconf("SC_CLK_TCK")
+    total = 0.0
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/stat") as f:
+                # The command name is in parentheses and may contain spaces.
+                fields = f.read().rsplit(")", 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / ticks
+            for task in os.listdir(f"/proc/{current}/task"):
+                with open(f"/proc/{current}/task/{task}/children") as f:
+                    pending.extend(int(child) for child in f.read().split())
+        except FileNotFoundError:
+            # Exited in the meantime.
+            continue
+    return total
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(fraction * len(sorted_values)))
+    return sorted_values[index]
+
+
+def scenario_requests(
+    settings: Settings, small_paths: list[str]
+) -> dict[str, Callable[[random.Random], Request]]:
+    mirrored = f"{MIRRORED_REPOSITORY}/resolve/main"
+    upstream = f"{UPSTREAM_REPOSITORY}/resolve/main"
+    return {
+        "small_files": lambda rng: (
+            "GET",
+            f"{mirrored}/{rng.choice(small_paths)}",
+            200,
+        ),
+        "large_files": lambda rng: ("GET", f"{mirrored}/model.safetensors", 200),
+        "head_storm": lambda rng: (
+            "HEAD",
+            f"{mirrored}/{rng.choice(small_paths + ['model.safetensors'])}",
+            200,
+        ),
+        "manifest_miss": lambda rng: (
+            "GET",
+            f"{upstream}/config_{rng.randrange(settings.small_files)}.json",
+            200,
+        ),
+        "probe_404": lambda rng: (
+            "GET",
+            f"{mirrored}/adapter_config_{rng.randrange(settings.small_files)}.json",
+            404,
+        ),
+        "upstream_fallback": lambda rng: (
+            "GET",
+            f"{upstream}/model-{rng.randrange(UPSTREAM_LARGE_FILES)}.safetensors",
+            200,
+        ),
+    }
+
+
+async def drive(
+    session: aiohttp.ClientSession,
+    base_url: str,
+    next_request: Callable[[random.Random], Request],
+    concurrency: int,
+    seconds: float,
+    seed: int,
+) -> tuple[list[float], int, int, float]:
+    # Returns latencies (of successful requests), body bytes, errors and the
+    # elapsed time.
+    latencies: list[float] = []
+    body_bytes = 0
+    errors = 0
+    deadline = time.perf_counter() + seconds
+
+    async def client(rng: random.Random):
+        nonlocal body_bytes, errors
+        while time.perf_counter() < deadline:
+            method, path, expected_status = next_request(rng)
+            started_at = time.perf_counter()
+            size = 0
+            try:
+                async with session.request(method, f"{base_url}/mirror/{path}") as r:
+                    async for chunk in r.content.iter_chunked(1024 * 1024):
+                        size += len(chunk)
+                    ok = r.status == expected_status
+            except aiohttp.ClientError:
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - started_at)
+                body_bytes += size
+            else:
+                errors += 1
+
+    started_at = time.perf_counter()
+    await asyncio.gather(
+        *[client(random.Random(seed * 1_000_003 + i)) for i in range(concurrency)]
+    )
+    return latencies, body_bytes, errors, time.perf_counter() - started_at
+
+
+async def run_scenarios(
+    settings: Settings, base_url: str, server_pid: int, small_paths: list[str]
+) -> list[ScenarioResult]:
+    requests = scenario_requests(settings, small_paths)
+    connector = aiohttp.TCPConnector(limit=settings.concurrency)
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=60)
+    results = []
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        for scenario in settings.scenarios or SCENARIOS:
+            next_request = requests[scenario]
+            print(f"Running {scenario}...", file=sys.stderr)
+            await drive(
+                session,
+                base_url,
+                next_request,
+                settings.concurrency,
+                settings.warmup_seconds,
+                settings.seed + 1,
+            )
+            cpu_before = process_tree_cpu_seconds(server_pid)
+            latencies, body_bytes, errors, elapsed = await drive(
+                session,
+                base_url,
+                next_request,
+                settings.concurrency,
+                settings.duration_seconds,
+                settings.seed,
+            )
+            cpu = process_tree_cpu_seconds(server_pid) - cpu_before
+            latencies.sort()
+            count = len(latencies) + errors
+            gib = body_bytes / 2**30
+            results.append(
+                ScenarioResult(
+                    scenario=scenario,
+                    requests=count,
+                    errors=errors,
+                    duration_seconds=round(elapsed, 3),
+                    requests_per_second=round(count / elapsed, 1),
+                    mib_per_second=round(body_bytes / elapsed / 2**20, 1),
+                    latency_p50_ms=round(percentile(latencies, 0.5) * 1000, 2),
+                    latency_p90_ms=round(percentile(latencies, 0.9) * 1000, 2),
+                    latency_p99_ms=round(percentile(latencies, 0.99) * 1000, 2),
+                    latency_max_ms=round(percentile(latencies, 1) * 1000, 2),
+                    server_cpu_seconds=round(cpu, 3),
+                    server_cpu_ms_per_request=round(cpu * 1000 / max(count, 1), 3),
+                    server_cpu_seconds_per_gib=round(cpu / gib, 3)
+                    if gib >= 0.01
+                    else None,
+                )
+            )
+    return results
+
+
+def gunicorn_config_path() -> str:
+    spec = importlib.util.find_spec("mirrorface.server.main")
+    assert spec is not None and spec.origin is not None
+    return os.path.join(os.path.dirname(spec.origin), "gunicorn.conf.py")
+
+
+def wait_until_healthy(base_url: str, server: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+
+    async def check() -> bool:
+        try:
+            async with aiohttp.ClientSession() as session:
+                async with session.get(f"{base_url}/health") as r:
+                    return r.status == 200
+        except aiohttp.ClientError:
+            return False
+
+    while not asyncio.run(check()):
+        if server.poll() is not None:
+            raise RuntimeError(f"Server exited with {server.returncode}")
+        if time.monotonic() > deadline:
+            raise TimeoutError("Server did not start")
+        time.sleep(0.2)
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(settings: Settings, directory: str) -> BenchmarkResults:
+    storage_root = os.path.join(directory, "storage")
+    print(f"Generating repositories in {storage_root}...", file=sys.stderr)
+    small_paths = generate_storage(settings, storage_root)
+
+    upstream_port = free_port()
+    upstream = multiprocessing.Process(
+        target=run_upstream,
+        args=(settings, upstream_port, free_port()),
+        daemon=True,
+    )
+    upstream.start()
+
+    environment = {k: v for k, v in os.environ.items() if k.startswith("MIRRORFACE_")}
+    environment.update(
+        MIRRORFACE_LOCAL_DIRECTORY=storage_root,
+        MIRRORFACE_UPSTREAM_URL=f"http://127.0.0.1:{upstream_port}",
+        MIRRORFACE_UPSTREAM_SPOOL_DIRECTORY=os.path.join(directory, "spool"),
+    )
+    port = free_port()
+    server_env = {
+        k: v for k, v in os.environ.items() if k != "PROMETHEUS_MULTIPROC_DIR"
+    }
+    server_env.update(environment, GUNICORN_WORKERS=str(settings.workers))
+    with open(os.path.join(directory, "server.log"), "wb") as log:
+        server = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "gunicorn",
+                "-c",
+                gunicorn_config_path(),
+                "--bind",
+                f"127.0.0.1:{port}",
+                "mirrorface.server.main:app",
+            ],
+            env=server_env,
+            stdout=log,
+            stderr=log,
+        )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        wait_until_healthy(base_url, server)
+        started_at = time.time()
+        scenarios = asyncio.run(
+            run_scenarios(settings, base_url, server.pid, small_paths)
+        )
+    finally:
+        server.terminate()
+        server.wait()
+        upstream.terminate()
+        upstream.join()
+
+    return BenchmarkResults(
+        commit=git_commit(),
+        started_at=started_at,
+        python=platform.python_version(),
+        machine=platform.machine(),
+        cpu_count=os.cpu_count() or 0,
+        settings=settings.model_dump(exclude={"output", "compare"}),
+        environment={
+            k: v
+            for k, v in environment.items()
+            # Temporary paths, different on every run.
+            if k
+            not in [
+                "MIRRORFACE_LOCAL_DIRECTORY",
+                "MIRRORFACE_UPSTREAM_URL",
+                "MIRRORFACE_UPSTREAM_SPOOL_DIRECTORY",
+            ]
+        },
+        scenarios=scenarios,
+    )
+
+
+def print_results(results: BenchmarkResults, baseline: Optional[BenchmarkResults]):
+    baseline_scenarios = {
+        s.scenario: s for s in (baseline.scenarios if baseline is not None else [])
+    }
+
+    def change(value: Optional[float], previous: Optional[float]) -> str:
+        if value is None or previous is None or previous == 0:
+            return ""
+        return f" ({(value - previous) / previous * 100:+.0f}%)"
+
+    columns = [
+        ("req/s", "requests_per_second"),
+        ("MiB/s", "mib_per_second"),
+        ("p50 ms", "latency_p50_ms"),
+        ("p99 ms", "latency_p99_ms"),
+        ("CPU s/GiB", "server_cpu_seconds_per_gib"),
+        ("CPU ms/req", "server_cpu_ms_per_request"),
+    ]
+    for s in results.scenarios:
+        previous = baseline_scenarios.get(s.scenario)
+        values = []
+        for name, field in columns:
+            value = getattr(s, field)
+            if value is None:
+                continue
+            values.append(
+                f"{name} {value}"
+                + change(value, getattr(previous, field) if previous else None)
+            )
+        errors = f", {s.errors} errors" if s.errors else ""
+        print(f"{s.scenario:>18}: " + ", ".join(values) + errors)
+
+
+def main(settings: Settings):
+    unknown = set(settings.scenarios or []) - set(SCENARIOS)
+    if unknown:
+        raise ValueError(f"Unknown scenarios: {sorted(unknown)}")
+    baseline = None
+    if settings.compare:
+        with open(settings.compare) as f:
+            baseline = BenchmarkResults.model_validate_json(f.read())
+
+    with tempfile.TemporaryDirectory(prefix="mirrorface-benchmark-") as directory:
+        results = run(settings, directory)
+
+    if settings.output:
+        with open(settings.output, "w") as f:
+            f.write(results.model_dump_json(indent=2))
+    print_results(results, baseline)
+    if baseline is not None and baseline.commit:
+        print(f"Changes are against {baseline.commit}.")
+
+
+if __name__ == "__main__":
+    main(Settings())  # pyright: ignore[reportCallIssue], pydantic-settings will initialize or throw
@@ -0,0 +1,56 @@
+# Small in-memory caches used by the server.
+#
+# Everything here is per-process and not thread-safe, it is meant to be used
+# from the event loop of a single worker.
+
+import collections
+import time
+from typing import Callable, Generic, Hashable, Optional, TypeVar
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class TTLCache(Generic[K, V]):
+    """LRU cache bounded by number of entries, where each entry also has its own expiry time."""
+
+    def __init__(
+        self,
+        max_entries: int,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self._clock = clock
+        # Value and the (clock) time when it expires, in LRU order (oldest first).
+        self._entries: collections.OrderedDict[K, tuple[V, Optional[float]]] = (
+            collections.OrderedDict()
+        )
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __getitem__(self, key: K) -> V:
+        # Raises KeyError if the entry is missing or expired. Stored values
+        # can be None (eg. negative entries) so we can't use None for misses.
+        value, expires_at = self._entries[key]
+        if expires_at is not None and expires_at <= self._clock():
+            del self._entries[key]
+            raise KeyError(key)
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: K, value: V, ttl: Optional[float] = None):
+        # TTL of None means the entry only goes away when evicted.
+        if self.max_entries <= 0:
+            return
+        expires_at = None if ttl is None else self._clock() + ttl
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def pop(self, key: K):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
@@ -0,0 +1,54 @@
+import pytest
+
+from mirrorface.common.cache import TTLCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_ttl_cache_expiry():
+    clock = FakeClock()
+    cache: TTLCache[str, int] = TTLCache(10, clock=clock)
+    cache.put("short", 1, ttl=5)
+    cache.put("long", 2, ttl=50)
+    cache.put("forever", 3)
+
+    clock.now = 4
+    assert cache["short"] == 1
+    clock.now = 5
+    with pytest.raises(KeyError):
+        cache["short"]
+    assert cache["long"] == 2
+
+    clock.now = 1000
+    with pytest.raises(KeyError):
+        cache["long"]
+    assert cache["forever"] == 3
+    assert len(cache) == 1
+
+
+def test_ttl_cache_none_values():
+    cache: TTLCache[str, None] = TTLCache(10)
+    cache.put("negative", None)
+    assert cache["negative"] is None
+    with pytest.raises(KeyError):
+        cache["missing"]
+
+
+def test_ttl_cache_lru_eviction():
+    cache: TTLCache[str, int] = TTLCache(2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    # Touch "a" so "b" is the least recently used.
+    assert cache["a"] == 1
+    cache.put("c", 3)
+    assert len(cache) == 2
+    assert cache["a"] == 1
+    assert cache["c"] == 3
+    with pytest.raises(KeyError):
+        cache["b"]
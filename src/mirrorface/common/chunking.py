@@ -0,0 +1,107 @@
+# Content-defined chunking of large blobs, FastCDC-style.
+#
+# Chunk boundaries depend only on the bytes right before them, so an insert or
+# a change in the middle of a file only changes the chunks around it, and the
+# other chunks dedupe against the previous revision of the file.
+#
+# The rolling hash is a gear hash, h = (h << 1) + GEAR[byte], with a one bit
+# gear table: the low n bits of h are then exactly the table bits of the last
+# n bytes. A boundary is where those bits match a fixed pattern, which we find
+# without a Python loop over the bytes: translate the data to its table bits
+# (one byte per input byte) and search for the pattern with bytes.find.
+#
+# As in FastCDC, the first min_size bytes of a chunk are skipped (no boundary
+# can be there), and chunking is normalized: a stricter pattern (one bit
+# longer) before the average size and a looser one (one bit shorter) after it,
+# which keeps chunk sizes close to the average. Chunks are cut at max_size if
+# no boundary is found.
+#
+# The table and the pattern must never change, or chunks of new uploads
+# stop matching the chunks already stored.
+
+import hashlib
+from typing import BinaryIO, Iterator
+
+
+def _gear_bits() -> bytes:
+    # Half of the byte values map to 1, so that every pattern of n bits is
+    # equally likely (2^-n) in random data.
+    order = sorted(
+        range(256),
+        key=lambda i: hashlib.sha256(f"mirrorface-gear-{i}".encode()).digest(),
+    )
+    ones = set(order[:128])
+    return bytes(1 if i in ones else 0 for i in range(256))
+
+
+GEAR_BITS = _gear_bits()
+_PATTERN_BITS = bytes(
+    (byte >> shift) & 1
+    for byte in hashlib.sha256(b"mirrorface-chunk-boundary").digest()
+    for shift in range(8)
+)
+
+# Default average chunk size. Every chunk is an object in the store and a file
+# open when serving, large model files need large chunks.
+AVERAGE_CHUNK_BYTES = 4 * 1024 * 1024
+# Data is read (and translated) in blocks of at least this size.
+READ_SIZE = 64 * 1024 * 1024
+
+
+def boundary_pattern(bits: int) -> bytes:
+    return _PATTERN_BITS[:bits]
+
+
+def chunk_size_limits(average_size: int) -> tuple[int, int]:
+    # Minimum and maximum chunk size for the average, same ratios as FastCDC.
+    return average_size // 4, average_size * 4
+
+
+def find_cut(
+    data_bits: bytes, start: int, end: int, average_size: int, at_end: bool
+) -> int:
+    # End of the chunk starting at start, with data_bits (the translated data)
+    # available up to end. Unless at_end, at least max_size bytes must be
+    # available.
+    min_size, max_size = chunk_size_limits(average_size)
+    length = end - start
+    if length <= min_size:
+        assert at_end
+        return end
+    bits = average_size.bit_length() - 1
+    strict = boundary_pattern(bits + 1)
+    loose = boundary_pattern(bits - 1)
+    normal_end = start + min(average_size, length)
+    index = data_bits.find(strict, start + min_size - len(strict), normal_end)
+    if index >= 0:
+        return index + len(strict)
+    limit = start + min(max_size, length)
+    index = data_bits.find(loose, normal_end - len(loose), limit)
+    if index >= 0:
+        return index + len(loose)
+    return limit
+
+
+def split_chunks(
+    f: BinaryIO, average_size: int = AVERAGE_CHUNK_BYTES, read_size: int = READ_SIZE
+) -> Iterator[memoryview]:
+    # Yields the chunks of the file, in order.
+    if average_size & (average_size - 1) or average_size < 64:
+        raise ValueError(f"Average chunk size must be a power of two: {average_size}")
+    _, max_size = chunk_size_limits(average_size)
+    read_size = max(read_size, 2 * max_size)
+    data = data_bits = b""
+    position = 0
+    at_end = False
+    while not at_end or position < len(data):
+        if not at_end and len(data) - position < max_size:
+            # Less than a whole chunk left, keep the rest and read more.
+            more = f.read(read_size)
+            at_end = not more
+            data = data[position:] + more
+            data_bits = data.translate(GEAR_BITS)
+            position = 0
+            continue
+        cut = find_cut(data_bits, position, len(data), average_size, at_end)
+        yield memoryview(data)[position:cut]
+        position = cut
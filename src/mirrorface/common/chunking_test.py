@@ -0,0 +1,38 @@
+import io
+import os
+
+import pytest
+
+from mirrorface.common.chunking import GEAR_BITS, split_chunks
+
+
+def chunks(data: bytes, average_size: int = 1024, read_size: int = 0) -> list[bytes]:
+    return [
+        bytes(chunk)
+        for chunk in split_chunks(io.BytesIO(data), average_size, read_size)
+    ]
+
+
+def test_split_chunks():
+    assert sum(GEAR_BITS) == 128
+    data = os.urandom(256 * 1024)
+    original = chunks(data)
+    assert b"".join(original) == data
+    # Between min and max size, except the last one.
+    assert all(256 <= len(chunk) <= 4096 for chunk in original[:-1])
+    assert 512 < len(data) / len(original) < 2048
+    # Boundaries don't depend on how the file is read.
+    assert chunks(data, read_size=10 * 1024 * 1024) == original
+
+    # An insert only changes the chunks around it.
+    changed = chunks(data[:100_000] + b"inserted" + data[100_000:])
+    assert len(set(changed) - set(original)) <= 2
+
+
+def test_split_chunks_small_and_uniform():
+    assert chunks(b"") == []
+    assert chunks(b"small") == [b"small"]
+    # No boundaries in uniform data, cut at max size.
+    assert [len(chunk) for chunk in chunks(bytes(10000))] == [4096, 4096, 1808]
+    with pytest.raises(ValueError):
+        chunks(b"data", average_size=1000)
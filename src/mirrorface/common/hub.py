@@ -1,8 +1,16 @@
 import logging
+import re
 from typing import Optional
 
 from pydantic import BaseModel
 
+COMMIT_HASH = re.compile(r"^[0-9a-f]{40}$")
+
+
+def is_commit_hash(revision: str) -> bool:
+    # Full commit hashes are immutable, unlike branches and tags.
+    return COMMIT_HASH.match(revision) is not None
+
 
 class RepositoryRevision(BaseModel):
     """Identifier for HF Hub repository (user/repo_name) and revision (branch, tag or commit hash)."""
@@ -22,6 +30,22 @@ class RepositoryRevision(BaseModel):
         revision = self.revision.replace("/", "--")
         return f"{repository}__{revision}"
 
+    @classmethod
+    def from_api_path(cls, url_path: str) -> Optional["RepositoryRevision"]:
+        # Expected format is "api/models/<user>/<repo>[/revision/<revision>]",
+        # without an explicit revision upstream returns the default branch.
+        parts = url_path.split("/", maxsplit=5)
+        if len(parts) < 4 or parts[0] != "api" or parts[1] != "models":
+            return None
+        _, _, user, repo, *rest = parts
+        if not user or not repo:
+            return None
+        if not rest:
+            return cls(repository=f"{user}/{repo}", revision="main")
+        if len(rest) != 2 or rest[0] != "revision" or not rest[1]:
+            return None
+        return cls(repository=f"{user}/{repo}", revision=rest[1])
+
 
 class RepositoryRevisionPath(BaseModel):
     """Identifier for a file in a HF Hub repository: the repository, revision and path."""
@@ -52,3 +52,21 @@ def test_path_safe_string():
         ).path_safe_string()
         is None
     )
+
+
+def test_api_path_parsing():
+    assert RepositoryRevision.from_api_path(
+        "api/models/user/repo/revision/0123456abcdef"
+    ) == RepositoryRevision(repository="user/repo", revision="0123456abcdef")
+    assert RepositoryRevision.from_api_path(
+        "api/models/user/repo/revision/refs/pr/1"
+    ) == RepositoryRevision(repository="user/repo", revision="refs/pr/1")
+    assert RepositoryRevision.from_api_path("api/models/user/repo") == (
+        RepositoryRevision(repository="user/repo", revision="main")
+    )
+
+    assert RepositoryRevision.from_api_path("api/models/user") is None
+    assert RepositoryRevision.from_api_path("api/models/user/repo/revision") is None
+    assert RepositoryRevision.from_api_path("api/models/user/repo/revision/") is None
+    assert RepositoryRevision.from_api_path("api/models/user/repo/tree/main") is None
+    assert RepositoryRevision.from_api_path("user/repo/resolve/main/path") is None
@@ -5,18 +5,39 @@
 #     content-addressed blobs (filename is SHA-512 hash of contents).
 #   - Manifest files which contain the contents of the repository,
 #     as a mapping from original paths to content hashes.
+#
+# Optionally, the small files of a revision are also concatenated into a pack
+# blob, so that the server can read all of them at once instead of opening
+# many small blobs. The pack is referenced from the full manifest, the
+# individual blobs are always stored as well.
+#
+# Optionally, large files are stored as content-defined chunks instead (see
+# chunking.py), so that revisions which change only part of a file share the
+# rest of it. Chunks are stored as blobs, and the chunk list of the file is
+# stored by its blob hash. The full manifest lists which blobs are chunked,
+# only their chunks are uploaded (the mirror keeps the whole blob locally).
+#
+# There is also an index from upstream object ids (LFS SHA-256, or git blob
+# SHA-1 for non-LFS files) to our blob hashes, so that mirroring can tell
+# which files it already has before downloading anything.
 
+import concurrent.futures
 import hashlib
 import logging
 import os
-from typing import Literal, Optional, Union
+from typing import Callable, Literal, Optional, Union
 
 from pydantic import BaseModel, Field
 
+from mirrorface.common.chunking import AVERAGE_CHUNK_BYTES, split_chunks
 from mirrorface.common.hub import RepositoryRevision
 
 BLOB_DIRECTORY = "blob"
 MANIFEST_DIRECTORY = "manifest"
+# Scratch space for blobs and manifests being written by the server.
+INGEST_DIRECTORY = "ingest"
+OID_INDEX_DIRECTORY = "oid"
+CHUNK_LIST_DIRECTORY = "chunks"
 
 
 def blob_path(storage_root: str, hash: str) -> str:
@@ -34,10 +55,27 @@ def manifest_path(
     )
 
 
-def get_file_hash(path: str) -> str:
-    hash = hashlib.sha512()
+def chunk_list_path(storage_root: str, hash: str) -> str:
+    return os.path.join(storage_root, CHUNK_LIST_DIRECTORY, f"{hash}.json")
+
+
+def oid_index_path(storage_root: str, oid: str) -> str:
+    return os.path.join(storage_root, OID_INDEX_DIRECTORY, oid)
+
+
+def blob_hasher():
+    # Hash used for blob names, everything that hashes blobs must use this.
+    return hashlib.sha512()
+
+
+# Default read size when hashing files.
+HASH_READ_SIZE = 1024 * 1024
+
+
+def get_file_hash(path: str, read_size: int = HASH_READ_SIZE) -> str:
+    hash = blob_hasher()
     with open(path, "rb") as f:
-        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+        for chunk in iter(lambda: f.read(read_size), b""):
             hash.update(chunk)
     return hash.hexdigest()
 
@@ -48,6 +86,43 @@ def get_file_hash(path: str) -> str:
 #     which contains a reference to the full manifest.
 
 
+class FileMetadata(BaseModel):
+    size: int
+    # Upstream identifiers, HF Hub uses them as ETags. Git blob SHA-1 of the
+    # file (or of the LFS pointer), and the SHA-256 of LFS file contents.
+    blob_id: Optional[str] = None
+    lfs_sha256: Optional[str] = None
+    # Size of the LFS pointer file, which is what is stored in git.
+    lfs_pointer_size: Optional[int] = None
+
+    def etag(self) -> Optional[str]:
+        # Unquoted, same as upstream would return for the file.
+        return self.lfs_sha256 or self.blob_id
+
+
+class PackEntry(BaseModel):
+    offset: int
+    size: int
+
+
+class Pack(BaseModel):
+    # Blob with the members concatenated, content-addressed like any other.
+    blob_hash: str
+    # By blob hash of the members.
+    entries: dict[str, PackEntry]
+
+
+class ChunkEntry(BaseModel):
+    blob_hash: str
+    size: int
+
+
+class ChunkList(BaseModel):
+    size: int
+    # In file order.
+    chunks: list[ChunkEntry]
+
+
 class FullManifest(BaseModel):
     manifest_type: Literal["full"] = "full"
     # This is the hash of the manifest itself. It should match the filename,
@@ -55,6 +130,13 @@ class FullManifest(BaseModel):
     # should not need to know the filename.
     revision_hash: str
     files: dict[str, str]
+    # Same keys as files. Lets the server answer metadata requests without
+    # touching the blobs. Missing in manifests written by older versions.
+    file_metadata: dict[str, FileMetadata] = Field(default_factory=dict)
+    # Optional pack of the small files, see write_pack.
+    pack: Optional[Pack] = None
+    # Blobs stored as chunks, see write_chunks.
+    chunked_blobs: list[str] = Field(default_factory=list)
 
 
 class RedirectManifest(BaseModel):
@@ -68,10 +150,15 @@ class Manifest(BaseModel):
     )
 
 
-def load_full_manifest(
+AnyManifest = Union[FullManifest, RedirectManifest]
+
+
+def read_manifest(
     storage_root: str,
     repository_revision: RepositoryRevision,
-) -> Optional[FullManifest]:
+) -> Optional[AnyManifest]:
+    # Reads a single manifest file without following redirects. Returns None
+    # if the manifest doesn't exist (or can't exist for the revision).
     manifest_file = manifest_path(storage_root, repository_revision)
     if manifest_file is None:
         return None
@@ -84,53 +171,66 @@ def load_full_manifest(
     except Exception:
         logging.error(f"Error loading manifest {manifest_file}", exc_info=True)
         raise
+    return manifest.manifest
+
+
+def resolve_full_manifest(
+    repository_revision: RepositoryRevision,
+    read: Callable[[RepositoryRevision], Optional[AnyManifest]],
+) -> Optional[FullManifest]:
+    # Loads the manifest using `read` and follows the redirect if needed.
+    # Split out from load_full_manifest so the server can plug in a cache.
+    manifest = read(repository_revision)
+    if manifest is None:
+        return None
 
-    if manifest.manifest.manifest_type == "full":
-        if manifest.manifest.revision_hash != repository_revision.revision:
+    if manifest.manifest_type == "full":
+        if manifest.revision_hash != repository_revision.revision:
             raise Exception(
-                f"Full manifest points to invalid revision: {manifest.manifest.revision_hash}"
+                f"Full manifest points to invalid revision: {manifest.revision_hash}"
             )
-        return manifest.manifest
+        return manifest
 
     # Follow redirect.
-    manifest_file = manifest_path(
-        storage_root,
-        RepositoryRevision(
-            repository=repository_revision.repository,
-            revision=manifest.manifest.revision_hash,
-        ),
+    target_revision = RepositoryRevision(
+        repository=repository_revision.repository,
+        revision=manifest.revision_hash,
     )
-    if manifest_file is None:
+    if target_revision.path_safe_string() is None:
         # Repository name is valid (passed first check) so the hash must be invalid.
         raise Exception(
-            f"Redirect manifest points to invalid revision: {manifest.manifest.revision_hash}"
+            f"Redirect manifest points to invalid revision: {manifest.revision_hash}"
         )
-    try:
-        with open(manifest_file, "r") as f:
-            manifest = Manifest.model_validate_json(f.read())
-    except Exception:
+    target = read(target_revision)
+    if target is None:
         # If we have redirect the hash it points to must be valid.
-        logging.error(f"Error loading redirect manifest {manifest_file}", exc_info=True)
-        raise
-
-    if manifest.manifest.manifest_type != "full":
+        raise FileNotFoundError(
+            f"Redirect manifest points to missing manifest: {target_revision}"
+        )
+    if target.manifest_type != "full":
         raise Exception(
-            f"Redirect manifest points to another redirect: {manifest_file}"
+            f"Redirect manifest points to another redirect: {target_revision}"
         )
-    if manifest.manifest.revision_hash != manifest.manifest.revision_hash:
+    if target.revision_hash != target_revision.revision:
         raise Exception(
-            f"Full manifest points to invalid revision: {manifest.manifest.revision_hash}"
+            f"Full manifest points to invalid revision: {target.revision_hash}"
         )
-    return manifest.manifest
+    return target
 
 
-def move_local_blobs(local_snapshot: str, local_directory: str) -> dict[str, str]:
-    # Move all files into local_directory/blobs/hash and return a mapping from original path to the hash.
-    file_hashes = {}
-    os.makedirs(
-        os.path.dirname(blob_path(local_directory, "")),
-        exist_ok=True,
+def load_full_manifest(
+    storage_root: str,
+    repository_revision: RepositoryRevision,
+) -> Optional[FullManifest]:
+    return resolve_full_manifest(
+        repository_revision,
+        lambda revision: read_manifest(storage_root, revision),
     )
+
+
+def snapshot_files(local_snapshot: str) -> list[str]:
+    # Sorted paths (relative to local_snapshot) of the files to mirror.
+    relative_paths = []
     for root, _, files in os.walk(local_snapshot):
         for file in files:
             file_path = os.path.join(root, file)
@@ -138,32 +238,188 @@ def move_local_blobs(local_snapshot: str, local_directory: str) -> dict[str, str
 
             # This has timestamps / changes on every run, and is not needed, just skip it
             # so we don't have to re-upload and overwrite manifests each time.
-            print(relative_path)
             if relative_path.startswith(".cache/huggingface/"):
                 continue
+            relative_paths.append(relative_path)
+    return sorted(relative_paths)
+
+
+def move_local_blobs(
+    local_snapshot: str,
+    local_directory: str,
+    workers: Optional[int] = None,
+    read_size: int = HASH_READ_SIZE,
+    progress: Optional[Callable[[str, int], None]] = None,
+) -> dict[str, str]:
+    # Move all files into local_directory/blobs/hash and return a mapping from original path to the hash.
+    #
+    # Files are hashed in parallel by `workers` threads (hashlib releases the
+    # GIL), `progress` is called (from those threads) with the relative path
+    # and size of each file once it is hashed. Blobs are moved afterwards in
+    # path order, so the result doesn't depend on which hash finished first.
+    os.makedirs(
+        os.path.dirname(blob_path(local_directory, "")),
+        exist_ok=True,
+    )
+    relative_paths = snapshot_files(local_snapshot)
+
+    def hash_file(relative_path: str) -> str:
+        file_path = os.path.join(local_snapshot, relative_path)
+        file_hash = get_file_hash(file_path, read_size)
+        if progress is not None:
+            progress(relative_path, os.path.getsize(file_path))
+        return file_hash
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=workers or os.cpu_count() or 1
+    ) as executor:
+        hashes = list(executor.map(hash_file, relative_paths))
 
-            file_hash = get_file_hash(file_path)
-            blob_file_path = blob_path(local_directory, file_hash)
-            if not os.path.exists(blob_file_path):
-                os.rename(file_path, blob_file_path)
-            file_hashes[relative_path] = file_hash
+    file_hashes = {}
+    for relative_path, file_hash in zip(relative_paths, hashes):
+        blob_file_path = blob_path(local_directory, file_hash)
+        if not os.path.exists(blob_file_path):
+            os.rename(os.path.join(local_snapshot, relative_path), blob_file_path)
+        file_hashes[relative_path] = file_hash
     return file_hashes
 
 
+def local_file_metadata(
+    local_directory: str, files: dict[str, str]
+) -> dict[str, FileMetadata]:
+    # Metadata for the manifest, from blobs already in local_directory.
+    sizes = {}
+    for file_hash in set(files.values()):
+        sizes[file_hash] = os.path.getsize(blob_path(local_directory, file_hash))
+    return {path: FileMetadata(size=sizes[hash]) for path, hash in files.items()}
+
+
+def publish_blob(local_directory: str, file_path: str, file_hash: str):
+    # Moves a file into the blob store, unless we already have the blob.
+    blob_file_path = blob_path(local_directory, file_hash)
+    if os.path.exists(blob_file_path):
+        os.remove(file_path)
+        return
+    os.makedirs(os.path.dirname(blob_file_path), exist_ok=True)
+    os.rename(file_path, blob_file_path)
+
+
+# Upper bound on the size of a pack, the server reads it whole.
+PACK_MAX_BYTES = 64 * 1024 * 1024
+
+
+def write_pack(
+    local_directory: str,
+    files: dict[str, str],
+    file_metadata: dict[str, FileMetadata],
+    max_file_bytes: int,
+    max_bytes: int = PACK_MAX_BYTES,
+) -> Optional[Pack]:
+    # Concatenates the blobs up to max_file_bytes (smallest first, until the
+    # pack would exceed max_bytes) into a pack blob in local_directory.
+    # Members are picked by the sizes in file_metadata (files without it are
+    # not packed), only they must be in local_directory: other blobs may be
+    # uploaded and removed already. Returns None if there would be fewer than
+    # two members, the pack wouldn't save anything.
+    sizes = {
+        files[path]: metadata.size
+        for path, metadata in file_metadata.items()
+        if path in files
+    }
+    members = []
+    total_bytes = 0
+    for file_hash in sorted(sizes, key=lambda h: (sizes[h], h)):
+        size = sizes[file_hash]
+        if size > max_file_bytes or total_bytes + size > max_bytes:
+            break
+        members.append(file_hash)
+        total_bytes += size
+    if len(members) < 2:
+        return None
+
+    temp_path = blob_path(local_directory, f"pack.tmp-{os.getpid()}")
+    hash = blob_hasher()
+    entries = {}
+    with open(temp_path, "wb") as pack_file:
+        for file_hash in members:
+            with open(blob_path(local_directory, file_hash), "rb") as f:
+                data = f.read()
+            entries[file_hash] = PackEntry(offset=pack_file.tell(), size=len(data))
+            pack_file.write(data)
+            hash.update(data)
+    pack_hash = hash.hexdigest()
+    publish_blob(local_directory, temp_path, pack_hash)
+    return Pack(blob_hash=pack_hash, entries=entries)
+
+
+def write_chunks(
+    local_directory: str,
+    file_hash: str,
+    average_size: int = AVERAGE_CHUNK_BYTES,
+) -> tuple[ChunkList, int]:
+    # Splits the blob into chunks stored as blobs in local_directory and
+    # writes its chunk list. The blob itself is left in place. Returns the
+    # chunk list and the number of bytes of chunks that weren't stored yet.
+    chunks = []
+    new_bytes = 0
+    with open(blob_path(local_directory, file_hash), "rb") as f:
+        for data in split_chunks(f, average_size):
+            chunk_hash = blob_hasher()
+            chunk_hash.update(data)
+            chunk = ChunkEntry(blob_hash=chunk_hash.hexdigest(), size=len(data))
+            chunks.append(chunk)
+            chunk_file_path = blob_path(local_directory, chunk.blob_hash)
+            if os.path.exists(chunk_file_path):
+                continue
+            temp_path = f"{chunk_file_path}.tmp-{os.getpid()}"
+            with open(temp_path, "wb") as chunk_file:
+                chunk_file.write(data)
+            os.replace(temp_path, chunk_file_path)
+            new_bytes += len(data)
+    chunk_list = ChunkList(size=sum(chunk.size for chunk in chunks), chunks=chunks)
+    path = chunk_list_path(local_directory, file_hash)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    write_file_atomic(path, chunk_list.model_dump_json())
+    return chunk_list, new_bytes
+
+
+def read_chunk_list(storage_root: str, file_hash: str) -> ChunkList:
+    with open(chunk_list_path(storage_root, file_hash), "r") as f:
+        return ChunkList.model_validate_json(f.read())
+
+
+def write_file_atomic(path: str, content: str):
+    # The server may be reading manifests while they are (re)written, make
+    # sure it never sees a partially written file.
+    temp_path = f"{path}.tmp-{os.getpid()}"
+    with open(temp_path, "w") as f:
+        f.write(content)
+    os.replace(temp_path, path)
+
+
 def write_local_manifests(
     repository_revision: RepositoryRevision,
     original_repository_revision: RepositoryRevision,
     files: dict[str, str],
     local_directory: str,
+    file_metadata: Optional[dict[str, FileMetadata]] = None,
+    pack: Optional[Pack] = None,
+    chunked_blobs: Optional[list[str]] = None,
 ):
     # Full manifest.
-    manifest = FullManifest(revision_hash=repository_revision.revision, files=files)
+    manifest = FullManifest(
+        revision_hash=repository_revision.revision,
+        files=files,
+        file_metadata=file_metadata or {},
+        pack=pack,
+        chunked_blobs=sorted(chunked_blobs or []),
+    )
     full_manifest_path = manifest_path(local_directory, repository_revision)
     if full_manifest_path is None:
         raise ValueError(f"Invalid repository revision: {repository_revision}")
     os.makedirs(os.path.dirname(full_manifest_path), exist_ok=True)
-    with open(full_manifest_path, "w") as f:
-        f.write(Manifest(manifest=manifest).model_dump_json())
+    write_file_atomic(full_manifest_path, Manifest(manifest=manifest).model_dump_json())
+    record_blob_oids(local_directory, files, file_metadata or {})
 
     if repository_revision.revision != original_repository_revision.revision:
         # Redirect manifest.
@@ -175,5 +431,54 @@ def write_local_manifests(
             raise ValueError(
                 f"Invalid original repository revision: {original_repository_revision}"
             )
-        with open(redirect_manifest_path, "w") as f:
-            f.write(Manifest(manifest=redirect_manifest).model_dump_json())
+        write_file_atomic(
+            redirect_manifest_path,
+            Manifest(manifest=redirect_manifest).model_dump_json(),
+        )
+
+
+def record_blob_oids(
+    local_directory: str, files: dict[str, str], file_metadata: dict[str, FileMetadata]
+):
+    # Adds the files to the upstream object id index. Entries never change,
+    # the same upstream object always has the same contents.
+    for path, file_hash in files.items():
+        metadata = file_metadata.get(path)
+        oid = metadata.etag() if metadata is not None else None
+        if oid is None:
+            continue
+        index_path = oid_index_path(local_directory, oid)
+        if os.path.exists(index_path):
+            continue
+        os.makedirs(os.path.dirname(index_path), exist_ok=True)
+        write_file_atomic(index_path, file_hash)
+
+
+def oid_index_paths(
+    local_directory: str, files: dict[str, str], file_metadata: dict[str, FileMetadata]
+) -> list[str]:
+    # Index entries of the files, as written by record_blob_oids.
+    oids = {
+        metadata.etag() for path, metadata in file_metadata.items() if path in files
+    }
+    return sorted(oid_index_path(local_directory, oid) for oid in oids if oid)
+
+
+def find_stored_blob(local_directory: str, metadata: FileMetadata) -> Optional[str]:
+    # Hash of the blob with the same contents as the upstream file, if it is
+    # in local_directory.
+    oid = metadata.etag()
+    if oid is None:
+        return None
+    try:
+        with open(oid_index_path(local_directory, oid), "r") as f:
+            file_hash = f.read().strip()
+    except FileNotFoundError:
+        return None
+    blob_file_path = blob_path(local_directory, file_hash)
+    if not os.path.exists(blob_file_path):
+        return None
+    if os.path.getsize(blob_file_path) != metadata.size:
+        logging.warning(f"Size mismatch for blob {file_hash} of {oid}, ignoring it")
+        return None
+    return file_hash
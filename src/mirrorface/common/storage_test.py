@@ -4,14 +4,21 @@ import pytest
 
 from mirrorface.common.hub import RepositoryRevision
 from mirrorface.common.storage import (
+    FileMetadata,
     FullManifest,
     Manifest,
     RedirectManifest,
     blob_path,
+    find_stored_blob,
+    get_file_hash,
     load_full_manifest,
+    local_file_metadata,
     manifest_path,
     move_local_blobs,
+    read_chunk_list,
+    write_chunks,
     write_local_manifests,
+    write_pack,
 )
 
 
@@ -165,7 +172,14 @@ def test_move_local_blobs(tmp_path_factory):
     with open(snapshot_dir / ".cache/huggingface/foo", "w") as f:
         f.write("should be skipped")
 
-    file_hashes = move_local_blobs(snapshot_dir, target_dir)
+    progress = []
+    file_hashes = move_local_blobs(
+        snapshot_dir,
+        target_dir,
+        workers=3,
+        read_size=2,
+        progress=lambda path, size: progress.append((path, size)),
+    )
 
     # Check the returned hashes / paths are ok.
     file1hash = "119c19f868a33109852c09d66f6a5c73a7cd52f38325020a461cd94a74edef88709fcbc547d96d0ad9da671260fc42322d177378bad7a285f5df03f8e28f8565"
@@ -188,6 +202,16 @@ def test_move_local_blobs(tmp_path_factory):
     assert_file_content(target_dir / "blob" / file2hash, "file2")
     assert_file_content(target_dir / "blob" / file3hash, "file3")
 
+    assert sorted(progress) == [
+        ("file1", 5),
+        ("file2", 5),
+        ("subdir/file1", 5),
+        ("subdir/file3", 5),
+    ]
+    # Duplicate content, first path in sorted order is moved.
+    assert not os.path.exists(snapshot_dir / "file1")
+    assert os.path.exists(snapshot_dir / "subdir/file1")
+
 
 def test_write_local_manifests(tmp_path_factory):
     target_dir = tmp_path_factory.mktemp("target")
@@ -206,3 +230,157 @@ def test_write_local_manifests(tmp_path_factory):
     manifest = load_full_manifest(target_dir, revision)
     assert manifest == FullManifest(revision_hash="hash1", files=files)
     assert manifest == load_full_manifest(target_dir, original_revision)
+
+
+def test_load_full_manifest_without_metadata(temp_storage_root):
+    # Manifests written before file metadata was added.
+    hash1 = RepositoryRevision(repository="user/repo", revision="hash1")
+    hash1_path = manifest_path(temp_storage_root, hash1)
+    assert hash1_path is not None
+    with open(hash1_path, "w") as f:
+        f.write(
+            '{"manifest": {"manifest_type": "full", "revision_hash": "hash1", "files": {"file1": "filehash1"}}}'
+        )
+
+    m = load_full_manifest(temp_storage_root, hash1)
+    assert m is not None
+    assert m.file_metadata == {}
+
+
+def test_write_local_manifests_with_metadata(tmp_path_factory):
+    target_dir = tmp_path_factory.mktemp("target")
+    os.makedirs(target_dir / "blob")
+    with open(blob_path(str(target_dir), "filehash1"), "w") as f:
+        f.write("file1")
+    with open(blob_path(str(target_dir), "filehash2"), "w") as f:
+        f.write("file2 longer")
+
+    revision = RepositoryRevision(repository="user/repo", revision="hash1")
+    files = {"file1": "filehash1", "file2": "filehash2", "copy": "filehash1"}
+    file_metadata = local_file_metadata(str(target_dir), files)
+    assert file_metadata == {
+        "file1": FileMetadata(size=5),
+        "file2": FileMetadata(size=12),
+        "copy": FileMetadata(size=5),
+    }
+
+    write_local_manifests(revision, revision, files, target_dir, file_metadata)
+    manifest = load_full_manifest(target_dir, revision)
+    assert manifest is not None
+    assert manifest.file_metadata == file_metadata
+
+
+def test_write_pack(tmp_path_factory):
+    target_dir = str(tmp_path_factory.mktemp("target"))
+    os.makedirs(os.path.join(target_dir, "blob"))
+    contents = {"filehash1": b"one", "filehash2": b"second", "filehash3": b"x" * 100}
+    for file_hash, data in contents.items():
+        with open(blob_path(target_dir, file_hash), "wb") as f:
+            f.write(data)
+    files = {"a": "filehash1", "b": "filehash2", "c": "filehash3", "d": "filehash1"}
+
+    file_metadata = local_file_metadata(target_dir, files)
+    pack = write_pack(target_dir, files, file_metadata, max_file_bytes=10)
+    assert pack is not None
+    assert sorted(pack.entries) == ["filehash1", "filehash2"]
+    with open(blob_path(target_dir, pack.blob_hash), "rb") as f:
+        pack_data = f.read()
+    for file_hash, entry in pack.entries.items():
+        assert (
+            pack_data[entry.offset : entry.offset + entry.size] == contents[file_hash]
+        )
+    # Content-addressed like the other blobs, no temporary files left behind.
+    assert pack.blob_hash == get_file_hash(blob_path(target_dir, pack.blob_hash))
+    assert len(os.listdir(os.path.join(target_dir, "blob"))) == 4
+
+    revision = RepositoryRevision(repository="user/repo", revision="hash1")
+    write_local_manifests(revision, revision, files, target_dir, pack=pack)
+    manifest = load_full_manifest(target_dir, revision)
+    assert manifest is not None and manifest.pack == pack
+
+    # A single small file, or a budget only one fits in: nothing to pack.
+    assert (
+        write_pack(target_dir, {"a": "filehash1", "c": "filehash3"}, file_metadata, 10)
+        is None
+    )
+    assert (
+        write_pack(target_dir, files, file_metadata, max_file_bytes=10, max_bytes=5)
+        is None
+    )
+
+    # Blobs that are not packed don't need to be there any more.
+    os.remove(blob_path(target_dir, "filehash3"))
+    assert write_pack(target_dir, files, file_metadata, max_file_bytes=10) == pack
+
+
+def test_write_chunks(tmp_path_factory):
+    target_dir = str(tmp_path_factory.mktemp("target"))
+    os.makedirs(os.path.join(target_dir, "blob"))
+    data = os.urandom(64 * 1024)
+    with open(blob_path(target_dir, "filehash1"), "wb") as f:
+        f.write(data)
+    # Same file with a few bytes inserted in the middle.
+    with open(blob_path(target_dir, "filehash2"), "wb") as f:
+        f.write(data[:30000] + b"inserted" + data[30000:])
+
+    chunk_list, new_bytes = write_chunks(target_dir, "filehash1", average_size=1024)
+    assert new_bytes == chunk_list.size == len(data)
+    assert len(chunk_list.chunks) > 10
+    assert read_chunk_list(target_dir, "filehash1") == chunk_list
+    contents = b""
+    for chunk in chunk_list.chunks:
+        with open(blob_path(target_dir, chunk.blob_hash), "rb") as f:
+            contents += f.read()
+    assert contents == data
+
+    # Only the chunks around the insert are new.
+    second_list, second_new_bytes = write_chunks(target_dir, "filehash2", 1024)
+    assert second_list.size == len(data) + 8
+    assert 0 < second_new_bytes < 16 * 1024
+    # The blobs themselves are kept.
+    assert os.path.exists(blob_path(target_dir, "filehash1"))
+
+    revision = RepositoryRevision(repository="user/repo", revision="hash1")
+    files = {"b": "filehash2", "a": "filehash1"}
+    write_local_manifests(
+        revision, revision, files, target_dir, chunked_blobs=["filehash2", "filehash1"]
+    )
+    manifest = load_full_manifest(target_dir, revision)
+    assert manifest is not None
+    assert manifest.chunked_blobs == ["filehash1", "filehash2"]
+
+
+def test_find_stored_blob(tmp_path_factory):
+    target_dir = tmp_path_factory.mktemp("target")
+    os.makedirs(target_dir / "blob")
+    with open(blob_path(str(target_dir), "filehash1"), "w") as f:
+        f.write("file1")
+    with open(blob_path(str(target_dir), "filehash2"), "w") as f:
+        f.write("file2")
+
+    revision = RepositoryRevision(repository="user/repo", revision="hash1")
+    files = {"file1": "filehash1", "file2": "filehash2", "file3": "filehash1"}
+    file_metadata = {
+        "file1": FileMetadata(size=5, blob_id="1" * 40),
+        "file2": FileMetadata(size=5, blob_id="2" * 40, lfs_sha256="3" * 64),
+        # Old manifests don't have the upstream ids.
+        "file3": FileMetadata(size=5),
+    }
+    write_local_manifests(revision, revision, files, target_dir, file_metadata)
+
+    assert find_stored_blob(target_dir, FileMetadata(size=5, blob_id="1" * 40)) == (
+        "filehash1"
+    )
+    # LFS files are indexed by their SHA-256.
+    assert (
+        find_stored_blob(target_dir, FileMetadata(size=5, lfs_sha256="3" * 64))
+        == "filehash2"
+    )
+    assert find_stored_blob(target_dir, FileMetadata(size=5, blob_id="2" * 40)) is None
+    assert find_stored_blob(target_dir, FileMetadata(size=5)) is None
+    # Must match the upstream size.
+    assert find_stored_blob(target_dir, FileMetadata(size=6, blob_id="1" * 40)) is None
+
+    # The index is only useful while we have the blob.
+    os.remove(blob_path(str(target_dir), "filehash1"))
+    assert find_stored_blob(target_dir, FileMetadata(size=5, blob_id="1" * 40)) is None
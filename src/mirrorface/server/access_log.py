@@ -0,0 +1,133 @@
+# Structured access log, one JSON record per request.
+#
+# Handlers add what they know about the current request to its record
+# (annotate), eg. where the file was served from or the upstream status. The
+# response middleware (timing.py) adds the status, bytes and durations, and
+# emits the record once the response is done.
+#
+# Writing to stderr from the event loop blocks it, so the logging of a worker
+# goes through queues to background threads, which format and write the
+# records: access records as JSON lines to stdout (AccessLog), other logs to
+# the handlers of the root logger (BackgroundLogging).
+#
+# Clients probe for many files that don't exist, so 404s can come at a high
+# rate. Only not_found_sample_rate of them are logged, with the sample rate in
+# the record to weigh them by when counting.
+
+import contextvars
+import datetime
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import time
+from typing import Any, Callable, Optional
+
+ACCESS_LOGGER = "mirrorface.access"
+
+current_record: contextvars.ContextVar[Optional[dict[str, Any]]] = (
+    contextvars.ContextVar("access_log_record", default=None)
+)
+
+
+def annotate(**fields: Any):
+    # Adds the fields to the record of the current request, if any.
+    record = current_record.get()
+    if record is not None:
+        record.update(fields)
+
+
+class AccessLog:
+    def __init__(
+        self,
+        not_found_sample_rate: float = 1,
+        random: Callable[[], float] = random.random,
+    ):
+        self.not_found_sample_rate = not_found_sample_rate
+        self.random = random
+        # Records are queued as they are, the listener thread turns them into
+        # log records. Creating a LogRecord on the event loop costs more than
+        # the rest of emit.
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._listener: Optional[AccessLogListener] = None
+
+    def start(self, handler: Optional[logging.Handler] = None):
+        # Writes JSON lines to stdout, unless given another handler.
+        if handler is None:
+            handler = logging.StreamHandler(sys.stdout)
+            handler.setFormatter(JsonFormatter())
+        self._listener = AccessLogListener(self._queue, handler)
+        self._listener.start()
+
+    def stop(self):
+        # Writes out the records still in the queue.
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def emit(self, record: dict[str, Any]):
+        if self._listener is None:
+            return
+        if record.get("status") == 404 and self.not_found_sample_rate < 1:
+            if self.random() >= self.not_found_sample_rate:
+                return
+            record["sample_rate"] = self.not_found_sample_rate
+        self._queue.put_nowait((time.time(), record))
+
+
+class AccessLogListener(logging.handlers.QueueListener):
+    def prepare(self, record: Any) -> logging.LogRecord:
+        created, access = record
+        log_record = logging.LogRecord(
+            ACCESS_LOGGER, logging.INFO, "", 0, "access", None, None
+        )
+        log_record.created = created
+        setattr(log_record, "access", access)
+        return log_record
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        timestamp = datetime.datetime.fromtimestamp(record.created, datetime.UTC)
+        return json.dumps(
+            {"time": timestamp.isoformat(), **getattr(record, "access", {})}
+        )
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The queue doesn't leave the process, format on the listener thread.
+        return record
+
+
+class BackgroundLogging:
+    def __init__(self):
+        # Handlers of the root logger move behind the queue. Without any, the
+        # same default handler logging.info would set up on first use.
+        root = logging.getLogger()
+        handlers = root.handlers[:]
+        if not handlers:
+            handler = logging.StreamHandler()
+            handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+            handlers = [handler]
+        for handler in handlers:
+            root.removeHandler(handler)
+        self._root_handlers = handlers
+        root_queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._root_handler = BackgroundQueueHandler(root_queue)
+        root.addHandler(self._root_handler)
+        self._listener = logging.handlers.QueueListener(
+            root_queue, *handlers, respect_handler_level=True
+        )
+        self._listener.start()
+
+    def stop(self):
+        # Writes out the records still in the queue, and logs directly from
+        # then on.
+        root = logging.getLogger()
+        root.removeHandler(self._root_handler)
+        self._listener.stop()
+        for handler in self._root_handlers:
+            root.addHandler(handler)
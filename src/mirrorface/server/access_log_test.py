@@ -0,0 +1,33 @@
+import json
+import logging
+
+from mirrorface.server.access_log import AccessLog, JsonFormatter
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        super().__init__()
+        self.lines = []
+
+    def emit(self, record):
+        self.lines.append(json.loads(JsonFormatter().format(record)))
+
+
+def test_access_log_not_found_sampling():
+    samples = iter([0.05, 0.5])
+    access_log = AccessLog(not_found_sample_rate=0.1, random=lambda: next(samples))
+    # Not started, nothing is queued.
+    access_log.emit({"path": "/ignored", "status": 200})
+
+    handler = RecordingHandler()
+    access_log.start(handler)
+    access_log.emit({"path": "/a", "status": 404})
+    access_log.emit({"path": "/b", "status": 404})
+    access_log.emit({"path": "/c", "status": 200})
+    access_log.stop()
+
+    assert [line.pop("time")[-6:] for line in handler.lines] == ["+00:00"] * 2
+    assert handler.lines == [
+        {"path": "/a", "status": 404, "sample_rate": 0.1},
+        {"path": "/c", "status": 200},
+    ]
@@ -0,0 +1,218 @@
+# Optional second storage tier for blobs on fast local disk (eg. local SSD).
+#
+# The main local directory is usually a GCS bucket mounted through FUSE, where
+# cold reads of large files are slow. When enabled, blobs are copied into the
+# cache directory on their first read (while being streamed to the client) and
+# served from there afterwards.
+#
+# Blobs are content-addressed so cached copies never need invalidation, only
+# eviction when the cache goes over its byte budget. The directory is shared
+# by all worker processes: files are published with an atomic rename and
+# eviction runs under a file lock, using the directory itself as the source
+# of truth for what is cached.
+
+import collections
+import fcntl
+import logging
+import os
+import time
+from typing import AsyncIterator, Literal, Optional
+
+import anyio
+import anyio.to_thread
+
+from mirrorface.server import metrics
+from mirrorface.server.responses import FileBlobSource
+
+LOCK_FILE = ".lock"
+TEMP_PREFIX = ".tmp-"
+# Temporary files older than this are leftovers from crashed workers.
+STALE_TEMP_SECONDS = 60 * 60
+
+EvictionPolicy = Literal["lru", "lfu"]
+
+
+class BlobCache:
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        eviction_policy: EvictionPolicy = "lru",
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.eviction_policy: EvictionPolicy = eviction_policy
+        # For LFU. Only counts hits seen by this worker, so with multiple
+        # workers it is an approximation (ties are broken by recency).
+        self._hit_counts: collections.Counter[str] = collections.Counter()
+        # Blobs this worker is currently copying in, to avoid duplicate copies.
+        self._populating: set[str] = set()
+        os.makedirs(directory, exist_ok=True)
+        self._evict(0)
+
+    def path(self, blob_hash: str) -> str:
+        return os.path.join(self.directory, blob_hash)
+
+    def lookup(self, blob_hash: str) -> Optional[os.stat_result]:
+        # Returns stat of the cached copy if present, and records the access.
+        path = self.path(blob_hash)
+        try:
+            stat_result = os.stat(path)
+        except FileNotFoundError:
+            return None
+        self._hit_counts[blob_hash] += 1
+        if self.eviction_policy == "lru":
+            try:
+                # Modification time is our "last used" time.
+                os.utime(path)
+            except FileNotFoundError:
+                # Evicted by another worker in the meantime.
+                return None
+        return stat_result
+
+    def should_populate(self, blob_hash: str, size: int) -> bool:
+        return size <= self.max_bytes and blob_hash not in self._populating
+
+    async def read_through(
+        self, blob_hash: str, source_path: str, size: int, chunk_size: int
+    ) -> AsyncIterator[bytes]:
+        # Streams the blob from source_path while copying it into the cache.
+        # Any problem with the cache only stops the copy, never the response.
+        self._populating.add(blob_hash)
+        temp_path = os.path.join(
+            self.directory, f"{TEMP_PREFIX}{os.getpid()}-{blob_hash}"
+        )
+        temp_file = None
+        copied = 0
+        try:
+            try:
+                # Make room up front so concurrent copies don't overshoot much.
+                await anyio.to_thread.run_sync(self._evict, size)
+                temp_file = await anyio.open_file(temp_path, "wb")
+            except OSError:
+                logging.warning(
+                    f"Failed to start copying {blob_hash} into blob cache",
+                    exc_info=True,
+                )
+
+            async with await anyio.open_file(source_path, "rb") as source:
+                while chunk := await source.read(chunk_size):
+                    if temp_file is not None:
+                        try:
+                            await temp_file.write(chunk)
+                            copied += len(chunk)
+                        except OSError:
+                            logging.warning(
+                                f"Failed to copy {blob_hash} into blob cache",
+                                exc_info=True,
+                            )
+                            await temp_file.aclose()
+                            temp_file = None
+                    yield chunk
+
+            if temp_file is not None:
+                await temp_file.aclose()
+                temp_file = None
+                if copied == size:
+                    await self._publish(blob_hash, temp_path, copied)
+                else:
+                    logging.warning(
+                        f"Size mismatch copying {blob_hash} into blob cache: {copied} != {size}"
+                    )
+        finally:
+            # Also runs if the client disconnects mid-stream.
+            self._populating.discard(blob_hash)
+            if temp_file is not None:
+                await temp_file.aclose()
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    async def _publish(self, blob_hash: str, temp_path: str, size: int):
+        try:
+            os.rename(temp_path, self.path(blob_hash))
+            # Refresh occupancy (and evict if other workers overshot).
+            await anyio.to_thread.run_sync(self._evict, 0)
+        except OSError:
+            logging.warning(
+                f"Failed to publish {blob_hash} in blob cache", exc_info=True
+            )
+            return
+        metrics.blob_cache_populated_bytes_inc(size)
+        logging.info(f"Copied {blob_hash} into blob cache: {size} bytes")
+
+    def _evict(self, reserve_bytes: int):
+        # Deletes blobs until the total size plus reserve_bytes fits the budget.
+        with open(os.path.join(self.directory, LOCK_FILE), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                self._evict_locked(reserve_bytes)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _evict_locked(self, reserve_bytes: int):
+        now = time.time()
+        blobs: list[tuple[str, int, float]] = []
+        total_bytes = 0
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    stat_result = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name == LOCK_FILE:
+                    continue
+                if entry.name.startswith(TEMP_PREFIX):
+                    if now - stat_result.st_mtime > STALE_TEMP_SECONDS:
+                        os.remove(entry.path)
+                    else:
+                        # In-flight copies count towards the budget.
+                        total_bytes += stat_result.st_size
+                    continue
+                blobs.append((entry.name, stat_result.st_size, stat_result.st_mtime))
+                total_bytes += stat_result.st_size
+
+        if self.eviction_policy == "lfu":
+            blobs.sort(key=lambda b: (self._hit_counts[b[0]], b[2]))
+        else:
+            blobs.sort(key=lambda b: b[2])
+
+        for blob_hash, size, _ in blobs:
+            if total_bytes + reserve_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(self.path(blob_hash))
+            except FileNotFoundError:
+                pass
+            self._hit_counts.pop(blob_hash, None)
+            total_bytes -= size
+            metrics.blob_cache_eviction_inc(size)
+            logging.info(f"Evicted {blob_hash} from blob cache: {size} bytes")
+
+        metrics.blob_cache_occupancy_set(total_bytes)
+
+
+class ReadThroughBlobSource(FileBlobSource):
+    """Blob in local storage which gets copied into the cache on whole-file reads."""
+
+    def __init__(self, cache: BlobCache, blob_hash: str, path: str, size: int):
+        super().__init__(path, size)
+        self.cache = cache
+        self.blob_hash = blob_hash
+
+    def sendfile_path(self) -> Optional[str]:
+        # The bytes are needed to copy them into the cache.
+        if self.cache.should_populate(self.blob_hash, self.size):
+            return None
+        return self.path
+
+    def read(self, start: int, end: int, chunk_size: int) -> AsyncIterator[bytes]:
+        # Ranges are served directly, only whole-file reads populate the cache.
+        if (
+            start == 0
+            and end == self.size
+            and self.cache.should_populate(self.blob_hash, self.size)
+        ):
+            return self.cache.read_through(
+                self.blob_hash, self.path, self.size, chunk_size
+            )
+        return super().read(start, end, chunk_size)
@@ -0,0 +1,65 @@
+import os
+
+import anyio
+
+from mirrorface.server.blob_cache import BlobCache, ReadThroughBlobSource
+
+
+def write_blob(path, size: int) -> bytes:
+    data = os.urandom(size)
+    with open(path, "wb") as f:
+        f.write(data)
+    return data
+
+
+async def read_all(cache: BlobCache, blob_hash: str, source: str, size: int) -> bytes:
+    chunks = [c async for c in cache.read_through(blob_hash, source, size, 1000)]
+    return b"".join(chunks)
+
+
+def test_blob_cache_read_through(tmp_path):
+    source = tmp_path / "source"
+    data = write_blob(source, 2500)
+    cache = BlobCache(str(tmp_path / "cache"), max_bytes=10_000)
+
+    assert cache.lookup("hash1") is None
+    assert anyio.run(read_all, cache, "hash1", str(source), 2500) == data
+
+    stat_result = cache.lookup("hash1")
+    assert stat_result is not None
+    assert stat_result.st_size == 2500
+    with open(cache.path("hash1"), "rb") as f:
+        assert f.read() == data
+    # No temporary files left behind.
+    assert sorted(os.listdir(tmp_path / "cache")) == [".lock", "hash1"]
+
+
+def test_blob_cache_eviction_lru(tmp_path):
+    cache = BlobCache(str(tmp_path / "cache"), max_bytes=2500)
+    for i, blob_hash in enumerate(["hash1", "hash2", "hash3"]):
+        source = tmp_path / blob_hash
+        write_blob(source, 1000)
+        anyio.run(read_all, cache, blob_hash, str(source), 1000)
+        os.utime(cache.path(blob_hash), (i, i))
+        # Touching hash1 makes hash2 the least recently used.
+        if blob_hash == "hash2":
+            assert cache.lookup("hash1") is not None
+
+    assert cache.lookup("hash1") is not None
+    assert cache.lookup("hash2") is None
+    assert cache.lookup("hash3") is not None
+
+
+def test_blob_cache_too_large(tmp_path):
+    cache = BlobCache(str(tmp_path / "cache"), max_bytes=100)
+    assert not cache.should_populate("hash1", 1000)
+    assert cache.should_populate("hash1", 100)
+
+
+def test_read_through_source_sendfile(tmp_path):
+    cache = BlobCache(str(tmp_path / "cache"), max_bytes=100)
+    # Whole-file reads copy into the cache, they need the bytes.
+    small = ReadThroughBlobSource(cache, "hash1", str(tmp_path / "small"), 100)
+    assert small.sendfile_path() is None
+    large = ReadThroughBlobSource(cache, "hash2", str(tmp_path / "large"), 1000)
+    assert large.sendfile_path() == str(tmp_path / "large")
@@ -0,0 +1,7 @@
+# Server settings are read from the environment when settings.py is imported,
+# tests of the modules using them need at least the local directory.
+
+import os
+import tempfile
+
+os.environ.setdefault("MIRRORFACE_LOCAL_DIRECTORY", tempfile.mkdtemp())
@@ -3,7 +3,14 @@ import shutil
 
 from prometheus_client import REGISTRY, multiprocess, start_http_server
 
-worker_class = "uvicorn.workers.UvicornWorker"
+from mirrorface.server.metrics_aggregation import (
+    ArchivingCollector,
+    archive_dead_process,
+)
+
+# Uvicorn with the ASGI pathsend extension, whole files are sent with
+# os.sendfile. See pathsend.py.
+worker_class = "mirrorface.server.pathsend.PathsendUvicornWorker"
 
 bind = "0.0.0.0:8000"
 
@@ -19,9 +26,13 @@ def on_starting(server):
     # Wipe between restarts, otherwise old metrics will persist.
     shutil.rmtree(multiproc_dir, ignore_errors=True)
     os.makedirs(multiproc_dir, exist_ok=True)
-    multiprocess.MultiProcessCollector(REGISTRY)
+    ArchivingCollector(REGISTRY)
     start_http_server(int(os.getenv("PROMETHEUS_MULTIPROC_PORT", 9000)))
 
 
 def child_exit(server, worker):
     multiprocess.mark_process_dead(worker.pid)
+    # Counters are kept, merged with those of all other dead workers.
+    multiproc_dir = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+    if multiproc_dir:
+        archive_dead_process(multiproc_dir, worker.pid)
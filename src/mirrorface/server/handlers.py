@@ -1,65 +1,244 @@
 import logging
 import os
-from typing import List, Optional, Set, Tuple
+from typing import AsyncIterator, List, Optional, Set, Tuple
 
 import aiohttp
+import anyio.to_thread
 import multidict
 from starlette.responses import (
-    FileResponse,
+    JSONResponse,
     PlainTextResponse,
     Response,
     StreamingResponse,
 )
 
-from mirrorface.common.hub import RepositoryRevisionPath
-from mirrorface.common.storage import blob_path, load_full_manifest
+from mirrorface.common.cache import TTLCache
+from mirrorface.common.hub import RepositoryRevision, RepositoryRevisionPath
+from mirrorface.common.storage import (
+    ChunkEntry,
+    ChunkList,
+    FullManifest,
+    Pack,
+    blob_path,
+    read_chunk_list,
+)
 from mirrorface.server import metrics
+from mirrorface.server.access_log import annotate
+from mirrorface.server.blob_cache import BlobCache, ReadThroughBlobSource
+from mirrorface.server.manifest_cache import ManifestCache
+from mirrorface.server.not_found_cache import NotFoundCache
+from mirrorface.server.prewarm import Prewarmer
+from mirrorface.server.responses import (
+    BlobResponse,
+    BlobSource,
+    ChunkedBlobSource,
+    FileBlobSource,
+    MemoryBlobSource,
+)
 from mirrorface.server.settings import settings
+from mirrorface.server.singleflight import FlightError, FlightTooLarge, SingleFlight
+from mirrorface.server.small_file_cache import SmallFileCache
+from mirrorface.server.write_through import WriteThrough, upstream_commit
 
 REQUEST_HEADERS_TO_FORWARD = set(
     [
         "user-agent",
+        # Resumed and parallel chunked downloads.
+        "range",
+        "if-range",
         # TODO: Auth headers for private HF Hub repositories.
     ]
 )
 RESPONSE_HEADERS_TO_FORWARD = set(
     [
+        "accept-ranges",
+        "content-range",
         "content-disposition",
         "content-length",
         "content-type",
         "etag",
+        "x-linked-etag",
+        "x-linked-size",
         "x-repo-commit",
     ]
 )
 
 
+blob_cache = (
+    BlobCache(
+        settings.blob_cache_directory,
+        max_bytes=settings.blob_cache_max_bytes,
+        eviction_policy=settings.blob_cache_eviction_policy,
+    )
+    if settings.blob_cache_directory
+    else None
+)
+small_file_cache = (
+    SmallFileCache(
+        settings.small_file_cache_directory,
+        max_bytes=settings.small_file_cache_max_bytes,
+        max_file_bytes=settings.small_file_cache_max_file_bytes,
+    )
+    if settings.small_file_cache_directory
+    else None
+)
+single_flight = (
+    SingleFlight(
+        settings.upstream_spool_directory,
+        chunk_size=settings.chunk_size,
+        max_spool_bytes=settings.upstream_spool_max_bytes,
+    )
+    if settings.upstream_coalescing
+    else None
+)
+manifest_cache = ManifestCache(
+    settings.local_directory,
+    max_entries=settings.manifest_cache_max_entries,
+    full_ttl=settings.manifest_cache_full_ttl_seconds,
+    redirect_ttl=settings.manifest_cache_redirect_ttl_seconds,
+    missing_ttl=settings.manifest_cache_missing_ttl_seconds,
+)
+chunk_list_cache: TTLCache[str, ChunkList] = TTLCache(
+    settings.chunk_list_cache_max_entries
+)
+not_found_cache = NotFoundCache(
+    max_entries=settings.upstream_not_found_cache_max_entries,
+    commit_ttl=settings.upstream_not_found_commit_ttl_seconds,
+    branch_ttl=settings.upstream_not_found_branch_ttl_seconds,
+    shared_directory=settings.upstream_not_found_cache_directory,
+)
+
+prewarmer = Prewarmer(
+    settings.local_directory,
+    concurrency=settings.prewarm_concurrency,
+    chunk_size=settings.local_chunk_size,
+    state_directory=settings.prewarm_state_directory,
+    blob_cache=blob_cache,
+)
+
+write_through = (
+    WriteThrough(settings.local_directory, settings.upstream_url, manifest_cache)
+    if settings.write_through
+    else None
+)
+
+
 def filtered_headers(headers, headers_to_forward: Set[str]) -> List[Tuple[str, str]]:
     return [
         (name, value) for name, value in headers if name.lower() in headers_to_forward
     ]
 
 
-async def stream_response(
-    repository_revision_path: RepositoryRevisionPath,
+async def upstream_body(response: aiohttp.ClientResponse) -> AsyncIterator[bytes]:
+    try:
+        async for chunk in response.content.iter_chunked(settings.chunk_size):
+            yield chunk
+    finally:
+        # Returns the connection to the pool, or closes it if the body
+        # wasn't fully read (eg. client disconnected).
+        response.release()
+
+
+def upstream_download_body(
     session: aiohttp.ClientSession,
+    repository_revision_path: RepositoryRevisionPath,
     response: aiohttp.ClientResponse,
+    response_headers: dict[str, str],
+) -> AsyncIterator[bytes]:
+    body = upstream_body(response)
+    if write_through is None or response.status != 200 or response.method == "HEAD":
+        return body
+    commit = upstream_commit(response_headers)
+    if commit is None:
+        return body
+    # Content-Length is of the encoded body, we see the decoded one.
+    expected_size = (
+        None if "content-encoding" in response.headers else response.content_length
+    )
+    return write_through.tee(
+        session, repository_revision_path, commit, expected_size, body
+    )
+
+
+async def stream_response(
+    repository_revision_path: RepositoryRevisionPath,
+    body: AsyncIterator[bytes],
 ):
     total_size = 0
-    async for chunk in response.content.iter_chunked(settings.chunk_size):
+    async for chunk in body:
         yield chunk
         total_size += len(chunk)
     metrics.fallback_total_bytes_inc(repository_revision_path, total_size)
-    logging.info(
-        f"Upstream response OK for {repository_revision_path}, {total_size} bytes"
+
+
+def read_small_blob(
+    cache: SmallFileCache, blob_hash: str, blob_file_path: str
+) -> Optional[memoryview]:
+    # Reads the blob and copies it into the small file cache, None if it is
+    # too large for it. Reads from the blob cache if the blob is there.
+    if blob_cache is not None and blob_cache.lookup(blob_hash) is not None:
+        blob_file_path = blob_cache.path(blob_hash)
+    if not cache.should_cache(os.path.getsize(blob_file_path)):
+        return None
+    with open(blob_file_path, "rb") as f:
+        data = f.read()
+    cache.put(blob_hash, data)
+    return memoryview(data)
+
+
+def read_pack(
+    cache: SmallFileCache, blob_hash: str, pack: Pack
+) -> Optional[memoryview]:
+    # Reads the whole pack and copies its members into the small file cache,
+    # the other small files of the revision are likely requested next.
+    # Returns the member blob_hash, None if the pack is missing.
+    pack_file_path = blob_path(settings.local_directory, pack.blob_hash)
+    try:
+        with open(pack_file_path, "rb") as f:
+            data = memoryview(f.read())
+    except FileNotFoundError:
+        logging.warning(f"Pack {pack.blob_hash} not found, reading blobs instead")
+        return None
+    if any(entry.offset + entry.size > len(data) for entry in pack.entries.values()):
+        logging.warning(f"Pack {pack.blob_hash} is truncated, reading blobs instead")
+        return None
+    for member_hash, entry in pack.entries.items():
+        cache.put(member_hash, data[entry.offset : entry.offset + entry.size])
+    entry = pack.entries[blob_hash]
+    return data[entry.offset : entry.offset + entry.size]
+
+
+async def load_chunk_list(blob_hash: str) -> ChunkList:
+    try:
+        return chunk_list_cache[blob_hash]
+    except KeyError:
+        pass
+    chunk_list = await anyio.to_thread.run_sync(
+        read_chunk_list, settings.local_directory, blob_hash
+    )
+    chunk_list_cache.put(blob_hash, chunk_list)
+    return chunk_list
+
+
+def chunk_source(chunk: ChunkEntry) -> BlobSource:
+    # Chunks are blobs, they go through the blob cache like any other blob.
+    chunk_file_path = blob_path(settings.local_directory, chunk.blob_hash)
+    if blob_cache is None:
+        return FileBlobSource(chunk_file_path, chunk.size)
+    cached_stat = blob_cache.lookup(chunk.blob_hash)
+    if cached_stat is not None:
+        return FileBlobSource(blob_cache.path(chunk.blob_hash), cached_stat.st_size)
+    return ReadThroughBlobSource(
+        blob_cache, chunk.blob_hash, chunk_file_path, chunk.size
     )
-    await session.close()
 
 
 async def try_serve_locally(
     repository_revision_path: RepositoryRevisionPath,
+    is_head: bool = False,
 ) -> Optional[Response]:
-    manifest = load_full_manifest(
-        settings.local_directory, repository_revision_path.repository_revision
+    manifest = manifest_cache.load_full_manifest(
+        repository_revision_path.repository_revision
     )
     if not manifest:
         return None
@@ -69,47 +248,242 @@ async def try_serve_locally(
         # File is not in the repository manifest.
         # This is expected, the client tries various paths without knowing
         # if they are in the repo.
-        logging.info(
-            f"File {repository_revision_path.path} not in manifest, returning 404"
-        )
+        annotate(resolution="not_in_manifest", revision_hash=manifest.revision_hash)
         return PlainTextResponse("File not found", status_code=404)
+    annotate(revision_hash=manifest.revision_hash, blob=blob_hash)
+
+    response_headers = {
+        # Note: not always the right content type but we have to return
+        # something (client expects it), and this seems to work so far.
+        "Content-Type": "application/octet-stream",
+        # This isn't the request revision (could be eg "main") but the actual
+        # resolved commit hash from the manifest.
+        "X-Repo-Commit": manifest.revision_hash,
+        # Not strictly necessary but otherwise the download progress
+        # shows filenames differently than when not using the proxy.
+        "Content-Disposition": f'inline; filename="{repository_revision_path.path}";',
+    }
+
+    # Content-addressed, so the hash is a strong validator. Prefer the same
+    # ETag upstream would return, so clients can reuse their existing HF cache.
+    etag = f'"{blob_hash}"'
+    file_metadata = manifest.file_metadata.get(repository_revision_path.path)
+    upstream_etag = file_metadata.etag() if file_metadata is not None else None
+    if file_metadata is not None and upstream_etag is not None:
+        etag = f'"{upstream_etag}"'
+        # The client prefers these over ETag and Content-Length (upstream
+        # sets them on LFS redirects).
+        response_headers["X-Linked-Etag"] = etag
+        response_headers["X-Linked-Size"] = str(file_metadata.size)
+
+    def on_complete(sent_bytes: int):
+        metrics.cache_total_bytes_inc(repository_revision_path, sent_bytes)
+
+    # Small files can also be read from the pack of the revision.
+    pack = manifest.pack if settings.local_packs else None
+    if pack is not None and blob_hash not in pack.entries:
+        pack = None
 
     blob_file_path = blob_path(settings.local_directory, blob_hash)
+    if is_head:
+        # Clients send a HEAD for every file before downloading it. Answer
+        # without reading the blob: the size is in the manifest, or for
+        # older manifests without file metadata in the chunk list, the pack
+        # or a stat of the blob.
+        if file_metadata is not None:
+            size = file_metadata.size
+            annotate(resolution="manifest")
+        elif blob_hash in manifest.chunked_blobs:
+            chunk_list = await load_chunk_list(blob_hash)
+            size = sum(chunk.size for chunk in chunk_list.chunks)
+            annotate(resolution="chunks")
+        elif pack is not None:
+            size = pack.entries[blob_hash].size
+            annotate(resolution="pack")
+        else:
+            size = os.stat(blob_file_path).st_size
+            annotate(resolution="local_storage")
+        return BlobResponse(
+            FileBlobSource(blob_file_path, size),
+            headers=response_headers,
+            chunk_size=settings.local_chunk_size,
+            etag=etag,
+        )
+
+    if blob_hash in manifest.chunked_blobs:
+        # Not in the blob store, only its chunks. A missing chunk list falls
+        # back to upstream, chunks are stored before it.
+        chunk_list = await load_chunk_list(blob_hash)
+        annotate(resolution="chunks")
+        metrics.chunked_hit_inc(repository_revision_path)
+        return BlobResponse(
+            ChunkedBlobSource(
+                [chunk.size for chunk in chunk_list.chunks],
+                lambda index: chunk_source(chunk_list.chunks[index]),
+            ),
+            headers=response_headers,
+            chunk_size=settings.local_chunk_size,
+            etag=etag,
+            on_complete=on_complete,
+        )
+
+    if small_file_cache is not None and (
+        file_metadata is None or small_file_cache.should_cache(file_metadata.size)
+    ):
+        data = small_file_cache.get(blob_hash)
+        resolution = "small_file_cache"
+        if data is not None:
+            metrics.small_file_cache_hit_inc(repository_revision_path)
+        else:
+            metrics.small_file_cache_miss_inc(repository_revision_path)
+            if pack is not None:
+                data = await anyio.to_thread.run_sync(
+                    read_pack, small_file_cache, blob_hash, pack
+                )
+                if data is not None:
+                    metrics.pack_hit_inc(repository_revision_path)
+                    resolution = "pack"
+            if data is None:
+                data = await anyio.to_thread.run_sync(
+                    read_small_blob, small_file_cache, blob_hash, blob_file_path
+                )
+                resolution = "local_storage"
+        if data is not None:
+            annotate(resolution=resolution)
+            return BlobResponse(
+                MemoryBlobSource(data),
+                headers=response_headers,
+                chunk_size=settings.local_chunk_size,
+                etag=etag,
+                on_complete=on_complete,
+            )
+
+    if blob_cache is not None:
+        cached_stat = blob_cache.lookup(blob_hash)
+        if cached_stat is not None:
+            annotate(resolution="blob_cache")
+            metrics.blob_cache_hit_inc(repository_revision_path)
+
+            def on_complete_cached(sent_bytes: int):
+                metrics.blob_cache_total_bytes_inc(repository_revision_path, sent_bytes)
+                on_complete(sent_bytes)
+
+            return BlobResponse(
+                FileBlobSource(blob_cache.path(blob_hash), cached_stat.st_size),
+                headers=response_headers,
+                chunk_size=settings.local_chunk_size,
+                etag=etag,
+                on_complete=on_complete_cached,
+                sendfile=settings.local_sendfile,
+            )
+        metrics.blob_cache_miss_inc(repository_revision_path)
+
+    if pack is not None:
+        # Opened here, a missing pack falls back to the blob. No separate
+        # existence check, every stat is a round trip on FUSE storage.
+        pack_file_path = blob_path(settings.local_directory, pack.blob_hash)
+        try:
+            pack_file = await anyio.open_file(pack_file_path, "rb")
+        except FileNotFoundError:
+            logging.warning(f"Pack {pack.blob_hash} not found, reading blob instead")
+        else:
+            entry = pack.entries[blob_hash]
+            annotate(resolution="pack")
+            metrics.pack_hit_inc(repository_revision_path)
+            return BlobResponse(
+                FileBlobSource(pack_file_path, entry.size, entry.offset, pack_file),
+                headers=response_headers,
+                chunk_size=settings.local_chunk_size,
+                etag=etag,
+                on_complete=on_complete,
+            )
+
+    # Stat even if the manifest has the size, so that a missing blob falls
+    # back to upstream instead of failing mid-response.
     blob_size = os.path.getsize(blob_file_path)
-    logging.info(
-        f"Serving {repository_revision_path} from local storage {blob_hash}: {blob_size} bytes"
-    )
-    metrics.cache_total_bytes_inc(repository_revision_path, blob_size)
-    return FileResponse(
-        blob_file_path,
-        headers={
-            # Note: not always the right content type but we have to return
-            # something (client expects it), and this seems to work so far.
-            "Content-Type": "application/octet-stream",
-            # This isn't the request revision (could be eg "main") but the actual
-            # resolved commit hash from the manifest.
-            "X-Repo-Commit": manifest.revision_hash,
-            # Not strictly necessary but otherwise the download progress
-            # shows filenames differently than when not using the proxy.
-            "Content-Disposition": f'inline; filename="{repository_revision_path.path}";',
-        },
+    annotate(resolution="local_storage")
+    source = (
+        ReadThroughBlobSource(blob_cache, blob_hash, blob_file_path, blob_size)
+        if blob_cache is not None
+        else FileBlobSource(blob_file_path, blob_size)
+    )
+    return BlobResponse(
+        source,
+        headers=response_headers,
+        chunk_size=settings.local_chunk_size,
+        etag=etag,
+        on_complete=on_complete,
+        sendfile=settings.local_sendfile,
     )
 
 
-async def proxy_request_upstream(
-    repository_revision_path: RepositoryRevisionPath,
+def model_info_siblings(manifest: FullManifest, include_blobs: bool) -> List[dict]:
+    # Same format as upstream, file metadata only if requested (blobs=true)
+    # and recorded in the manifest.
+    siblings = []
+    for path in sorted(manifest.files):
+        sibling: dict = {"rfilename": path}
+        file_metadata = manifest.file_metadata.get(path)
+        if include_blobs and file_metadata is not None:
+            sibling["size"] = file_metadata.size
+            if file_metadata.blob_id is not None:
+                sibling["blobId"] = file_metadata.blob_id
+            if (
+                file_metadata.lfs_sha256 is not None
+                and file_metadata.lfs_pointer_size is not None
+            ):
+                sibling["lfs"] = {
+                    "size": file_metadata.size,
+                    "sha256": file_metadata.lfs_sha256,
+                    "pointerSize": file_metadata.lfs_pointer_size,
+                }
+        siblings.append(sibling)
+    return siblings
+
+
+async def try_serve_model_info_locally(
+    repository_revision: RepositoryRevision,
+    include_blobs: bool,
+) -> Optional[Response]:
+    # Clients (eg. snapshot_download) list the repository files before
+    # downloading them. Answer from the manifest, with the subset of the
+    # upstream model info they need.
+    manifest = manifest_cache.load_full_manifest(repository_revision)
+    if not manifest:
+        return None
+    return JSONResponse(
+        {
+            "id": repository_revision.repository,
+            "modelId": repository_revision.repository,
+            "sha": manifest.revision_hash,
+            "siblings": model_info_siblings(manifest, include_blobs),
+        }
+    )
+
+
+async def proxy_model_info_upstream(
+    session: aiohttp.ClientSession,
     upstream_path: str,
-    is_head: bool,
     request_headers: List[Tuple[str, str]],
 ) -> Response:
-    session = aiohttp.ClientSession()
-    response = await session.request(
-        "HEAD" if is_head else "GET",
-        upstream_path,
-        headers=filtered_headers(request_headers, REQUEST_HEADERS_TO_FORWARD),
-        allow_redirects=True,
-    )
+    forwarded_headers = filtered_headers(request_headers, REQUEST_HEADERS_TO_FORWARD)
+    async with session.get(upstream_path, headers=forwarded_headers) as response:
+        body = await response.read()
+        annotate(upstream_status=response.status)
+        if response.status != 200:
+            logging.warning(
+                f"Unexpected upstream error: {response.status} for {upstream_path}"
+            )
+        # The body is already decoded, so don't forward the upstream
+        # Content-Length and Content-Encoding.
+        return Response(
+            body, status_code=response.status, media_type=response.content_type
+        )
 
+
+def upstream_response_headers(
+    response: aiohttp.ClientResponse,
+) -> List[Tuple[str, str]]:
     # Large model files are stored on CDN and HF Hub will serve a redirect for them,
     # but the CDN response is missing important headers the client expects. Combine
     # all the seen headers (in reverse order, latest value wins).
@@ -117,24 +491,148 @@ async def proxy_request_upstream(
     for redirect in response.history[::-1]:
         combined_response_headers.update(redirect.headers)
     combined_response_headers.update(response.headers)
+    return filtered_headers(
+        combined_response_headers.items(), RESPONSE_HEADERS_TO_FORWARD
+    )
+
+
+def upstream_error_response(
+    repository_revision_path: RepositoryRevisionPath,
+    upstream_path: str,
+    status: int,
+    response_headers: dict[str, str],
+) -> Response:
+    if status == 404:
+        not_found_cache.add(repository_revision_path, upstream_path)
+    else:
+        logging.warning(f"Unexpected upstream error: {status} for {upstream_path}")
+    metrics.fallback_upstream_error_inc(repository_revision_path, status)
+    # The upstream body isn't forwarded, so neither is its Content-Length.
+    headers = {
+        name: value
+        for name, value in response_headers.items()
+        if name.lower() != "content-length"
+    }
+    return PlainTextResponse("", status_code=status, headers=headers)
+
+
+async def proxy_request_coalesced(
+    session: aiohttp.ClientSession,
+    single_flight: SingleFlight,
+    repository_revision_path: RepositoryRevisionPath,
+    upstream_path: str,
+    forwarded_headers: List[Tuple[str, str]],
+) -> Response:
+    async def fetch():
+        response = await session.get(
+            upstream_path, headers=forwarded_headers, allow_redirects=True
+        )
+        response_headers = upstream_response_headers(response)
+        if response.status not in (200, 206):
+            response.release()
+            return response.status, response_headers, empty_body()
+        return (
+            response.status,
+            response_headers,
+            upstream_download_body(
+                session, repository_revision_path, response, dict(response_headers)
+            ),
+        )
+
+    subscription, leader = await single_flight.join(upstream_path, fetch)
+    if leader is not None:
+        annotate(coalesced_leader=leader)
+        metrics.fallback_coalesced_inc(repository_revision_path, leader)
 
-    response_headers = dict(
-        filtered_headers(combined_response_headers.items(), RESPONSE_HEADERS_TO_FORWARD)
+    response_headers = dict(subscription.headers)
+    annotate(
+        resolution="upstream",
+        upstream_status=subscription.status,
+        revision_hash=upstream_commit(response_headers),
+    )
+    if subscription.status not in (200, 206):
+        subscription.close()
+        return upstream_error_response(
+            repository_revision_path,
+            upstream_path,
+            subscription.status,
+            response_headers,
+        )
+    return StreamingResponse(
+        stream_response(repository_revision_path, subscription.body()),
+        status_code=subscription.status,
+        headers=response_headers,
     )
 
-    if response.status != 200:
-        if response.status != 404:
-            logging.warning(
-                f"Unexpected upstream error: {response.status} for {upstream_path}"
-            )
-        await session.close()
-        metrics.fallback_upstream_error_inc(repository_revision_path, response.status)
-        return PlainTextResponse(
-            "", status_code=response.status, headers=response_headers
+
+async def empty_body() -> AsyncIterator[bytes]:
+    return
+    yield
+
+
+async def proxy_request_upstream(
+    session: aiohttp.ClientSession,
+    repository_revision_path: RepositoryRevisionPath,
+    upstream_path: str,
+    is_head: bool,
+    request_headers: List[Tuple[str, str]],
+) -> Response:
+    if not_found_cache.contains(upstream_path):
+        annotate(resolution="not_found_cache")
+        metrics.fallback_not_found_cache_hit_inc(repository_revision_path)
+        return PlainTextResponse("", status_code=404)
+
+    forwarded_headers = filtered_headers(request_headers, REQUEST_HEADERS_TO_FORWARD)
+
+    # Only whole-file downloads are coalesced, HEAD requests are cheap and
+    # ranges are unlikely to line up between clients.
+    if single_flight is not None and not is_head:
+        if not any(name.lower() == "range" for name, _ in forwarded_headers):
+            try:
+                return await proxy_request_coalesced(
+                    session,
+                    single_flight,
+                    repository_revision_path,
+                    upstream_path,
+                    forwarded_headers,
+                )
+            except FlightTooLarge:
+                # Another client streams it directly, so do we.
+                pass
+            except FlightError:
+                # Fall back to a direct request, which also retries upstream.
+                logging.warning(
+                    f"Coalesced upstream fetch failed for {upstream_path}",
+                    exc_info=True,
+                )
+
+    response = await session.request(
+        "HEAD" if is_head else "GET",
+        upstream_path,
+        headers=forwarded_headers,
+        allow_redirects=True,
+    )
+    response_headers = dict(upstream_response_headers(response))
+    annotate(
+        resolution="upstream",
+        upstream_status=response.status,
+        revision_hash=upstream_commit(response_headers),
+    )
+
+    # 206 is the successful response to a forwarded Range request.
+    if response.status not in (200, 206):
+        response.release()
+        return upstream_error_response(
+            repository_revision_path, upstream_path, response.status, response_headers
         )
 
     return StreamingResponse(
-        stream_response(repository_revision_path, session, response),
-        # status_code=200,
+        stream_response(
+            repository_revision_path,
+            upstream_download_body(
+                session, repository_revision_path, response, response_headers
+            ),
+        ),
+        status_code=response.status,
         headers=response_headers,
     )
@@ -0,0 +1,57 @@
+import anyio
+
+from mirrorface.common.hub import RepositoryRevision
+from mirrorface.common.storage import FileMetadata, FullManifest
+from mirrorface.server import handlers
+from mirrorface.server.handlers import (
+    model_info_siblings,
+    try_serve_model_info_locally,
+)
+from mirrorface.server.manifest_cache import ManifestCache
+
+MANIFEST = FullManifest(
+    revision_hash="0123456789abcdef0123456789abcdef01234567",
+    files={"model.bin": "hash_model", "config.json": "hash_config", "old": "hash_old"},
+    file_metadata={
+        "model.bin": FileMetadata(
+            size=5000, blob_id="1" * 40, lfs_sha256="2" * 64, lfs_pointer_size=134
+        ),
+        "config.json": FileMetadata(size=20, blob_id="3" * 40),
+    },
+)
+
+
+def test_model_info_siblings():
+    assert model_info_siblings(MANIFEST, include_blobs=False) == [
+        {"rfilename": "config.json"},
+        {"rfilename": "model.bin"},
+        {"rfilename": "old"},
+    ]
+    assert model_info_siblings(MANIFEST, include_blobs=True) == [
+        {"rfilename": "config.json", "size": 20, "blobId": "3" * 40},
+        {
+            "rfilename": "model.bin",
+            "size": 5000,
+            "blobId": "1" * 40,
+            "lfs": {"size": 5000, "sha256": "2" * 64, "pointerSize": 134},
+        },
+        # Mirrored before file metadata was recorded.
+        {"rfilename": "old"},
+    ]
+
+
+def test_model_info_without_manifest(tmp_path, monkeypatch):
+    # Not mirrored, the caller falls back to upstream.
+    monkeypatch.setattr(
+        handlers,
+        "manifest_cache",
+        ManifestCache(
+            str(tmp_path), max_entries=10, full_ttl=0, redirect_ttl=0, missing_ttl=0
+        ),
+    )
+    response = anyio.run(
+        try_serve_model_info_locally,
+        RepositoryRevision(repository="user/repo", revision="main"),
+        True,
+    )
+    assert response is None
@@ -1,24 +1,66 @@
+import asyncio
 import contextlib
+import hmac
 import logging
 import urllib.parse
 
 from starlette.applications import Starlette
-from starlette.responses import PlainTextResponse
+from starlette.middleware import Middleware
+from starlette.responses import JSONResponse, PlainTextResponse
 
-from mirrorface.common.hub import RepositoryRevisionPath
+from mirrorface.common.hub import RepositoryRevision, RepositoryRevisionPath
 from mirrorface.server import metrics
-from mirrorface.server.handlers import proxy_request_upstream, try_serve_locally
+from mirrorface.server.access_log import AccessLog, BackgroundLogging, annotate
+from mirrorface.server.handlers import (
+    prewarmer,
+    proxy_model_info_upstream,
+    proxy_request_upstream,
+    try_serve_locally,
+    try_serve_model_info_locally,
+)
 from mirrorface.server.settings import settings
+from mirrorface.server.timing import ResponseTimingMiddleware
+from mirrorface.server.upstream import create_upstream_session
+
+access_log = (
+    AccessLog(settings.access_log_not_found_sample_rate)
+    if settings.access_log
+    else None
+)
 
 
 @contextlib.asynccontextmanager
 async def lifespan(app):
     logging.getLogger().setLevel(logging.INFO)
-    # TODO: Structured logs?
-    yield
-
-
-app = Starlette(debug=True, lifespan=lifespan)
+    background_logging = BackgroundLogging()
+    if access_log is not None:
+        access_log.start()
+    metrics.configure(
+        max_repositories=settings.metrics_max_repositories,
+        repository_min_requests=settings.metrics_repository_min_requests,
+    )
+    flush_task = asyncio.create_task(
+        metrics.flush_periodically(settings.metrics_flush_interval_seconds)
+    )
+    try:
+        async with create_upstream_session(settings) as upstream_session:
+            # Available to handlers as request.state.upstream_session.
+            yield {"upstream_session": upstream_session}
+    finally:
+        flush_task.cancel()
+        metrics.flush()
+        if access_log is not None:
+            access_log.stop()
+        background_logging.stop()
+
+
+app = Starlette(
+    debug=True,
+    lifespan=lifespan,
+    middleware=[
+        Middleware(ResponseTimingMiddleware, access_log=access_log),
+    ],
+)
 
 
 @app.route("/health")
@@ -29,10 +71,8 @@ async def health(request):
 @app.route("/mirror/{path:path}")
 async def mirror(request):
     path = request.path_params.get("path")
-    if path.startswith("/api/models/"):
-        # TODO: The client requests this path, works without it but we should
-        # figure out what that is used for and whether we need to support it.
-        return PlainTextResponse("Not implemented", status_code=404)
+    if path.startswith("api/models/"):
+        return await model_info(request, path)
     repository_revision_path = RepositoryRevisionPath.from_url_path(path)
 
     if repository_revision_path is None:
@@ -43,18 +83,26 @@ async def mirror(request):
         return PlainTextResponse("Unsupported method", status_code=405)
 
     metrics.total_requests_inc(repository_revision_path)
-    logging.info(f"Request: {request.method} {path} -> {repository_revision_path}")
+    annotate(
+        repository=repository_revision_path.repository_revision.repository,
+        revision=repository_revision_path.repository_revision.revision,
+        file=repository_revision_path.path,
+    )
 
     # First try to serve locally.
     try:
-        response = await try_serve_locally(repository_revision_path)
+        response = await try_serve_locally(
+            repository_revision_path, is_head=request.method == "HEAD"
+        )
         if response is not None:
             metrics.cache_hit_inc(repository_revision_path)
+            annotate(source="local", cache="hit")
             return response
         metrics.cache_miss_inc(repository_revision_path)
-        logging.info(f"Cache miss for {repository_revision_path}")
+        annotate(cache="miss")
     except Exception:
         logging.error("Error serving locally", exc_info=True)
+        annotate(cache="error")
         # Don't return error to client / raise, continue with the fallback so
         # we have strictly higher availability than just using upstream.
 
@@ -64,11 +112,87 @@ async def mirror(request):
 
     upstream_path = urllib.parse.urljoin(settings.upstream_url, path)
     metrics.fallback_requests_inc(repository_revision_path)
-    logging.info(f"Fallback to upstream: {upstream_path}")
+    annotate(source="upstream")
 
     return await proxy_request_upstream(
+        request.state.upstream_session,
         repository_revision_path,
         upstream_path,
         is_head=request.method == "HEAD",
         request_headers=request.headers.items(),
     )
+
+
+async def model_info(request, path: str):
+    # Model info API, used by clients to list the repository files.
+    repository_revision = RepositoryRevision.from_api_path(path)
+    if repository_revision is None or request.method != "GET":
+        # Other API endpoints, not supported.
+        return PlainTextResponse("Not implemented", status_code=404)
+    annotate(
+        repository=repository_revision.repository,
+        revision=repository_revision.revision,
+    )
+
+    try:
+        response = await try_serve_model_info_locally(
+            repository_revision,
+            include_blobs=request.query_params.get("blobs", "").lower() == "true",
+        )
+        if response is not None:
+            metrics.api_model_info_request_inc(repository_revision, "local")
+            annotate(resolution="manifest")
+            return response
+    except Exception:
+        logging.error("Error serving model info locally", exc_info=True)
+
+    # The revision was decoded from the path, encode it again.
+    upstream_path = urllib.parse.urljoin(
+        settings.upstream_url,
+        f"api/models/{repository_revision.repository}/revision/{urllib.parse.quote(repository_revision.revision, safe='')}",
+    )
+    if request.url.query:
+        upstream_path += f"?{request.url.query}"
+    metrics.api_model_info_request_inc(repository_revision, "upstream")
+    annotate(resolution="upstream")
+    return await proxy_model_info_upstream(
+        request.state.upstream_session,
+        upstream_path,
+        request_headers=request.headers.items(),
+    )
+
+
+@app.route("/admin/prewarm", methods=["GET", "POST", "DELETE"])
+async def prewarm(request):
+    # Reads all blobs of a mirrored revision ahead of a rollout, see prewarm.py.
+    #   POST ?repository=user/repo&revision=main starts (or returns) the job,
+    #   GET with the same parameters returns its status (all jobs without),
+    #   DELETE cancels it.
+    if settings.admin_token is not None and not hmac.compare_digest(
+        request.headers.get("authorization", ""), f"Bearer {settings.admin_token}"
+    ):
+        return PlainTextResponse("Unauthorized", status_code=401)
+
+    repository = request.query_params.get("repository")
+    if repository is None:
+        if request.method != "GET":
+            return PlainTextResponse("Missing repository", status_code=400)
+        return JSONResponse([s.model_dump() for s in prewarmer.statuses()])
+    repository_revision = RepositoryRevision(
+        repository=repository,
+        revision=request.query_params.get("revision", "main"),
+    )
+    logging.info(f"Prewarm: {request.method} {repository_revision}")
+
+    if request.method == "POST":
+        status = await prewarmer.start(repository_revision)
+        if status is None:
+            return PlainTextResponse("Revision not mirrored", status_code=404)
+        return JSONResponse(status.model_dump(), status_code=202)
+    if request.method == "DELETE":
+        status = await prewarmer.cancel(repository_revision)
+    else:
+        status = await prewarmer.find(repository_revision)
+    if status is None:
+        return PlainTextResponse("No prewarm job for the revision", status_code=404)
+    return JSONResponse(status.model_dump())
@@ -0,0 +1,291 @@
+import asyncio
+import contextlib
+import json
+import os
+from typing import AsyncIterator, Optional
+
+import aiohttp
+import anyio
+
+from mirrorface.common.hub import RepositoryRevision
+from mirrorface.common.storage import (
+    FileMetadata,
+    blob_path,
+    local_file_metadata,
+    write_local_manifests,
+    write_pack,
+)
+from mirrorface.server import handlers
+from mirrorface.server.main import app
+from mirrorface.server.manifest_cache import ManifestCache
+from mirrorface.server.settings import settings
+from mirrorface.server.singleflight import SingleFlight
+from mirrorface.server.small_file_cache import SmallFileCache
+from mirrorface.server.upstream import create_upstream_session
+from mirrorface.tools.fake_hub import FakeHub, Shaping, synthetic_repository
+
+REPOSITORY = "fake/model"
+
+
+async def call(
+    method: str,
+    path: str,
+    query: str = "",
+    session: Optional[aiohttp.ClientSession] = None,
+) -> tuple[int, dict[str, str], bytes]:
+    # Calls the app directly, like a server would with the lifespan state.
+    scope = {
+        "type": "http",
+        "asgi": {"version": "3.0"},
+        "http_version": "1.1",
+        "method": method,
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": query.encode(),
+        "headers": [],
+        "client": ("127.0.0.1", 12345),
+        "server": ("testserver", 80),
+        "state": {"upstream_session": session},
+    }
+    received = False
+    messages = []
+
+    async def receive():
+        nonlocal received
+        if not received:
+            received = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        # The client stays connected.
+        await asyncio.Event().wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    await app(scope, receive, send)
+    start = messages[0]
+    headers = {k.decode(): v.decode() for k, v in start["headers"]}
+    body = b"".join(m.get("body", b"") for m in messages[1:])
+    return start["status"], headers, body
+
+
+@contextlib.asynccontextmanager
+async def upstream(monkeypatch, hub: FakeHub) -> AsyncIterator[aiohttp.ClientSession]:
+    async with hub.serve():
+        monkeypatch.setattr(settings, "upstream_url", hub.url)
+        async with create_upstream_session(settings) as session:
+            yield session
+
+
+def use_storage(monkeypatch, storage_root: str):
+    monkeypatch.setattr(
+        handlers,
+        "manifest_cache",
+        ManifestCache(
+            storage_root, max_entries=10, full_ttl=0, redirect_ttl=0, missing_ttl=0
+        ),
+    )
+
+
+def store_local(
+    monkeypatch,
+    storage_root: str,
+    contents: dict[str, bytes],
+    pack: bool = False,
+    metadata: bool = True,
+):
+    # Mirrors user/repo at main with the files (named by their blob hash),
+    # optionally packs them. Without metadata the manifest is like the ones
+    # written before file metadata was added.
+    use_storage(monkeypatch, storage_root)
+    monkeypatch.setattr(settings, "local_directory", storage_root)
+    os.makedirs(os.path.join(storage_root, "blob"), exist_ok=True)
+    for blob_hash, data in contents.items():
+        with open(blob_path(storage_root, blob_hash), "wb") as f:
+            f.write(data)
+    files = {blob_hash: blob_hash for blob_hash in contents}
+    file_metadata = local_file_metadata(storage_root, files)
+    revision = RepositoryRevision(repository="user/repo", revision="main")
+    write_local_manifests(
+        revision,
+        revision,
+        files,
+        storage_root,
+        file_metadata if metadata else None,
+        write_pack(storage_root, files, file_metadata, max_file_bytes=1000)
+        if pack
+        else None,
+    )
+
+
+def test_model_info_local(tmp_path, monkeypatch):
+    use_storage(monkeypatch, str(tmp_path))
+    commit = "0123456789abcdef0123456789abcdef01234567"
+    write_local_manifests(
+        RepositoryRevision(repository="user/repo", revision=commit),
+        RepositoryRevision(repository="user/repo", revision="main"),
+        {"config.json": "hash_config"},
+        str(tmp_path),
+        {"config.json": FileMetadata(size=20, blob_id="3" * 40)},
+    )
+
+    status, _, body = anyio.run(
+        call, "GET", "/mirror/api/models/user/repo/revision/main", "blobs=true"
+    )
+    assert status == 200
+    assert json.loads(body) == {
+        "id": "user/repo",
+        "modelId": "user/repo",
+        "sha": commit,
+        "siblings": [{"rfilename": "config.json", "size": 20, "blobId": "3" * 40}],
+    }
+
+
+def test_model_info_upstream(tmp_path, monkeypatch):
+    # Not mirrored, proxied to upstream with the query.
+    use_storage(monkeypatch, str(tmp_path))
+    repository = synthetic_repository(REPOSITORY, large_file_bytes=1000)
+    hub = FakeHub([repository])
+
+    async def run():
+        async with upstream(monkeypatch, hub) as session:
+            return await call(
+                "GET", f"/mirror/api/models/{REPOSITORY}", "blobs=true", session
+            )
+
+    status, _, body = anyio.run(run)
+    assert status == 200
+    info = json.loads(body)
+    assert info["sha"] == repository.revision_hash
+    assert len(info["siblings"]) == len(repository.files)
+    assert all("size" in sibling for sibling in info["siblings"])
+    assert hub.requests == [
+        ("GET", f"/api/models/{REPOSITORY}/revision/main?blobs=true")
+    ]
+
+
+def test_model_info_unsupported(tmp_path, monkeypatch):
+    use_storage(monkeypatch, str(tmp_path))
+    # Only GET and HEAD are routed.
+    status, _, _ = anyio.run(call, "POST", "/mirror/api/models/user/repo")
+    assert status == 405
+    for method, path in [
+        ("HEAD", "/mirror/api/models/user/repo/revision/main"),
+        # Other API endpoints.
+        ("GET", "/mirror/api/models/user/repo/tree/main"),
+        ("GET", "/mirror/api/models/user"),
+    ]:
+        status, _, _ = anyio.run(call, method, path)
+        assert status == 404, (method, path)
+
+
+def test_fallback_lfs_file(tmp_path, monkeypatch):
+    # LFS files are redirected to the CDN, the response combines the headers
+    # of the redirect and of the CDN.
+    use_storage(monkeypatch, str(tmp_path))
+    monkeypatch.setattr(handlers, "single_flight", None)
+    repository = synthetic_repository(REPOSITORY, large_file_bytes=100_000)
+    model = repository.files["model-0.safetensors"]
+    hub = FakeHub([repository])
+
+    async def run():
+        async with upstream(monkeypatch, hub) as session:
+            return await call(
+                "GET",
+                f"/mirror/{REPOSITORY}/resolve/main/model-0.safetensors",
+                session=session,
+            )
+
+    status, headers, body = anyio.run(run)
+    assert status == 200
+    assert body == model.content
+    assert headers["content-length"] == "100000"
+    assert headers["x-repo-commit"] == repository.revision_hash
+    assert headers["x-linked-etag"] == f'"{model.lfs_sha256}"'
+    assert headers["x-linked-size"] == "100000"
+    assert [path for _, path in hub.requests] == [
+        f"/{REPOSITORY}/resolve/main/model-0.safetensors",
+        f"/lfs/{model.lfs_sha256}",
+    ]
+
+
+def test_fallback_coalesced(tmp_path, monkeypatch):
+    # Concurrent downloads of the same file make one upstream request.
+    use_storage(monkeypatch, str(tmp_path / "storage"))
+    monkeypatch.setattr(
+        handlers,
+        "single_flight",
+        SingleFlight(str(tmp_path / "spool"), chunk_size=16 * 1024, linger=0),
+    )
+    repository = synthetic_repository(REPOSITORY, large_file_bytes=100_000)
+    model = repository.files["model-0.safetensors"]
+    # Slow enough that all requests arrive while the first one is running.
+    hub = FakeHub([repository], Shaping(latency_seconds=0.1))
+
+    async def run():
+        async with upstream(monkeypatch, hub) as session:
+            return await asyncio.gather(
+                *[
+                    call(
+                        "GET",
+                        f"/mirror/{REPOSITORY}/resolve/main/model-0.safetensors",
+                        session=session,
+                    )
+                    for _ in range(5)
+                ]
+            )
+
+    for status, headers, body in anyio.run(run):
+        assert status == 200
+        assert body == model.content
+        assert headers["x-linked-etag"] == f'"{model.lfs_sha256}"'
+    assert hub.requests.count(("GET", f"/lfs/{model.lfs_sha256}")) == 1
+    assert len(hub.requests) == 2
+
+
+def test_local_pack(tmp_path, monkeypatch):
+    contents = {"hash_a": b"first file", "hash_b": b"second file"}
+    store_local(monkeypatch, str(tmp_path), contents, pack=True)
+    for blob_hash in contents:
+        os.remove(blob_path(str(tmp_path), blob_hash))
+
+    status, _, body = anyio.run(call, "GET", "/mirror/user/repo/resolve/main/hash_b")
+    assert status == 200 and body == b"second file"
+
+
+def test_local_pack_missing(tmp_path, monkeypatch):
+    # Blobs are stored too, a missing pack falls back to them.
+    contents = {"hash_a": b"first file", "hash_b": b"second file"}
+    store_local(monkeypatch, str(tmp_path), contents, pack=True)
+    manifest = handlers.manifest_cache.load_full_manifest(
+        RepositoryRevision(repository="user/repo", revision="main")
+    )
+    assert manifest is not None and manifest.pack is not None
+    os.remove(blob_path(str(tmp_path), manifest.pack.blob_hash))
+
+    status, _, body = anyio.run(call, "GET", "/mirror/user/repo/resolve/main/hash_b")
+    assert status == 200 and body == b"second file"
+
+
+def test_local_head_without_metadata(tmp_path, monkeypatch):
+    # HEAD is answered from a stat, the blob isn't read into the cache.
+    store_local(
+        monkeypatch, str(tmp_path / "storage"), {"hash_a": b"a file"}, metadata=False
+    )
+    cache = SmallFileCache(
+        str(tmp_path / "small"), max_bytes=1024 * 1024, max_file_bytes=1024
+    )
+    monkeypatch.setattr(handlers, "small_file_cache", cache)
+
+    status, headers, body = anyio.run(
+        call, "HEAD", "/mirror/user/repo/resolve/main/hash_a"
+    )
+    assert status == 200 and body == b""
+    assert headers["content-length"] == "6"
+    assert cache.get("hash_a") is None
+
+    status, _, body = anyio.run(call, "GET", "/mirror/user/repo/resolve/main/hash_a")
+    assert status == 200 and body == b"a file"
+    assert cache.get("hash_a") == b"a file"
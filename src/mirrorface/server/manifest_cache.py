@@ -0,0 +1,74 @@
+# Per-worker cache of manifests read from the local directory.
+#
+# Every request needs the manifest of its repository revision, and for branch
+# revisions (eg. "main") that means reading two files (redirect + full). On the
+# FUSE mounted bucket each read is a round trip, so we cache the individual
+# manifest files and resolve redirects through the cache.
+#
+# Full manifests are keyed by commit hash and never change, redirect manifests
+# change whenever someone re-mirrors the branch, and missing manifests might
+# show up at any time. Each of those has its own TTL.
+
+import time
+from typing import Optional
+
+from mirrorface.common.cache import TTLCache
+from mirrorface.common.hub import RepositoryRevision
+from mirrorface.common.storage import (
+    AnyManifest,
+    FullManifest,
+    read_manifest,
+    resolve_full_manifest,
+)
+from mirrorface.server import metrics
+
+
+class ManifestCache:
+    def __init__(
+        self,
+        storage_root: str,
+        max_entries: int,
+        full_ttl: float,
+        redirect_ttl: float,
+        missing_ttl: float,
+    ):
+        self.storage_root = storage_root
+        self.full_ttl = full_ttl
+        self.redirect_ttl = redirect_ttl
+        self.missing_ttl = missing_ttl
+        self._cache: TTLCache[tuple[str, str], Optional[AnyManifest]] = TTLCache(
+            max_entries
+        )
+
+    def load_full_manifest(
+        self, repository_revision: RepositoryRevision
+    ) -> Optional[FullManifest]:
+        return resolve_full_manifest(repository_revision, self.read_manifest)
+
+    def read_manifest(
+        self, repository_revision: RepositoryRevision
+    ) -> Optional[AnyManifest]:
+        key = (repository_revision.repository, repository_revision.revision)
+        try:
+            manifest = self._cache[key]
+            metrics.manifest_cache_hit_inc(repository_revision)
+            return manifest
+        except KeyError:
+            pass
+
+        metrics.manifest_cache_miss_inc(repository_revision)
+        # Errors (eg. corrupted manifest) are not cached, let them propagate.
+        started_at = time.monotonic()
+        manifest = read_manifest(self.storage_root, repository_revision)
+        metrics.manifest_load_observe(time.monotonic() - started_at)
+        if manifest is None:
+            ttl = self.missing_ttl
+        elif manifest.manifest_type == "full":
+            ttl = self.full_ttl
+        else:
+            ttl = self.redirect_ttl
+        self._cache.put(key, manifest, ttl)
+        return manifest
+
+    def invalidate(self, repository_revision: RepositoryRevision):
+        self._cache.pop((repository_revision.repository, repository_revision.revision))
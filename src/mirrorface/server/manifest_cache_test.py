@@ -0,0 +1,50 @@
+import os
+
+from mirrorface.common.hub import RepositoryRevision
+from mirrorface.common.storage import (
+    FullManifest,
+    manifest_path,
+    write_local_manifests,
+)
+from mirrorface.server.manifest_cache import ManifestCache
+
+
+def make_cache(storage_root) -> ManifestCache:
+    return ManifestCache(
+        str(storage_root),
+        max_entries=100,
+        full_ttl=3600,
+        redirect_ttl=3600,
+        missing_ttl=3600,
+    )
+
+
+def test_manifest_cache_follows_redirect(tmp_path):
+    revision = RepositoryRevision(repository="user/repo", revision="hash1")
+    main = RepositoryRevision(repository="user/repo", revision="main")
+    files = {"file1": "filehash1"}
+    write_local_manifests(revision, main, files, str(tmp_path))
+
+    cache = make_cache(tmp_path)
+    expected = FullManifest(revision_hash="hash1", files=files)
+    assert cache.load_full_manifest(main) == expected
+
+    # Served from cache even after the files are gone.
+    for r in [revision, main]:
+        path = manifest_path(str(tmp_path), r)
+        assert path is not None
+        os.remove(path)
+    assert cache.load_full_manifest(main) == expected
+    assert cache.load_full_manifest(revision) == expected
+
+
+def test_manifest_cache_negative_entries(tmp_path):
+    revision = RepositoryRevision(repository="user/repo", revision="hash1")
+    cache = make_cache(tmp_path)
+    assert cache.load_full_manifest(revision) is None
+
+    # Missing manifest is cached until invalidated.
+    write_local_manifests(revision, revision, {"file1": "filehash1"}, str(tmp_path))
+    assert cache.load_full_manifest(revision) is None
+    cache.invalidate(revision)
+    assert cache.load_full_manifest(revision) is not None
@@ -1,8 +1,23 @@
-from prometheus_client import Counter
+from typing import Optional
 
-from mirrorface.common.hub import RepositoryRevisionPath
+from prometheus_client import Counter, Gauge, Histogram
+
+from mirrorface.common.hub import RepositoryRevision, RepositoryRevisionPath
+from mirrorface.server.metrics_aggregation import MetricsBuffer, RepositoryLabels
+
+# Defaults for tests and tools, the server configures them from its settings.
+DEFAULT_MAX_REPOSITORIES = 500
+DEFAULT_REPOSITORY_MIN_REQUESTS = 10
+
+buffer = MetricsBuffer()
+repository_labels = RepositoryLabels(
+    max_repositories=DEFAULT_MAX_REPOSITORIES,
+    min_requests=DEFAULT_REPOSITORY_MIN_REQUESTS,
+)
 
 # All metrics have repository label, but not revision (too high cardinality).
+# Rare repositories are counted as "other", and counter increments are
+# buffered per worker, see metrics_aggregation.py.
 
 total_requests = Counter(
     "mirrorface_total_requests",
@@ -34,52 +49,397 @@ fallback_upstream_error = Counter(
     "Fallback upstream errors per repository and status code",
     ["repository", "status_code"],
 )
+fallback_not_found_cache_hit = Counter(
+    "mirrorface_fallback_not_found_cache_hit",
+    "Fallback requests answered with a cached upstream 404 per repository",
+    ["repository"],
+)
 fallback_total_bytes = Counter(
     "mirrorface_fallback_total_bytes",
     "Total bytes proxied upstream per repository",
     ["repository"],
 )
+api_model_info_requests = Counter(
+    "mirrorface_api_model_info_requests",
+    "Model info API requests per repository and where they were answered from (local or upstream)",
+    ["repository", "source"],
+)
+manifest_cache_hit = Counter(
+    "mirrorface_manifest_cache_hit",
+    "Manifest reads served from the in-memory cache per repository",
+    ["repository"],
+)
+manifest_cache_miss = Counter(
+    "mirrorface_manifest_cache_miss",
+    "Manifest reads that went to local storage per repository",
+    ["repository"],
+)
+blob_cache_hit = Counter(
+    "mirrorface_blob_cache_hit",
+    "Local hits served from the local disk blob cache per repository",
+    ["repository"],
+)
+blob_cache_miss = Counter(
+    "mirrorface_blob_cache_miss",
+    "Local hits not in the local disk blob cache per repository",
+    ["repository"],
+)
+blob_cache_total_bytes = Counter(
+    "mirrorface_blob_cache_total_bytes",
+    "Total bytes served from the local disk blob cache per repository",
+    ["repository"],
+)
+# Blobs are content-addressed and shared between repositories, so the
+# following blob cache metrics have no repository label.
+blob_cache_populated_bytes = Counter(
+    "mirrorface_blob_cache_populated_bytes",
+    "Total bytes copied into the local disk blob cache",
+)
+blob_cache_evictions = Counter(
+    "mirrorface_blob_cache_evictions",
+    "Number of blobs evicted from the local disk blob cache",
+)
+blob_cache_evicted_bytes = Counter(
+    "mirrorface_blob_cache_evicted_bytes",
+    "Total bytes evicted from the local disk blob cache",
+)
+# The cache directory is shared by all workers, latest measurement wins.
+blob_cache_occupancy_bytes = Gauge(
+    "mirrorface_blob_cache_occupancy_bytes",
+    "Bytes currently stored in the local disk blob cache",
+    multiprocess_mode="livemostrecent",
+)
+small_file_cache_hit = Counter(
+    "mirrorface_small_file_cache_hit",
+    "Local hits served from the shared memory small file cache per repository",
+    ["repository"],
+)
+small_file_cache_miss = Counter(
+    "mirrorface_small_file_cache_miss",
+    "Local hits not in the shared memory small file cache per repository",
+    ["repository"],
+)
+small_file_cache_populated_bytes = Counter(
+    "mirrorface_small_file_cache_populated_bytes",
+    "Total bytes copied into the shared memory small file cache",
+)
+small_file_cache_evictions = Counter(
+    "mirrorface_small_file_cache_evictions",
+    "Number of blobs evicted from the shared memory small file cache",
+)
+small_file_cache_evicted_bytes = Counter(
+    "mirrorface_small_file_cache_evicted_bytes",
+    "Total bytes evicted from the shared memory small file cache",
+)
+small_file_cache_occupancy_bytes = Gauge(
+    "mirrorface_small_file_cache_occupancy_bytes",
+    "Bytes currently stored in the shared memory small file cache",
+    multiprocess_mode="livemostrecent",
+)
+pack_hit = Counter(
+    "mirrorface_pack_hit",
+    "Local hits served from the pack of the revision per repository",
+    ["repository"],
+)
+chunked_hit = Counter(
+    "mirrorface_chunked_hit",
+    "Local hits of files stored as chunks per repository",
+    ["repository"],
+)
+fallback_coalesced = Counter(
+    "mirrorface_fallback_coalesced",
+    "Fallback requests that joined an upstream fetch already in flight, per repository and where the fetch runs (worker or remote)",
+    ["repository", "leader"],
+)
+write_through_blobs = Counter(
+    "mirrorface_write_through_blobs",
+    "Files from upstream fallbacks stored as blobs per repository",
+    ["repository"],
+)
+write_through_bytes = Counter(
+    "mirrorface_write_through_bytes",
+    "Total bytes from upstream fallbacks stored as blobs per repository",
+    ["repository"],
+)
+write_through_manifests = Counter(
+    "mirrorface_write_through_manifests",
+    "Manifests written once all files of a revision were stored, per repository",
+    ["repository"],
+)
+prewarm_bytes = Counter(
+    "mirrorface_prewarm_bytes",
+    "Total bytes read to prewarm mirrored revisions per repository",
+    ["repository"],
+)
+# Upstream connection pool, shared by all repositories.
+upstream_connections_created = Counter(
+    "mirrorface_upstream_connections_created",
+    "New connections opened to upstream",
+)
+upstream_connections_reused = Counter(
+    "mirrorface_upstream_connections_reused",
+    "Upstream requests that reused a pooled keep-alive connection",
+)
+upstream_pool_wait_seconds = Histogram(
+    "mirrorface_upstream_pool_wait_seconds",
+    "Time upstream requests waited for a free connection when the pool was full",
+    buckets=[0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30],
+)
+
+# Latency of file responses by where they were served from (local, upstream
+# or not_found) and method, see timing.py. No repository label, histograms
+# have a series per bucket.
+time_to_first_byte_seconds = Histogram(
+    "mirrorface_time_to_first_byte_seconds",
+    "Time from the request to the first byte of the response body (end of the response if empty), including upstream redirect hops",
+    ["source", "method"],
+    buckets=[
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1,
+        2.5,
+        5,
+        10,
+        30,
+    ],
+)
+transfer_seconds = Histogram(
+    "mirrorface_transfer_seconds",
+    "Time from the request until the whole response was sent",
+    ["source", "method"],
+    buckets=[0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600],
+)
+transfer_bytes_per_second = Histogram(
+    "mirrorface_transfer_bytes_per_second",
+    "Effective throughput of responses with large bodies (body bytes over the transfer time)",
+    ["source", "method"],
+    buckets=[1e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 2.5e8, 5e8, 1e9, 2.5e9, 5e9],
+)
+# Separate series per worker, to spot one stuck on slow streams.
+in_flight_streams = Gauge(
+    "mirrorface_in_flight_streams",
+    "File responses currently being sent by the worker",
+    ["source"],
+    multiprocess_mode="liveall",
+)
+manifest_load_seconds = Histogram(
+    "mirrorface_manifest_load_seconds",
+    "Time to read a manifest from local storage (in-memory cache misses)",
+    buckets=[0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5],
+)
+
+
+def configure(max_repositories: int, repository_min_requests: int):
+    repository_labels.max_repositories = max_repositories
+    repository_labels.min_requests = repository_min_requests
+
+
+def flush():
+    buffer.flush()
+
+
+async def flush_periodically(interval: float):
+    await buffer.flush_periodically(interval)
+
+
+def repository_label(repository: str) -> str:
+    return repository_labels.label(repository)
 
 
 def get_repo(repository_revision_path: RepositoryRevisionPath):
-    return repository_revision_path.repository_revision.repository
+    return repository_label(repository_revision_path.repository_revision.repository)
 
 
 def total_requests_inc(repository_revision_path: RepositoryRevisionPath):
-    total_requests.labels(repository=get_repo(repository_revision_path)).inc()
+    repository_labels.record_request(
+        repository_revision_path.repository_revision.repository
+    )
+    buffer.inc(total_requests, get_repo(repository_revision_path))
 
 
 def cache_hit_inc(repository_revision_path: RepositoryRevisionPath):
-    cache_hit.labels(repository=get_repo(repository_revision_path)).inc()
+    buffer.inc(cache_hit, get_repo(repository_revision_path))
 
 
 def cache_miss_inc(repository_revision_path: RepositoryRevisionPath):
-    cache_miss.labels(repository=get_repo(repository_revision_path)).inc()
+    buffer.inc(cache_miss, get_repo(repository_revision_path))
 
 
 def cache_total_bytes_inc(
     repository_revision_path: RepositoryRevisionPath, total_size: int
 ):
-    cache_total_bytes.labels(repository=get_repo(repository_revision_path)).inc(
-        total_size
-    )
+    buffer.inc(cache_total_bytes, get_repo(repository_revision_path), amount=total_size)
 
 
 def fallback_requests_inc(repository_revision_path: RepositoryRevisionPath):
-    fallback_requests.labels(repository=get_repo(repository_revision_path)).inc()
+    buffer.inc(fallback_requests, get_repo(repository_revision_path))
 
 
 def fallback_upstream_error_inc(
     repository_revision_path: RepositoryRevisionPath, status_code: int
 ):
-    fallback_upstream_error.labels(
-        repository=get_repo(repository_revision_path), status_code=status_code
-    ).inc()
+    buffer.inc(
+        fallback_upstream_error, get_repo(repository_revision_path), str(status_code)
+    )
+
+
+def fallback_not_found_cache_hit_inc(repository_revision_path: RepositoryRevisionPath):
+    buffer.inc(fallback_not_found_cache_hit, get_repo(repository_revision_path))
 
 
 def fallback_total_bytes_inc(
     repository_revision_path: RepositoryRevisionPath, total_size: int
 ):
-    fallback_total_bytes.labels(repository=get_repo(repository_revision_path)).inc(
-        total_size
+    buffer.inc(
+        fallback_total_bytes, get_repo(repository_revision_path), amount=total_size
     )
+
+
+def api_model_info_request_inc(repository_revision: RepositoryRevision, source: str):
+    repository_labels.record_request(repository_revision.repository)
+    buffer.inc(
+        api_model_info_requests,
+        repository_label(repository_revision.repository),
+        source,
+    )
+
+
+def manifest_cache_hit_inc(repository_revision: RepositoryRevision):
+    buffer.inc(manifest_cache_hit, repository_label(repository_revision.repository))
+
+
+def manifest_cache_miss_inc(repository_revision: RepositoryRevision):
+    buffer.inc(manifest_cache_miss, repository_label(repository_revision.repository))
+
+
+def blob_cache_hit_inc(repository_revision_path: RepositoryRevisionPath):
+    buffer.inc(blob_cache_hit, get_repo(repository_revision_path))
+
+
+def blob_cache_miss_inc(repository_revision_path: RepositoryRevisionPath):
+    buffer.inc(blob_cache_miss, get_repo(repository_revision_path))
+
+
+def blob_cache_total_bytes_inc(
+    repository_revision_path: RepositoryRevisionPath, total_size: int
+):
+    buffer.inc(
+        blob_cache_total_bytes, get_repo(repository_revision_path), amount=total_size
+    )
+
+
+def blob_cache_populated_bytes_inc(total_size: int):
+    buffer.inc(blob_cache_populated_bytes, amount=total_size)
+
+
+def blob_cache_eviction_inc(total_size: int):
+    buffer.inc(blob_cache_evictions)
+    buffer.inc(blob_cache_evicted_bytes, amount=total_size)
+
+
+def blob_cache_occupancy_set(total_size: int):
+    blob_cache_occupancy_bytes.set(total_size)
+
+
+def small_file_cache_hit_inc(repository_revision_path: RepositoryRevisionPath):
+    buffer.inc(small_file_cache_hit, get_repo(repository_revision_path))
+
+
+def small_file_cache_miss_inc(repository_revision_path: RepositoryRevisionPath):
+    buffer.inc(small_file_cache_miss, get_repo(repository_revision_path))
+
+
+def small_file_cache_populated_bytes_inc(total_size: int):
+    buffer.inc(small_file_cache_populated_bytes, amount=total_size)
+
+
+def small_file_cache_eviction_inc(total_size: int):
+    buffer.inc(small_file_cache_evictions)
+    buffer.inc(small_file_cache_evicted_bytes, amount=total_size)
+
+
+def small_file_cache_occupancy_set(total_size: int):
+    small_file_cache_occupancy_bytes.set(total_size)
+
+
+def pack_hit_inc(repository_revision_path: RepositoryRevisionPath):
+    buffer.inc(pack_hit, get_repo(repository_revision_path))
+
+
+def chunked_hit_inc(repository_revision_path: RepositoryRevisionPath):
+    buffer.inc(chunked_hit, get_repo(repository_revision_path))
+
+
+def fallback_coalesced_inc(
+    repository_revision_path: RepositoryRevisionPath, leader: str
+):
+    buffer.inc(fallback_coalesced, get_repo(repository_revision_path), leader)
+
+
+def write_through_blob_inc(
+    repository_revision_path: RepositoryRevisionPath, total_size: int
+):
+    buffer.inc(write_through_blobs, get_repo(repository_revision_path))
+    buffer.inc(
+        write_through_bytes, get_repo(repository_revision_path), amount=total_size
+    )
+
+
+def write_through_manifest_inc(repository_revision_path: RepositoryRevisionPath):
+    buffer.inc(write_through_manifests, get_repo(repository_revision_path))
+
+
+def prewarm_bytes_inc(repository_revision: RepositoryRevision, total_size: int):
+    buffer.inc(
+        prewarm_bytes,
+        repository_label(repository_revision.repository),
+        amount=total_size,
+    )
+
+
+def upstream_connection_created_inc():
+    buffer.inc(upstream_connections_created)
+
+
+def upstream_connection_reused_inc():
+    buffer.inc(upstream_connections_reused)
+
+
+def upstream_pool_wait_observe(seconds: float):
+    upstream_pool_wait_seconds.observe(seconds)
+
+
+def response_timing_observe(
+    source: str,
+    method: str,
+    time_to_first_byte: float,
+    duration: float,
+    bytes_per_second: Optional[float],
+):
+    time_to_first_byte_seconds.labels(source=source, method=method).observe(
+        time_to_first_byte
+    )
+    transfer_seconds.labels(source=source, method=method).observe(duration)
+    if bytes_per_second is not None:
+        transfer_bytes_per_second.labels(source=source, method=method).observe(
+            bytes_per_second
+        )
+
+
+def in_flight_streams_inc(source: str):
+    in_flight_streams.labels(source=source).inc()
+
+
+def in_flight_streams_dec(source: str):
+    in_flight_streams.labels(source=source).dec()
+
+
+def manifest_load_observe(seconds: float):
+    manifest_load_seconds.observe(seconds)
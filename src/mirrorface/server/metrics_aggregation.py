@@ -0,0 +1,112 @@
+# Keeps metrics cheap in Prometheus multiprocess mode.
+#
+# Every counter increment is a write to the worker's mmap file, and every
+# request does several of them. Workers sum the increments in memory instead
+# (MetricsBuffer) and apply them to the counters periodically, one write per
+# changed series.
+#
+# The repository label is unbounded. Each worker gives a repository its own
+# label value once it has seen min_requests requests for it, up to
+# max_repositories of them, and counts the rest as "other" (RepositoryLabels).
+# Repositories keep their label once they have it, counts can't move between
+# series.
+#
+# Every worker has its own files, which the collector reads on every scrape,
+# and files of dead workers are left behind. The gunicorn master merges them
+# into one archive file per metric type when a worker exits
+# (archive_dead_process). Scrapes hold the same lock (ArchivingCollector), so
+# they never see a worker counted twice or not at all.
+
+import asyncio
+import os
+import threading
+
+from prometheus_client import Counter
+from prometheus_client.mmap_dict import MmapedDict
+from prometheus_client.multiprocess import MultiProcessCollector
+
+OTHER_REPOSITORY = "other"
+# Gauges of dead workers are removed by mark_process_dead, all ours are live.
+ARCHIVED_TYPES = ["counter", "histogram"]
+ARCHIVE_PID = "archive"
+
+collect_lock = threading.Lock()
+
+
+class RepositoryLabels:
+    def __init__(self, max_repositories: int, min_requests: int):
+        self.max_repositories = max_repositories
+        self.min_requests = min_requests
+        self._labelled: set[str] = set()
+        # Requests of repositories without a label yet. Started over when
+        # full, only repositories with many requests should make it.
+        self._candidates: dict[str, int] = {}
+
+    def record_request(self, repository: str):
+        if repository in self._labelled:
+            return
+        if len(self._labelled) >= self.max_repositories:
+            return
+        requests = self._candidates.get(repository, 0) + 1
+        if requests < self.min_requests:
+            if len(self._candidates) >= 10 * self.max_repositories:
+                self._candidates.clear()
+            self._candidates[repository] = requests
+            return
+        self._candidates.pop(repository, None)
+        self._labelled.add(repository)
+
+    def label(self, repository: str) -> str:
+        return repository if repository in self._labelled else OTHER_REPOSITORY
+
+
+class MetricsBuffer:
+    def __init__(self):
+        # Increments come from the event loop and from worker threads.
+        self._lock = threading.Lock()
+        self._pending: dict[tuple[Counter, tuple[str, ...]], float] = {}
+
+    def inc(self, counter: Counter, *label_values: str, amount: float = 1):
+        key = (counter, label_values)
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + amount
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for (counter, label_values), amount in pending.items():
+            if label_values:
+                counter.labels(*label_values).inc(amount)
+            else:
+                counter.inc(amount)
+
+    async def flush_periodically(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            self.flush()
+
+
+def archive_dead_process(directory: str, pid: int):
+    with collect_lock:
+        for metric_type in ARCHIVED_TYPES:
+            path = os.path.join(directory, f"{metric_type}_{pid}.db")
+            if not os.path.exists(path):
+                continue
+            archive = MmapedDict(
+                os.path.join(directory, f"{metric_type}_{ARCHIVE_PID}.db")
+            )
+            try:
+                for key, value, timestamp, _ in MmapedDict.read_all_values_from_file(
+                    path
+                ):
+                    archived_value, _ = archive.read_value(key)
+                    archive.write_value(key, archived_value + value, timestamp)
+            finally:
+                archive.close()
+            os.remove(path)
+
+
+class ArchivingCollector(MultiProcessCollector):
+    def collect(self):
+        with collect_lock:
+            return super().collect()
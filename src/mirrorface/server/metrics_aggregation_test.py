@@ -0,0 +1,79 @@
+import os
+
+from prometheus_client import CollectorRegistry, Counter
+from prometheus_client.mmap_dict import MmapedDict, mmap_key
+
+from mirrorface.server.metrics_aggregation import (
+    ArchivingCollector,
+    MetricsBuffer,
+    RepositoryLabels,
+    archive_dead_process,
+)
+
+
+def test_repository_labels():
+    labels = RepositoryLabels(max_repositories=2, min_requests=3)
+    for _ in range(3):
+        labels.record_request("user/popular")
+    labels.record_request("user/rare")
+    assert labels.label("user/popular") == "user/popular"
+    assert labels.label("user/rare") == "other"
+
+    for _ in range(3):
+        labels.record_request("user/second")
+    # Over the limit, stays "other" however popular.
+    for _ in range(10):
+        labels.record_request("user/third")
+    assert labels.label("user/second") == "user/second"
+    assert labels.label("user/third") == "other"
+
+
+def test_metrics_buffer():
+    registry = CollectorRegistry()
+    requests = Counter("requests", "", ["repository"], registry=registry)
+    total_bytes = Counter("bytes", "", registry=registry)
+    buffer = MetricsBuffer()
+
+    buffer.inc(requests, "user/repo")
+    buffer.inc(requests, "user/repo")
+    buffer.inc(total_bytes, amount=100)
+    # Nothing written until flushed.
+    assert (
+        registry.get_sample_value("requests_total", {"repository": "user/repo"}) is None
+    )
+
+    buffer.flush()
+    buffer.inc(total_bytes, amount=50)
+    buffer.flush()
+    assert registry.get_sample_value("requests_total", {"repository": "user/repo"}) == 2
+    assert registry.get_sample_value("bytes_total") == 150
+
+
+def write_counter(directory, pid: str, repository: str, value: float):
+    values = MmapedDict(os.path.join(directory, f"counter_{pid}.db"))
+    key = mmap_key("requests", "requests_total", ["repository"], [repository], "")
+    values.write_value(key, value, 0)
+    values.close()
+
+
+def test_archive_dead_process(tmp_path):
+    write_counter(tmp_path, "1", "user/repo", 1)
+    write_counter(tmp_path, "2", "user/repo", 2)
+    write_counter(tmp_path, "3", "user/other", 4)
+    registry = CollectorRegistry()
+    ArchivingCollector(registry, path=str(tmp_path))
+
+    def samples():
+        return {
+            repository: registry.get_sample_value(
+                "requests_total", {"repository": repository}
+            )
+            for repository in ["user/repo", "user/other"]
+        }
+
+    assert samples() == {"user/repo": 3, "user/other": 4}
+    archive_dead_process(str(tmp_path), 1)
+    archive_dead_process(str(tmp_path), 3)
+    # Same totals, from the live worker and the archive.
+    assert samples() == {"user/repo": 3, "user/other": 4}
+    assert sorted(os.listdir(tmp_path)) == ["counter_2.db", "counter_archive.db"]
@@ -0,0 +1,118 @@
+# Cache of upstream 404 responses.
+#
+# Clients probe many paths that don't exist (eg. adapter_config.json or
+# model.safetensors.index.json). For repositories we have manifests for those
+# are answered locally, for everything else each probe is an upstream round
+# trip that comes back 404. Remember those and answer repeated probes
+# ourselves.
+#
+# Files at a commit hash never change, so 404s for those are kept for long.
+# Branches and tags might gain the file at any time, so those expire quickly.
+#
+# The cache is per worker, optionally backed by a directory shared by all
+# workers on the machine. Each entry there is a small file named by the hash of
+# the upstream path that contains its expiry time.
+
+import contextlib
+import hashlib
+import logging
+import os
+import time
+from typing import Callable, Optional
+
+from mirrorface.common.cache import TTLCache
+from mirrorface.common.hub import RepositoryRevisionPath, is_commit_hash
+
+# Temporary files not modified for this long are leftovers from crashed workers.
+STALE_TEMP_SECONDS = 60 * 60
+
+
+class NotFoundCache:
+    def __init__(
+        self,
+        max_entries: int,
+        commit_ttl: float,
+        branch_ttl: float,
+        shared_directory: Optional[str] = None,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.commit_ttl = commit_ttl
+        self.branch_ttl = branch_ttl
+        self.shared_directory = shared_directory
+        self._clock = clock
+        self._entries: TTLCache[str, bool] = TTLCache(max_entries, clock=clock)
+        if shared_directory is not None:
+            os.makedirs(shared_directory, exist_ok=True)
+            self._remove_expired_files()
+
+    def _ttl(self, repository_revision_path: RepositoryRevisionPath) -> float:
+        revision = repository_revision_path.repository_revision.revision
+        return self.commit_ttl if is_commit_hash(revision) else self.branch_ttl
+
+    def _shared_path(self, upstream_path: str) -> Optional[str]:
+        if self.shared_directory is None:
+            return None
+        return os.path.join(
+            self.shared_directory, hashlib.sha256(upstream_path.encode()).hexdigest()
+        )
+
+    def contains(self, upstream_path: str) -> bool:
+        with contextlib.suppress(KeyError):
+            return self._entries[upstream_path]
+
+        shared_path = self._shared_path(upstream_path)
+        if shared_path is None:
+            return False
+        expires_at = self._read_expiry(shared_path)
+        if expires_at is None:
+            return False
+        remaining = expires_at - self._clock()
+        if remaining <= 0:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(shared_path)
+            return False
+        self._entries.put(upstream_path, True, ttl=remaining)
+        return True
+
+    def add(self, repository_revision_path: RepositoryRevisionPath, upstream_path: str):
+        ttl = self._ttl(repository_revision_path)
+        self._entries.put(upstream_path, True, ttl=ttl)
+
+        shared_path = self._shared_path(upstream_path)
+        if shared_path is None:
+            return
+        try:
+            temp_path = f"{shared_path}.tmp-{os.getpid()}"
+            with open(temp_path, "w") as f:
+                f.write(str(self._clock() + ttl))
+            os.replace(temp_path, shared_path)
+        except OSError:
+            logging.warning(
+                f"Failed to share not found entry for {upstream_path}", exc_info=True
+            )
+
+    def _read_expiry(self, shared_path: str) -> Optional[float]:
+        try:
+            with open(shared_path, "r") as f:
+                return float(f.read())
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            logging.warning(f"Invalid not found entry {shared_path}", exc_info=True)
+            return None
+
+    def _remove_expired_files(self):
+        assert self.shared_directory is not None
+        now = self._clock()
+        with os.scandir(self.shared_directory) as entries:
+            for entry in entries:
+                if ".tmp-" in entry.name:
+                    # Might be in the middle of being written by another worker.
+                    with contextlib.suppress(FileNotFoundError):
+                        if time.time() - entry.stat().st_mtime > STALE_TEMP_SECONDS:
+                            os.remove(entry.path)
+                    continue
+                expires_at = self._read_expiry(entry.path)
+                if expires_at is None or expires_at <= now:
+                    with contextlib.suppress(FileNotFoundError):
+                        os.remove(entry.path)
@@ -0,0 +1,59 @@
+import os
+
+from mirrorface.common.hub import RepositoryRevisionPath
+from mirrorface.server.not_found_cache import NotFoundCache
+
+COMMIT = "0123456789abcdef0123456789abcdef01234567"
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def path(revision: str) -> tuple[RepositoryRevisionPath, str]:
+    url_path = f"user/repo/resolve/{revision}/adapter_config.json"
+    repository_revision_path = RepositoryRevisionPath.from_url_path(url_path)
+    assert repository_revision_path is not None
+    return repository_revision_path, f"https://huggingface.co/{url_path}"
+
+
+def test_not_found_cache_ttls():
+    clock = FakeClock()
+    cache = NotFoundCache(100, commit_ttl=3600, branch_ttl=60, clock=clock)
+    commit, commit_url = path(COMMIT)
+    branch, branch_url = path("main")
+    assert not cache.contains(commit_url)
+    cache.add(commit, commit_url)
+    cache.add(branch, branch_url)
+    assert cache.contains(commit_url)
+    assert cache.contains(branch_url)
+
+    clock.now += 61
+    assert cache.contains(commit_url)
+    assert not cache.contains(branch_url)
+    clock.now += 3600
+    assert not cache.contains(commit_url)
+
+
+def test_not_found_cache_shared(tmp_path):
+    clock = FakeClock()
+    worker1 = NotFoundCache(100, 3600, 60, shared_directory=str(tmp_path), clock=clock)
+    worker2 = NotFoundCache(100, 3600, 60, shared_directory=str(tmp_path), clock=clock)
+    branch, branch_url = path("main")
+    worker1.add(branch, branch_url)
+    assert worker2.contains(branch_url)
+    assert len(os.listdir(tmp_path)) == 1
+
+    # Expired entries are removed.
+    clock.now += 61
+    assert not worker2.contains(branch_url)
+    assert os.listdir(tmp_path) == []
+
+    worker1.add(branch, branch_url)
+    clock.now += 61
+    NotFoundCache(100, 3600, 60, shared_directory=str(tmp_path), clock=clock)
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,113 @@
+# Uvicorn worker with the ASGI pathsend extension.
+#
+# Uvicorn doesn't implement `http.response.pathsend`, so BlobResponse would
+# always fall back to reading files in chunks and passing every chunk through
+# the ASGI send loop. This worker uses the h11 protocol (the one uvicorn picks
+# without httptools installed, as in our image) with pathsend added: the
+# response headers go through uvicorn as usual, then the file is written to
+# the socket with loop.sendfile (os.sendfile for plain TCP, a read/write loop
+# for TLS), and the response is finished through uvicorn again.
+#
+# The extension is only advertised by this worker, the app works unchanged
+# under any other server. Use it with
+#
+#     worker_class = "mirrorface.server.pathsend.PathsendUvicornWorker"
+
+import asyncio
+import os
+from typing import BinaryIO, cast
+
+import anyio
+import anyio.to_thread
+import h11
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+from uvicorn.protocols.http.h11_impl import H11Protocol, RequestResponseCycle
+from uvicorn.workers import UvicornWorker
+
+PATHSEND = "http.response.pathsend"
+
+
+class FileData:
+    # Stands in for the body bytes in h11, which only needs their length to
+    # frame the body. Passed through by send_with_data_passthrough.
+    def __init__(self, size: int):
+        self.size = size
+
+    def __len__(self) -> int:
+        return self.size
+
+
+def open_file(path: str) -> tuple[BinaryIO, int]:
+    f = open(path, "rb")
+    try:
+        return f, os.fstat(f.fileno()).st_size
+    except BaseException:
+        f.close()
+        raise
+
+
+async def send_file(cycle: RequestResponseCycle, path: str):
+    # Sends the body of the started response from the file, and completes it.
+    if cycle.disconnected:
+        return
+    if not cycle.response_started or cycle.response_complete:
+        raise RuntimeError(f"Unexpected ASGI message '{PATHSEND}'")
+    if cycle.scope["method"] != "HEAD":
+        f, size = await anyio.to_thread.run_sync(open_file, path)
+        try:
+            if cycle.flow.write_paused:
+                await cycle.flow.drain()
+            if cycle.disconnected:
+                # While opening the file, h11 doesn't accept data anymore.
+                return
+            # h11 checks the size against Content-Length and frames the body
+            # (the placeholder is one of the parts), we send the parts.
+            placeholder = FileData(size)
+            parts = cycle.conn.send_with_data_passthrough(
+                h11.Data(data=cast(bytes, placeholder))
+            )
+            for part in parts or []:
+                if part is placeholder:
+                    await asyncio.get_running_loop().sendfile(
+                        cycle.transport, f, 0, size
+                    )
+                else:
+                    cycle.transport.write(part)
+        except ConnectionError:
+            # Client went away, like uvicorn ignore the rest of the response.
+            cycle.disconnected = True
+            cycle.transport.close()
+            return
+        finally:
+            f.close()
+    await cycle.send({"type": "http.response.body", "body": b"", "more_body": False})
+
+
+class PathsendH11Protocol(H11Protocol):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.app = self._with_pathsend(self.app)
+
+    def _with_pathsend(self, app: ASGIApp) -> ASGIApp:
+        async def pathsend_app(scope: Scope, receive: Receive, send: Send):
+            if scope["type"] != "http":
+                await app(scope, receive, send)
+                return
+            # h11 handles one request of a connection at a time, the cycle
+            # stays the same until the response is complete.
+            cycle = self.cycle
+            scope["extensions"] = {**scope.get("extensions", {}), PATHSEND: {}}
+
+            async def send_with_pathsend(message: Message):
+                if message["type"] == PATHSEND:
+                    await send_file(cycle, message["path"])
+                else:
+                    await send(message)
+
+            await app(scope, receive, send_with_pathsend)
+
+        return pathsend_app
+
+
+class PathsendUvicornWorker(UvicornWorker):
+    CONFIG_KWARGS = {**UvicornWorker.CONFIG_KWARGS, "http": PathsendH11Protocol}
@@ -0,0 +1,68 @@
+import asyncio
+import os
+import socket
+
+import aiohttp
+import anyio
+import uvicorn
+
+from mirrorface.server.pathsend import PathsendH11Protocol
+from mirrorface.server.responses import BlobResponse, FileBlobSource
+
+DATA = os.urandom(3 * 1024 * 1024 + 17)
+
+
+class CountingSource(FileBlobSource):
+    def __init__(self, path: str, size: int):
+        super().__init__(path, size)
+        self.reads = 0
+
+    def read(self, start: int, end: int, chunk_size: int):
+        self.reads += 1
+        return super().read(start, end, chunk_size)
+
+
+def test_pathsend(tmp_path):
+    path = str(tmp_path / "blob")
+    with open(path, "wb") as f:
+        f.write(DATA)
+    sources = []
+
+    async def app(scope, receive, send):
+        assert "http.response.pathsend" in scope["extensions"]
+        source = CountingSource(path, len(DATA))
+        sources.append(source)
+        response = BlobResponse(source, headers={}, chunk_size=65536, sendfile=True)
+        await response(scope, receive, send)
+
+    async def run():
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        url = f"http://127.0.0.1:{sock.getsockname()[1]}/"
+        config = uvicorn.Config(app, http=PathsendH11Protocol, log_config=None)
+        server = uvicorn.Server(config)
+        task = asyncio.create_task(server.serve(sockets=[sock]))
+        while not server.started:
+            await asyncio.sleep(0.01)
+        try:
+            # One connection for all requests, so responses must be complete.
+            connector = aiohttp.TCPConnector(limit=1)
+            async with aiohttp.ClientSession(connector=connector) as session:
+                for _ in range(2):
+                    async with session.get(url) as r:
+                        assert r.status == 200
+                        assert r.headers["content-length"] == str(len(DATA))
+                        assert await r.read() == DATA
+                async with session.get(url, headers={"Range": "bytes=10-99"}) as r:
+                    assert r.status == 206 and await r.read() == DATA[10:100]
+                async with session.head(url) as r:
+                    assert r.status == 200 and await r.read() == b""
+                async with session.get(url) as r:
+                    assert await r.read() == DATA
+        finally:
+            server.should_exit = True
+            await task
+
+    anyio.run(run)
+    # Whole files are sent from the path, only the range is read.
+    assert [source.reads for source in sources] == [0, 0, 1, 0, 0]
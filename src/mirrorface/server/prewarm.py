@@ -0,0 +1,451 @@
+# Prewarming of mirrored revisions ahead of a rollout.
+#
+# When many pods start at the same time they all read the same blobs, and the
+# first reads of each blob go to cold storage (GCS behind the FUSE mount).
+# Prewarming reads every blob of a revision once beforehand, which fills the
+# FUSE file cache and the page cache, and copies the blobs into the blob cache
+# when it is enabled. Files stored as chunks are prewarmed by reading their
+# chunks.
+#
+# Jobs run in the background of the worker that received the request, reading
+# a bounded number of blobs at a time. Starting a job for a revision that is
+# already prewarmed (or in progress) returns the existing job instead, and
+# running jobs can be cancelled.
+#
+# Requests for a job can land on any worker, so jobs are also tracked in a
+# directory shared by the workers (SharedJobs), one set of files per job:
+#   - `<key>.lock`: the worker running the job holds an exclusive flock on
+#     it, so a job is never run twice, and a job whose worker died is seen
+#     as failed.
+#   - `<key>.json`: the status, written periodically by the running worker.
+#   - `<key>.cancel`: asks the running worker to cancel the job.
+
+import asyncio
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import time
+from typing import Literal, Optional
+
+import anyio
+import anyio.to_thread
+from pydantic import BaseModel
+
+from mirrorface.common.hub import RepositoryRevision
+from mirrorface.common.storage import (
+    ChunkList,
+    FullManifest,
+    blob_path,
+    load_full_manifest,
+    read_chunk_list,
+    write_file_atomic,
+)
+from mirrorface.server import metrics
+from mirrorface.server.blob_cache import BlobCache
+
+# Finished jobs kept for status requests, oldest are dropped first.
+MAX_FINISHED_JOBS = 100
+# How long to wait for another worker to start or cancel a job.
+SHARED_WAIT_SECONDS = 10
+SHARED_POLL_SECONDS = 0.05
+
+JobKey = tuple[str, str]
+
+
+class PrewarmStatus(BaseModel):
+    repository: str
+    # As requested when the job was started.
+    revision: str
+    revision_hash: str
+    state: Literal["running", "done", "failed", "cancelled"] = "running"
+    error: Optional[str] = None
+    # Blobs (chunks of chunked files), files with the same contents are read
+    # once.
+    total_blobs: int
+    total_bytes: int
+    read_blobs: int = 0
+    read_bytes: int = 0
+    started_at: float
+    finished_at: Optional[float] = None
+
+
+class PrewarmJob:
+    def __init__(self, status: PrewarmStatus, task: "asyncio.Task[None]"):
+        self.status = status
+        self.task = task
+
+
+class SharedJobs:
+    """Job files in a directory shared by all workers, small local files."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: JobKey, suffix: str) -> str:
+        name = hashlib.sha256("\n".join(key).encode()).hexdigest()
+        return os.path.join(self.directory, f"{name}{suffix}")
+
+    def try_lock(self, key: JobKey) -> Optional[int]:
+        # Returns the locked descriptor, None if another worker runs the job.
+        fd = os.open(self._path(key, ".lock"), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return None
+        return fd
+
+    def _is_locked(self, key: JobKey) -> bool:
+        try:
+            fd = os.open(self._path(key, ".lock"), os.O_RDONLY)
+        except FileNotFoundError:
+            return False
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return True
+        finally:
+            os.close(fd)
+        return False
+
+    def write(self, key: JobKey, status: PrewarmStatus):
+        write_file_atomic(self._path(key, ".json"), status.model_dump_json())
+
+    def read(self, key: JobKey) -> Optional[PrewarmStatus]:
+        try:
+            with open(self._path(key, ".json"), "r") as f:
+                status = PrewarmStatus.model_validate_json(f.read())
+        except FileNotFoundError:
+            return None
+        return self._check_running(key, status)
+
+    def _check_running(self, key: JobKey, status: PrewarmStatus) -> PrewarmStatus:
+        # A running job whose lock is free was left behind by a dead worker.
+        if status.state == "running" and not self._is_locked(key):
+            status.state = "failed"
+            status.error = "The worker running the job exited"
+        return status
+
+    def all(self) -> list[PrewarmStatus]:
+        statuses = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(".json"):
+                continue
+            with contextlib.suppress(FileNotFoundError, ValueError):
+                with open(os.path.join(self.directory, name), "r") as f:
+                    status = PrewarmStatus.model_validate_json(f.read())
+                key = (status.repository, status.revision_hash)
+                statuses.append(self._check_running(key, status))
+        return statuses
+
+    def request_cancel(self, key: JobKey):
+        with open(self._path(key, ".cancel"), "w"):
+            pass
+
+    def cancel_requested(self, key: JobKey) -> bool:
+        return os.path.exists(self._path(key, ".cancel"))
+
+    def clear_cancel(self, key: JobKey):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self._path(key, ".cancel"))
+
+    def drop_finished(self, max_finished: int):
+        finished = sorted(
+            (status.finished_at or 0, (status.repository, status.revision_hash))
+            for status in self.all()
+            if status.state != "running"
+        )
+        for _, key in finished[: max(0, len(finished) - max_finished)]:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path(key, ".json"))
+
+
+class Prewarmer:
+    def __init__(
+        self,
+        storage_root: str,
+        concurrency: int,
+        chunk_size: int,
+        state_directory: str,
+        blob_cache: Optional[BlobCache] = None,
+        publish_interval: float = 1,
+    ):
+        self.storage_root = storage_root
+        self.concurrency = concurrency
+        self.chunk_size = chunk_size
+        self.blob_cache = blob_cache
+        # Seconds between status updates of running jobs in the shared
+        # directory, and checks for cancellation from other workers.
+        self.publish_interval = publish_interval
+        self.shared = SharedJobs(state_directory)
+        # Jobs run by this worker, by repository and revision hash, in start
+        # order.
+        self.jobs: dict[JobKey, PrewarmJob] = {}
+
+    async def _resolve(
+        self, repository_revision: RepositoryRevision
+    ) -> Optional[FullManifest]:
+        # Always read from storage, a branch might have been re-mirrored.
+        return await anyio.to_thread.run_sync(
+            load_full_manifest, self.storage_root, repository_revision
+        )
+
+    async def start(
+        self, repository_revision: RepositoryRevision
+    ) -> Optional[PrewarmStatus]:
+        # Returns None if the revision is not mirrored.
+        manifest = await self._resolve(repository_revision)
+        if manifest is None:
+            return None
+        key = (repository_revision.repository, manifest.revision_hash)
+        job = self.jobs.get(key)
+        if job is not None and job.status.state in ["running", "done"]:
+            return job.status
+        shared_status = self.shared.read(key)
+        if shared_status is not None and shared_status.state in ["running", "done"]:
+            # Run by another worker.
+            return shared_status
+
+        blobs = sorted(set(manifest.files.values()))
+        sizes = {
+            manifest.files[path]: metadata.size
+            for path, metadata in manifest.file_metadata.items()
+        }
+        if not sizes:
+            # Manifests written by older versions, stat the blobs instead.
+            sizes = await anyio.to_thread.run_sync(self._blob_sizes, blobs)
+        if manifest.chunked_blobs:
+            chunk_lists = await anyio.to_thread.run_sync(
+                self._chunk_lists, manifest.chunked_blobs
+            )
+            chunks = {
+                chunk.blob_hash: chunk.size
+                for chunk_list in chunk_lists
+                for chunk in chunk_list.chunks
+            }
+            blobs = sorted(set(blobs) - set(manifest.chunked_blobs) | set(chunks))
+            sizes.update(chunks)
+        if manifest.pack is not None:
+            # Small files are served from the pack.
+            pack = manifest.pack
+            blobs = sorted(set(blobs) | {pack.blob_hash})
+            sizes[pack.blob_hash] = max(
+                entry.offset + entry.size for entry in pack.entries.values()
+            )
+        status = PrewarmStatus(
+            repository=repository_revision.repository,
+            revision=repository_revision.revision,
+            revision_hash=manifest.revision_hash,
+            total_blobs=len(blobs),
+            total_bytes=sum(sizes.get(blob_hash, 0) for blob_hash in blobs),
+            started_at=time.time(),
+        )
+        lock_fd = self.shared.try_lock(key)
+        if lock_fd is None:
+            # Another worker started it in the meantime.
+            return await self._wait_for_shared(key, status)
+        shared_status = self.shared.read(key)
+        if shared_status is not None and shared_status.state == "done":
+            os.close(lock_fd)
+            return shared_status
+        self.shared.clear_cancel(key)
+        self.shared.write(key, status)
+        self.jobs.pop(key, None)
+        self.jobs[key] = PrewarmJob(
+            status,
+            asyncio.create_task(
+                self._run(repository_revision, key, status, blobs, lock_fd)
+            ),
+        )
+        self._drop_finished()
+        logging.info(
+            f"Prewarming {repository_revision} ({manifest.revision_hash}): "
+            f"{status.total_blobs} blobs"
+        )
+        return status
+
+    async def find(
+        self, repository_revision: RepositoryRevision
+    ) -> Optional[PrewarmStatus]:
+        key = await self._find_key(repository_revision)
+        if key is None:
+            return None
+        job = self.jobs.get(key)
+        if job is not None and not job.task.done():
+            return job.status
+        # Finished jobs are in the shared directory, maybe restarted since by
+        # another worker.
+        return self.shared.read(key) or (job.status if job is not None else None)
+
+    async def cancel(
+        self, repository_revision: RepositoryRevision
+    ) -> Optional[PrewarmStatus]:
+        key = await self._find_key(repository_revision)
+        if key is None:
+            return None
+        job = self.jobs.get(key)
+        if job is not None and not job.task.done():
+            job.task.cancel()
+            # Returns once the reads in progress stopped.
+            await asyncio.wait([job.task])
+            return job.status
+        status = self.shared.read(key) or (job.status if job is not None else None)
+        if status is None or status.state != "running":
+            return status
+        # Run by another worker, which notices the request within
+        # publish_interval.
+        self.shared.request_cancel(key)
+        deadline = time.monotonic() + SHARED_WAIT_SECONDS
+        while status.state == "running" and time.monotonic() < deadline:
+            await asyncio.sleep(SHARED_POLL_SECONDS)
+            status = self.shared.read(key) or status
+        return status
+
+    def statuses(self) -> list[PrewarmStatus]:
+        # Jobs of all workers, with the latest status of our own.
+        statuses = {
+            (status.repository, status.revision_hash): status
+            for status in self.shared.all()
+        }
+        for key, job in self.jobs.items():
+            if not job.task.done() or key not in statuses:
+                statuses[key] = job.status
+        return sorted(statuses.values(), key=lambda status: status.started_at)
+
+    async def _find_key(
+        self, repository_revision: RepositoryRevision
+    ) -> Optional[JobKey]:
+        manifest = await self._resolve(repository_revision)
+        if manifest is None:
+            return None
+        return (repository_revision.repository, manifest.revision_hash)
+
+    async def _wait_for_shared(
+        self, key: JobKey, status: PrewarmStatus
+    ) -> PrewarmStatus:
+        # The worker that has the lock writes the status right after taking
+        # it. Returns our own view of the job if that takes too long.
+        deadline = time.monotonic() + SHARED_WAIT_SECONDS
+        while time.monotonic() < deadline:
+            shared_status = self.shared.read(key)
+            if shared_status is not None and shared_status.started_at >= (
+                status.started_at - SHARED_WAIT_SECONDS
+            ):
+                return shared_status
+            await asyncio.sleep(SHARED_POLL_SECONDS)
+        return status
+
+    def _blob_sizes(self, blobs: list[str]) -> dict[str, int]:
+        sizes = {}
+        for blob_hash in blobs:
+            try:
+                sizes[blob_hash] = os.path.getsize(
+                    blob_path(self.storage_root, blob_hash)
+                )
+            except FileNotFoundError:
+                # Reported when reading it.
+                pass
+        return sizes
+
+    def _chunk_lists(self, chunked_blobs: list[str]) -> list[ChunkList]:
+        chunk_lists = []
+        for blob_hash in chunked_blobs:
+            try:
+                chunk_lists.append(read_chunk_list(self.storage_root, blob_hash))
+            except FileNotFoundError:
+                logging.warning(f"Chunk list of {blob_hash} not found, not prewarmed")
+        return chunk_lists
+
+    def _drop_finished(self):
+        finished = [
+            key for key, job in self.jobs.items() if job.status.state != "running"
+        ]
+        for key in finished[: max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self.jobs[key]
+        self.shared.drop_finished(MAX_FINISHED_JOBS)
+
+    async def _run(
+        self,
+        repository_revision: RepositoryRevision,
+        key: JobKey,
+        status: PrewarmStatus,
+        blobs: list[str],
+        lock_fd: int,
+    ):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        publisher = asyncio.create_task(
+            self._publish(key, status, asyncio.current_task())
+        )
+
+        async def read(blob_hash: str):
+            async with semaphore:
+                await self._read_blob(repository_revision, status, blob_hash)
+
+        try:
+            results = await asyncio.gather(
+                *[read(blob_hash) for blob_hash in blobs], return_exceptions=True
+            )
+            errors = [r for r in results if isinstance(r, Exception)]
+            if errors:
+                status.state = "failed"
+                status.error = f"{len(errors)} blobs failed: {errors[0]}"
+            else:
+                status.state = "done"
+        except asyncio.CancelledError:
+            status.state = "cancelled"
+            raise
+        finally:
+            publisher.cancel()
+            status.finished_at = time.time()
+            self.shared.write(key, status)
+            self.shared.clear_cancel(key)
+            os.close(lock_fd)
+            logging.info(
+                f"Prewarming {repository_revision} {status.state}: "
+                f"{status.read_blobs}/{status.total_blobs} blobs, "
+                f"{status.read_bytes} bytes in "
+                f"{status.finished_at - status.started_at:.1f}s"
+            )
+
+    async def _publish(
+        self, key: JobKey, status: PrewarmStatus, task: "Optional[asyncio.Task]"
+    ):
+        # Shares the progress of a running job, and cancels it on request of
+        # another worker.
+        while True:
+            await asyncio.sleep(self.publish_interval)
+            self.shared.write(key, status)
+            if task is not None and self.shared.cancel_requested(key):
+                task.cancel()
+
+    async def _read_blob(
+        self,
+        repository_revision: RepositoryRevision,
+        status: PrewarmStatus,
+        blob_hash: str,
+    ):
+        path = blob_path(self.storage_root, blob_hash)
+        size = await anyio.to_thread.run_sync(os.path.getsize, path)
+        if (
+            self.blob_cache is not None
+            and self.blob_cache.lookup(blob_hash) is not None
+        ):
+            # Already on fast local disk.
+            status.read_bytes += size
+        elif self.blob_cache is not None and self.blob_cache.should_populate(
+            blob_hash, size
+        ):
+            async for chunk in self.blob_cache.read_through(
+                blob_hash, path, size, self.chunk_size
+            ):
+                status.read_bytes += len(chunk)
+                metrics.prewarm_bytes_inc(repository_revision, len(chunk))
+        else:
+            async with await anyio.open_file(path, "rb") as f:
+                while chunk := await f.read(self.chunk_size):
+                    status.read_bytes += len(chunk)
+                    metrics.prewarm_bytes_inc(repository_revision, len(chunk))
+        status.read_blobs += 1
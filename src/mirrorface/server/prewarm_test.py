@@ -0,0 +1,280 @@
+import asyncio
+import os
+
+import anyio
+
+from mirrorface.common.hub import RepositoryRevision
+from mirrorface.common.storage import (
+    blob_path,
+    local_file_metadata,
+    write_chunks,
+    write_local_manifests,
+    write_pack,
+)
+from mirrorface.server.blob_cache import BlobCache
+from mirrorface.server.prewarm import Prewarmer
+
+COMMIT = "0123456789abcdef0123456789abcdef01234567"
+MAIN = RepositoryRevision(repository="user/repo", revision="main")
+
+
+def make_store(
+    storage_root: str,
+    with_metadata: bool = True,
+    chunked: bool = False,
+    packed: bool = False,
+):
+    os.makedirs(os.path.join(storage_root, "blob"))
+    files = {"a.bin": "hash_a", "b.bin": "hash_b", "copy.bin": "hash_a"}
+    for blob_hash, size in [("hash_a", 3000), ("hash_b", 500)]:
+        with open(blob_path(storage_root, blob_hash), "wb") as f:
+            f.write(os.urandom(size))
+    file_metadata = local_file_metadata(storage_root, files)
+    pack = (
+        write_pack(storage_root, files, file_metadata, max_file_bytes=3000)
+        if packed
+        else None
+    )
+    if chunked:
+        write_chunks(storage_root, "hash_a", average_size=256)
+        os.remove(blob_path(storage_root, "hash_a"))
+    write_local_manifests(
+        RepositoryRevision(repository="user/repo", revision=COMMIT),
+        MAIN,
+        files,
+        storage_root,
+        file_metadata if with_metadata else None,
+        pack,
+        chunked_blobs=["hash_a"] if chunked else None,
+    )
+
+
+async def wait(prewarmer: Prewarmer, repository_revision: RepositoryRevision):
+    for job in prewarmer.jobs.values():
+        await asyncio.wait([job.task])
+    return await prewarmer.find(repository_revision)
+
+
+def test_prewarm(tmp_path):
+    storage_root = str(tmp_path / "store")
+    make_store(storage_root)
+    cache = BlobCache(str(tmp_path / "cache"), max_bytes=10_000)
+    prewarmer = Prewarmer(
+        storage_root,
+        concurrency=2,
+        chunk_size=1000,
+        state_directory=str(tmp_path / "state"),
+        blob_cache=cache,
+    )
+
+    async def run():
+        assert (
+            await prewarmer.start(
+                RepositoryRevision(repository="user/missing", revision="main")
+            )
+            is None
+        )
+        status = await prewarmer.start(MAIN)
+        assert status is not None
+        assert status.revision_hash == COMMIT
+        assert (status.total_blobs, status.total_bytes) == (2, 3500)
+
+        # Same job, also when asked by commit hash.
+        by_hash = RepositoryRevision(repository="user/repo", revision=COMMIT)
+        assert await prewarmer.start(by_hash) is status
+        status = await wait(prewarmer, by_hash)
+        assert status is not None
+        assert status.state == "done"
+        assert (status.read_blobs, status.read_bytes) == (2, 3500)
+        assert status.finished_at is not None
+
+        # Done jobs are not repeated.
+        assert await prewarmer.start(MAIN) == status
+        assert prewarmer.statuses() == [status]
+
+    anyio.run(run)
+    # Copied into the blob cache.
+    assert cache.lookup("hash_a") is not None
+    assert cache.lookup("hash_b") is not None
+
+
+def test_prewarm_chunked(tmp_path):
+    storage_root = str(tmp_path)
+    make_store(storage_root, chunked=True)
+    prewarmer = Prewarmer(
+        storage_root,
+        concurrency=2,
+        chunk_size=1000,
+        state_directory=str(tmp_path / "state"),
+    )
+
+    async def run():
+        status = await prewarmer.start(MAIN)
+        assert status is not None
+        # The chunks of hash_a, and hash_b.
+        assert status.total_blobs > 2 and status.total_bytes == 3500
+        status = await wait(prewarmer, MAIN)
+        assert status is not None
+        assert status.state == "done"
+        assert status.read_bytes == 3500
+
+    anyio.run(run)
+
+
+def test_prewarm_packed(tmp_path):
+    storage_root = str(tmp_path / "store")
+    make_store(storage_root, packed=True)
+    cache = BlobCache(str(tmp_path / "cache"), max_bytes=10_000)
+    prewarmer = Prewarmer(
+        storage_root,
+        concurrency=2,
+        chunk_size=1000,
+        state_directory=str(tmp_path / "state"),
+        blob_cache=cache,
+    )
+
+    async def run():
+        status = await prewarmer.start(MAIN)
+        assert status is not None
+        # The pack of both files, and the files themselves.
+        assert (status.total_blobs, status.total_bytes) == (3, 7000)
+        status = await wait(prewarmer, MAIN)
+        assert status is not None
+        assert status.state == "done"
+        assert (status.read_blobs, status.read_bytes) == (3, 7000)
+
+    anyio.run(run)
+    blobs = os.listdir(os.path.join(storage_root, "blob"))
+    assert len(blobs) == 3
+    assert all(cache.lookup(blob_hash) is not None for blob_hash in blobs)
+
+
+def test_prewarm_missing_blob(tmp_path):
+    storage_root = str(tmp_path)
+    make_store(storage_root, with_metadata=False)
+    os.remove(blob_path(storage_root, "hash_b"))
+    prewarmer = Prewarmer(
+        storage_root,
+        concurrency=2,
+        chunk_size=1000,
+        state_directory=str(tmp_path / "state"),
+    )
+
+    async def run():
+        status = await prewarmer.start(MAIN)
+        assert status is not None
+        # Sizes from the blobs, the manifest doesn't have them.
+        assert status.total_bytes == 3000
+        status = await wait(prewarmer, MAIN)
+        assert status is not None
+        assert status.state == "failed"
+        assert status.error is not None and "1 blobs failed" in status.error
+        assert status.read_blobs == 1
+
+        # Failed jobs can be started again.
+        restarted = await prewarmer.start(MAIN)
+        assert restarted is not None and restarted.state == "running"
+
+    anyio.run(run)
+
+
+def test_prewarm_cancel(tmp_path):
+    storage_root = str(tmp_path)
+    make_store(storage_root)
+    prewarmer = Prewarmer(
+        storage_root,
+        concurrency=1,
+        chunk_size=1,
+        state_directory=str(tmp_path / "state"),
+    )
+
+    async def run():
+        status = await prewarmer.start(MAIN)
+        assert status is not None
+        await asyncio.sleep(0.05)
+        assert await prewarmer.cancel(MAIN) is status
+        assert status.state == "cancelled"
+        assert status.read_bytes < 3500
+        assert status.finished_at is not None
+
+    anyio.run(run)
+
+
+def test_prewarm_workers(tmp_path):
+    # Two workers sharing the state directory, the job runs in the first one.
+    storage_root = str(tmp_path / "store")
+    make_store(storage_root)
+    first, second = [
+        Prewarmer(
+            storage_root,
+            concurrency=1,
+            chunk_size=1,
+            state_directory=str(tmp_path / "state"),
+            publish_interval=0.01,
+        )
+        for _ in range(2)
+    ]
+
+    async def run():
+        status = await first.start(MAIN)
+        assert status is not None
+        await asyncio.sleep(0.05)
+
+        shared = await second.find(MAIN)
+        assert shared is not None
+        assert shared.state == "running" and shared.started_at == status.started_at
+        assert 0 < shared.read_bytes < 3500
+        # Not started again by the second worker.
+        again = await second.start(MAIN)
+        assert again is not None and again.started_at == status.started_at
+        assert not second.jobs
+        assert [s.started_at for s in second.statuses()] == [status.started_at]
+
+        cancelled = await second.cancel(MAIN)
+        assert cancelled is not None
+        assert cancelled.state == "cancelled"
+        assert status.state == "cancelled"
+        assert cancelled.read_bytes == status.read_bytes
+
+        # Cancelled jobs can be started again, from any worker.
+        status = await second.start(MAIN)
+        assert status is not None and status.state == "running"
+        assert second.jobs and await first.find(MAIN) == status
+        await second.cancel(MAIN)
+
+    anyio.run(run)
+
+
+def test_prewarm_worker_exited(tmp_path):
+    storage_root = str(tmp_path / "store")
+    make_store(storage_root)
+    state_directory = str(tmp_path / "state")
+    prewarmer = Prewarmer(
+        storage_root, concurrency=1, chunk_size=1000, state_directory=state_directory
+    )
+
+    async def run():
+        status = await prewarmer.start(MAIN)
+        assert status is not None
+        await wait(prewarmer, MAIN)
+        # The status a worker left behind when it was killed mid-job.
+        prewarmer.shared.write(
+            (status.repository, status.revision_hash),
+            status.model_copy(update={"state": "running"}),
+        )
+
+        other = Prewarmer(
+            storage_root,
+            concurrency=1,
+            chunk_size=1000,
+            state_directory=state_directory,
+        )
+        shared = await other.find(MAIN)
+        assert shared is not None
+        assert shared.state == "failed"
+        assert shared.error == "The worker running the job exited"
+        # And it can be started again.
+        restarted = await other.start(MAIN)
+        assert restarted is not None and other.jobs
+
+    anyio.run(run)
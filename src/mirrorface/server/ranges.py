@@ -0,0 +1,89 @@
+# HTTP range requests (RFC 9110, section 14).
+#
+# Clients use these to resume interrupted downloads and to download large
+# files in parallel chunks.
+
+import re
+from typing import Optional
+
+# Don't let a single request turn into an unbounded number of reads.
+MAX_RANGES = 100
+
+_RANGE_SPEC = re.compile(r"^(\d*)-(\d*)$")
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range_header(value: str, size: int) -> Optional[list[tuple[int, int]]]:
+    """Parses a Range header into sorted, non-overlapping (start, end) pairs (end exclusive).
+
+    Returns None if the header should be ignored (serve the whole content), and
+    raises RangeNotSatisfiable if none of the requested ranges overlap the content.
+    """
+    unit, _, range_set = value.partition("=")
+    if unit.strip().lower() != "bytes" or not range_set:
+        return None
+
+    specs = range_set.split(",")
+    if len(specs) > MAX_RANGES:
+        return None
+
+    ranges: list[tuple[int, int]] = []
+    for spec in specs:
+        spec = spec.strip()
+        if not spec:
+            # Empty list elements are allowed.
+            continue
+        match = _RANGE_SPEC.match(spec)
+        if not match:
+            return None
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            if last and int(last) < start:
+                # Invalid syntax, the whole header is ignored.
+                return None
+            end = min(int(last) + 1, size) if last else size
+        elif last:
+            # Suffix range, last N bytes.
+            if int(last) == 0:
+                # Zero-length suffix is unsatisfiable.
+                continue
+            start = max(size - int(last), 0)
+            end = size
+        else:
+            return None
+        if start >= size:
+            continue
+        ranges.append((start, end))
+
+    if not ranges:
+        raise RangeNotSatisfiable()
+
+    # Merge overlapping or adjacent ranges.
+    ranges.sort()
+    merged = [ranges[0]]
+    for start, end in ranges[1:]:
+        last_start, last_end = merged[-1]
+        if start <= last_end:
+            merged[-1] = (last_start, max(last_end, end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def if_range_matches(if_range: Optional[str], etag: Optional[str]) -> bool:
+    # If-Range makes the range conditional on the representation not having
+    # changed. We only compare (strong) entity tags, if the client sent a date
+    # or we have no ETag, it doesn't match and the whole content is returned.
+    if if_range is None:
+        return True
+    if etag is None or if_range.startswith("W/"):
+        return False
+    return if_range.strip() == etag
+
+
+def content_range(start: int, end: int, size: int) -> str:
+    return f"bytes {start}-{end - 1}/{size}"
@@ -0,0 +1,55 @@
+import pytest
+
+from mirrorface.server.ranges import (
+    RangeNotSatisfiable,
+    if_range_matches,
+    parse_range_header,
+)
+
+
+def test_parse_range_header_single():
+    assert parse_range_header("bytes=0-99", 1000) == [(0, 100)]
+    assert parse_range_header("bytes=500-", 1000) == [(500, 1000)]
+    assert parse_range_header("bytes=-100", 1000) == [(900, 1000)]
+    # Clamped to the content size.
+    assert parse_range_header("bytes=900-5000", 1000) == [(900, 1000)]
+    assert parse_range_header("bytes=-5000", 1000) == [(0, 1000)]
+
+
+def test_parse_range_header_multiple():
+    assert parse_range_header("bytes=0-9, 20-29", 100) == [(0, 10), (20, 30)]
+    # Sorted, overlapping and adjacent ranges are merged.
+    assert parse_range_header("bytes=50-59,0-9,5-14,15-19", 100) == [
+        (0, 20),
+        (50, 60),
+    ]
+    # Unsatisfiable ranges are dropped if others are satisfiable.
+    assert parse_range_header("bytes=0-9,200-300", 100) == [(0, 10)]
+
+
+def test_parse_range_header_ignored():
+    assert parse_range_header("items=0-9", 100) is None
+    assert parse_range_header("bytes=", 100) is None
+    assert parse_range_header("bytes=abc", 100) is None
+    assert parse_range_header("bytes=-", 100) is None
+    assert parse_range_header("bytes=20-10", 100) is None
+    assert parse_range_header("bytes=" + ",".join(["0-1"] * 1000), 100) is None
+
+
+def test_parse_range_header_not_satisfiable():
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range_header("bytes=100-", 100)
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range_header("bytes=-0", 100)
+    with pytest.raises(RangeNotSatisfiable):
+        parse_range_header("bytes=0-", 0)
+
+
+def test_if_range_matches():
+    assert if_range_matches(None, None)
+    assert if_range_matches(None, '"abc"')
+    assert if_range_matches('"abc"', '"abc"')
+    assert not if_range_matches('"def"', '"abc"')
+    assert not if_range_matches('W/"abc"', '"abc"')
+    assert not if_range_matches("Wed, 21 Oct 2015 07:28:00 GMT", '"abc"')
+    assert not if_range_matches('"abc"', None)
@@ -0,0 +1,306 @@
+# Response for serving blobs from local storage.
+#
+# Like Starlette's FileResponse, but works with any source of bytes (not just
+# a file path) and handles range requests ourselves: single and multiple
+# ranges, If-Range and 416 for unsatisfiable ranges. Only the requested bytes
+# are read from the source. Also answers If-None-Match with 304 so clients
+# with a cached copy can revalidate without downloading anything.
+#
+# Whole files can be handed to the server with the ASGI pathsend extension,
+# when the server supports it. The server then sends the file itself (with
+# os.sendfile), without reading it in chunks and passing every chunk through
+# the ASGI send loop. Ranges and servers without the extension use the
+# chunked path.
+#
+# Blobs stored as chunks are read by ChunkedBlobSource, which opens only the
+# chunks that overlap the requested range.
+
+import bisect
+import itertools
+import secrets
+from typing import AsyncIterator, Callable, Mapping, Optional, Protocol, Sequence
+
+import anyio
+from anyio import AsyncFile
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from mirrorface.server.ranges import (
+    RangeNotSatisfiable,
+    content_range,
+    if_range_matches,
+    parse_range_header,
+)
+
+
+class BlobSource(Protocol):
+    size: int
+
+    def read(self, start: int, end: int, chunk_size: int) -> AsyncIterator[bytes]:
+        """Yields bytes [start, end) of the blob in chunks of at most chunk_size."""
+        ...
+
+
+class FileBlobSource:
+    def __init__(
+        self,
+        path: str,
+        size: int,
+        offset: int = 0,
+        file: Optional[AsyncFile[bytes]] = None,
+    ):
+        # The blob is at offset in the file, eg. a member of a pack. file is
+        # the path already opened by the caller (so a missing file is noticed
+        # before the response starts), it is closed once the response is sent.
+        self.path = path
+        self.size = size
+        self.offset = offset
+        self.file = file
+
+    def sendfile_path(self) -> Optional[str]:
+        # Path the server can send the whole file from directly, None if the
+        # bytes need to go through read().
+        return self.path if self.offset == 0 else None
+
+    async def read(self, start: int, end: int, chunk_size: int) -> AsyncIterator[bytes]:
+        if self.file is not None:
+            async for chunk in self._read(self.file, start, end, chunk_size):
+                yield chunk
+            return
+        async with await anyio.open_file(self.path, "rb") as f:
+            async for chunk in self._read(f, start, end, chunk_size):
+                yield chunk
+
+    async def aclose(self):
+        if self.file is not None:
+            await self.file.aclose()
+
+    async def _read(
+        self, f: AsyncFile[bytes], start: int, end: int, chunk_size: int
+    ) -> AsyncIterator[bytes]:
+        # The caller's file may be anywhere after reading an earlier range.
+        if self.file is not None or self.offset + start:
+            await f.seek(self.offset + start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = await f.read(min(chunk_size, remaining))
+            if not chunk:
+                raise EOFError(f"Unexpected end of {self.path}")
+            remaining -= len(chunk)
+            yield chunk
+
+
+class MemoryBlobSource:
+    def __init__(self, data: memoryview):
+        self.data = data
+        self.size = len(data)
+
+    async def read(self, start: int, end: int, chunk_size: int) -> AsyncIterator[bytes]:
+        # ASGI bodies are bytes, copy out one chunk at a time.
+        for offset in range(start, end, chunk_size):
+            yield bytes(self.data[offset : min(offset + chunk_size, end)])
+
+
+class ChunkedBlobSource:
+    def __init__(
+        self, chunk_sizes: Sequence[int], open_chunk: Callable[[int], BlobSource]
+    ):
+        # open_chunk returns the source of the chunk with the given index, it
+        # is only called for the chunks that are read.
+        self.open_chunk = open_chunk
+        # Start offset of every chunk, and the end of the blob.
+        self.offsets = [0, *itertools.accumulate(chunk_sizes)]
+        self.size = self.offsets[-1]
+
+    async def read(self, start: int, end: int, chunk_size: int) -> AsyncIterator[bytes]:
+        index = bisect.bisect_right(self.offsets, start) - 1
+        while start < end:
+            chunk_start = self.offsets[index]
+            chunk_end = min(self.offsets[index + 1], end)
+            async for data in self.open_chunk(index).read(
+                start - chunk_start, chunk_end - chunk_start, chunk_size
+            ):
+                yield data
+            start = chunk_end
+            index += 1
+
+
+def if_none_match_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    # Weak comparison (RFC 9110, section 13.1.2), our ETags are all strong
+    # but clients may send them back marked as weak.
+    if if_none_match is None or etag is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    return any(
+        candidate.strip().removeprefix("W/") == etag.removeprefix("W/")
+        for candidate in if_none_match.split(",")
+    )
+
+
+class BlobResponse(Response):
+    def __init__(
+        self,
+        source: BlobSource,
+        headers: Mapping[str, str],
+        chunk_size: int,
+        etag: Optional[str] = None,
+        on_complete: Optional[Callable[[int], None]] = None,
+        sendfile: bool = False,
+    ):
+        # on_complete is called with the number of body bytes sent, once the
+        # whole response was sent (not if the client disconnected). With
+        # sendfile, whole files are sent with pathsend if the server can.
+        self.source = source
+        self.chunk_size = chunk_size
+        self.etag = etag
+        self.on_complete = on_complete
+        self.sendfile = sendfile
+        self.status_code = 200
+        self.background = None
+        self.media_type = None
+        self.init_headers(headers)
+        self.headers["accept-ranges"] = "bytes"
+        if etag is not None:
+            self.headers["etag"] = etag
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await self._send(scope, send)
+        finally:
+            if isinstance(self.source, FileBlobSource):
+                await self.source.aclose()
+
+    async def _send(self, scope: Scope, send: Send) -> None:
+        send_header_only = scope["method"].upper() == "HEAD"
+        request_headers = Headers(scope=scope)
+        size = self.source.size
+
+        if if_none_match_matches(request_headers.get("if-none-match"), self.etag):
+            await self._send_not_modified(send)
+            return
+
+        ranges = None
+        range_header = request_headers.get("range")
+        if range_header is not None and if_range_matches(
+            request_headers.get("if-range"), self.etag
+        ):
+            try:
+                ranges = parse_range_header(range_header, size)
+            except RangeNotSatisfiable:
+                await self._send_not_satisfiable(send)
+                return
+
+        trailer = b""
+        if ranges is None:
+            self.headers["content-length"] = str(size)
+            parts = [(0, size, b"")]
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.status_code = 206
+            self.headers["content-range"] = content_range(start, end, size)
+            self.headers["content-length"] = str(end - start)
+            parts = [(start, end, b"")]
+        else:
+            self.status_code = 206
+            parts, trailer = self._multipart_parts(ranges)
+
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        if send_header_only:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+            return
+
+        path = self._sendfile_path(scope) if ranges is None else None
+        if path is not None:
+            await send({"type": "http.response.pathsend", "path": path})
+            if self.on_complete is not None:
+                self.on_complete(size)
+            return
+
+        sent = 0
+        for start, end, part_header in parts:
+            if part_header:
+                await send(
+                    {
+                        "type": "http.response.body",
+                        "body": part_header,
+                        "more_body": True,
+                    }
+                )
+            async for chunk in self.source.read(start, end, self.chunk_size):
+                await send(
+                    {"type": "http.response.body", "body": chunk, "more_body": True}
+                )
+                sent += len(chunk)
+        await send(
+            {
+                "type": "http.response.body",
+                "body": trailer,
+                "more_body": False,
+            }
+        )
+        if self.on_complete is not None:
+            self.on_complete(sent)
+
+    def _sendfile_path(self, scope: Scope) -> Optional[str]:
+        if not self.sendfile or not isinstance(self.source, FileBlobSource):
+            return None
+        if "http.response.pathsend" not in scope.get("extensions", {}):
+            return None
+        return self.source.sendfile_path()
+
+    def _multipart_parts(
+        self, ranges: list[tuple[int, int]]
+    ) -> tuple[list[tuple[int, int, bytes]], bytes]:
+        # multipart/byteranges body, each part has its own Content-Range.
+        boundary = secrets.token_hex(16)
+        content_type = self.headers.get("content-type", "application/octet-stream")
+        parts = []
+        for i, (start, end) in enumerate(ranges):
+            part_header = (
+                ("\r\n" if i > 0 else "")
+                + f"--{boundary}\r\n"
+                + f"Content-Type: {content_type}\r\n"
+                + f"Content-Range: {content_range(start, end, self.source.size)}\r\n"
+                + "\r\n"
+            ).encode("latin-1")
+            parts.append((start, end, part_header))
+        trailer = f"\r\n--{boundary}--\r\n".encode("latin-1")
+
+        content_length = len(trailer) + sum(
+            len(header) + end - start for start, end, header in parts
+        )
+        self.headers["content-type"] = f"multipart/byteranges; boundary={boundary}"
+        self.headers["content-length"] = str(content_length)
+        return parts, trailer
+
+    async def _send_not_modified(self, send: Send):
+        self.status_code = 304
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def _send_not_satisfiable(self, send: Send):
+        self.status_code = 416
+        self.headers["content-range"] = f"bytes */{self.source.size}"
+        self.headers["content-length"] = "0"
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
@@ -0,0 +1,249 @@
+from typing import AsyncIterator, Optional
+
+import anyio
+
+from mirrorface.server.responses import (
+    BlobResponse,
+    BlobSource,
+    ChunkedBlobSource,
+    FileBlobSource,
+    MemoryBlobSource,
+)
+
+DATA = bytes(range(256)) * 4
+
+
+class MemorySource:
+    def __init__(self, data: bytes):
+        self.data = data
+        self.size = len(data)
+        self.reads: list[tuple[int, int]] = []
+
+    async def read(self, start: int, end: int, chunk_size: int) -> AsyncIterator[bytes]:
+        self.reads.append((start, end))
+        for offset in range(start, end, chunk_size):
+            yield self.data[offset : min(offset + chunk_size, end)]
+
+
+def call(
+    source: BlobSource,
+    request_headers: dict[str, str],
+    method: str = "GET",
+    etag: Optional[str] = '"etag"',
+) -> tuple[int, dict[str, str], bytes]:
+    response = BlobResponse(
+        source,
+        headers={"Content-Type": "application/octet-stream"},
+        chunk_size=100,
+        etag=etag,
+    )
+    scope = {
+        "type": "http",
+        "method": method,
+        "headers": [
+            (k.lower().encode("latin-1"), v.encode("latin-1"))
+            for k, v in request_headers.items()
+        ],
+    }
+    messages = []
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        messages.append(message)
+
+    anyio.run(response, scope, receive, send)
+    start = messages[0]
+    headers = {k.decode(): v.decode() for k, v in start["headers"]}
+    body = b"".join(m["body"] for m in messages[1:])
+    assert not messages[-1]["more_body"]
+    return start["status"], headers, body
+
+
+def test_full_response():
+    status, headers, body = call(MemorySource(DATA), {})
+    assert status == 200
+    assert body == DATA
+    assert headers["content-length"] == str(len(DATA))
+    assert headers["accept-ranges"] == "bytes"
+    assert headers["etag"] == '"etag"'
+
+
+def test_head_response():
+    source = MemorySource(DATA)
+    status, headers, body = call(source, {}, method="HEAD")
+    assert status == 200
+    assert body == b""
+    assert headers["content-length"] == str(len(DATA))
+    assert source.reads == []
+
+
+def test_single_range():
+    source = MemorySource(DATA)
+    status, headers, body = call(source, {"Range": "bytes=10-509"})
+    assert status == 206
+    assert body == DATA[10:510]
+    assert headers["content-range"] == f"bytes 10-509/{len(DATA)}"
+    assert headers["content-length"] == "500"
+    # Only the requested bytes are read.
+    assert source.reads == [(10, 510)]
+
+
+def test_multiple_ranges():
+    status, headers, body = call(MemorySource(DATA), {"Range": "bytes=0-9,-10"})
+    assert status == 206
+    content_type, boundary = headers["content-type"].split("; boundary=")
+    assert content_type == "multipart/byteranges"
+    assert headers["content-length"] == str(len(body))
+    assert (
+        body
+        == (
+            f"--{boundary}\r\n"
+            "Content-Type: application/octet-stream\r\n"
+            f"Content-Range: bytes 0-9/{len(DATA)}\r\n\r\n"
+        ).encode()
+        + DATA[:10]
+        + (
+            f"\r\n--{boundary}\r\n"
+            "Content-Type: application/octet-stream\r\n"
+            f"Content-Range: bytes {len(DATA) - 10}-{len(DATA) - 1}/{len(DATA)}\r\n\r\n"
+        ).encode()
+        + DATA[-10:]
+        + f"\r\n--{boundary}--\r\n".encode()
+    )
+
+
+def test_range_not_satisfiable():
+    status, headers, body = call(MemorySource(DATA), {"Range": "bytes=5000-"})
+    assert status == 416
+    assert headers["content-range"] == f"bytes */{len(DATA)}"
+    assert body == b""
+
+
+def test_if_range():
+    status, _, body = call(
+        MemorySource(DATA), {"Range": "bytes=0-9", "If-Range": '"etag"'}
+    )
+    assert status == 206
+    assert body == DATA[:10]
+    status, _, body = call(
+        MemorySource(DATA), {"Range": "bytes=0-9", "If-Range": '"other"'}
+    )
+    assert status == 200
+    assert body == DATA
+
+
+def test_if_none_match():
+    for if_none_match in ['"etag"', 'W/"etag"', '"other", "etag"', "*"]:
+        source = MemorySource(DATA)
+        status, headers, body = call(source, {"If-None-Match": if_none_match})
+        assert status == 304
+        assert headers["etag"] == '"etag"'
+        assert body == b""
+        assert source.reads == []
+    status, _, body = call(MemorySource(DATA), {"If-None-Match": '"other"'})
+    assert status == 200
+    assert body == DATA
+    # Takes precedence over ranges.
+    status, _, _ = call(
+        MemorySource(DATA), {"If-None-Match": '"etag"', "Range": "bytes=0-9"}
+    )
+    assert status == 304
+
+
+def test_pathsend(tmp_path):
+    path = str(tmp_path / "blob")
+    with open(path, "wb") as f:
+        f.write(DATA)
+
+    def send_messages(
+        request_headers: dict[str, str], extensions: dict, sendfile: bool = True
+    ) -> list[dict]:
+        completed = []
+        response = BlobResponse(
+            FileBlobSource(path, len(DATA)),
+            headers={},
+            chunk_size=100,
+            on_complete=completed.append,
+            sendfile=sendfile,
+        )
+        scope = {
+            "type": "http",
+            "method": "GET",
+            "headers": [
+                (k.lower().encode("latin-1"), v.encode("latin-1"))
+                for k, v in request_headers.items()
+            ],
+            "extensions": extensions,
+        }
+        messages = []
+
+        async def receive():
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            messages.append(message)
+
+        anyio.run(response, scope, receive, send)
+        assert completed
+        return messages
+
+    pathsend = {"http.response.pathsend": {}}
+    start, body = send_messages({}, pathsend)
+    assert start["status"] == 200
+    assert (b"content-length", str(len(DATA)).encode()) in start["headers"]
+    assert body == {"type": "http.response.pathsend", "path": path}
+
+    # Ranges, servers without the extension, or disabled: chunked.
+    for messages in [
+        send_messages({"Range": "bytes=0-9"}, pathsend),
+        send_messages({}, {}),
+        send_messages({}, pathsend, sendfile=False),
+    ]:
+        assert all(m["type"] != "http.response.pathsend" for m in messages)
+        assert messages[-1]["type"] == "http.response.body"
+
+
+def test_file_source_offset(tmp_path):
+    # Member of a pack: the blob starts at offset in the file, never pathsend.
+    path = str(tmp_path / "pack")
+    with open(path, "wb") as f:
+        f.write(b"header" + DATA + b"trailer")
+    source = FileBlobSource(path, len(DATA), offset=6)
+    assert source.sendfile_path() is None
+
+    status, _, body = call(source, {})
+    assert status == 200 and body == DATA
+    status, _, body = call(source, {"Range": "bytes=1000-"})
+    assert status == 206 and body == DATA[1000:]
+
+
+def test_memory_source():
+    status, _, body = call(MemoryBlobSource(memoryview(DATA)), {"Range": "bytes=10-"})
+    assert status == 206 and body == DATA[10:]
+
+
+def test_chunked_source():
+    chunk_sizes = [300, 200, 24, 500]
+    offsets = [0, 300, 500, 524, 1024]
+    chunks = [MemorySource(DATA[offsets[i] : offsets[i + 1]]) for i in range(4)]
+    source = ChunkedBlobSource(chunk_sizes, lambda index: chunks[index])
+    assert source.size == len(DATA)
+
+    status, _, body = call(source, {})
+    assert status == 200 and body == DATA
+    # Only the chunks that overlap the range are read.
+    for chunk in chunks:
+        chunk.reads.clear()
+    status, _, body = call(source, {"Range": "bytes=250-510"})
+    assert status == 206 and body == DATA[250:511]
+    assert [chunk.reads for chunk in chunks] == [
+        [(250, 300)],
+        [(0, 200)],
+        [(0, 11)],
+        [],
+    ]
+    status, _, body = call(source, {"Range": "bytes=500-523,1000-"})
+    assert status == 206
+    assert DATA[500:524] in body and DATA[1000:] in body
@@ -1,3 +1,7 @@
+import os
+import tempfile
+from typing import Literal, Optional
+
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
@@ -15,5 +19,107 @@ class Settings(BaseSettings):
     # Chunk size for transparent proxying.
     chunk_size: int = 8 * 1024 * 1024
 
+    # Upstream HTTP client, one connection pool per worker process.
+    # Maximum number of connections in total and per host.
+    upstream_pool_size: int = 100
+    upstream_pool_size_per_host: int = 32
+    upstream_dns_cache_ttl_seconds: int = 300
+    # How long idle connections are kept open for reuse.
+    upstream_keepalive_timeout_seconds: float = 60
+    upstream_connect_timeout_seconds: float = 10
+    # Maximum time between reads, there is no limit on the whole request.
+    upstream_read_timeout_seconds: float = 60
+
+    # Coalesce concurrent identical upstream downloads (also across workers).
+    # The body is spooled to a local directory that clients read from, which
+    # needs disk space for every file being downloaded at the same time.
+    upstream_coalescing: bool = False
+    upstream_spool_directory: str = os.path.join(
+        tempfile.gettempdir(), "mirrorface-spool"
+    )
+    # Larger downloads (and ones of unknown size) are not spooled, every
+    # client streams them directly from upstream.
+    upstream_spool_max_bytes: Optional[int] = 4 * 1024 * 1024 * 1024
+
+    # Cache of upstream 404s, so repeated probes for files that don't exist
+    # don't go upstream. Per worker, bounded by the number of entries.
+    upstream_not_found_cache_max_entries: int = 16384
+    # Files at a commit hash never change, branches and tags might gain them.
+    upstream_not_found_commit_ttl_seconds: float = 24 * 3600
+    upstream_not_found_branch_ttl_seconds: float = 60
+    # Optional local directory to share the entries between workers.
+    upstream_not_found_cache_directory: Optional[str] = None
+
+    # Store files downloaded from upstream in the local directory, and write
+    # the manifests once all files of a commit are stored. Requires the local
+    # directory to be writable.
+    write_through: bool = False
+
+    # Read size when serving blobs from local storage.
+    local_chunk_size: int = 1024 * 1024
+    # Let the server send whole blobs with os.sendfile (ASGI pathsend
+    # extension), if it supports it. Otherwise, or when disabled, blobs are
+    # read in chunks of local_chunk_size and sent through the ASGI app.
+    # Plain uvicorn doesn't support it, the worker in the shipped gunicorn
+    # config does (see pathsend.py).
+    local_sendfile: bool = True
+    # Serve small files from the pack of the revision, if the manifest has
+    # one. The whole pack is read into the small file cache when enabled.
+    local_packs: bool = True
+
+    # In-memory manifest cache, per worker process.
+    manifest_cache_max_entries: int = 4096
+    # Full manifests are keyed by commit hash and immutable, keep them for long.
+    manifest_cache_full_ttl_seconds: float = 3600
+    # Redirect manifests (branches, tags) change when re-mirrored.
+    manifest_cache_redirect_ttl_seconds: float = 60
+    # Manifests that don't exist (not mirrored yet), short to pick up new mirrors.
+    manifest_cache_missing_ttl_seconds: float = 10
+    # Chunk lists of files stored as chunks, per worker process. They never
+    # change, entries are only evicted.
+    chunk_list_cache_max_entries: int = 256
+
+    # Optional blob cache on fast local disk (eg. local SSD) in front of the
+    # local directory. Blobs are copied in on first read. Disabled if not set.
+    blob_cache_directory: Optional[str] = None
+    # Total size budget of the blob cache directory.
+    blob_cache_max_bytes: int = 100 * 1024 * 1024 * 1024
+    # Which blobs to evict first when over budget.
+    blob_cache_eviction_policy: Literal["lru", "lfu"] = "lru"
+
+    # Optional cache of small blobs in shared memory, used by all workers.
+    # Must be on a memory-backed filesystem (eg. /dev/shm). Blobs are copied
+    # in on first read. Disabled if not set.
+    small_file_cache_directory: Optional[str] = None
+    # Total size budget of the small file cache.
+    small_file_cache_max_bytes: int = 512 * 1024 * 1024
+    # Only blobs up to this size are cached.
+    small_file_cache_max_file_bytes: int = 1024 * 1024
+
+    # Number of blobs read at the same time when prewarming a revision.
+    prewarm_concurrency: int = 8
+    # Prewarm jobs are tracked in this directory, shared by the workers so
+    # that any of them can report on (or cancel) a job.
+    prewarm_state_directory: str = os.path.join(
+        tempfile.gettempdir(), "mirrorface-prewarm"
+    )
+
+    # Structured access log, one JSON line per request on stdout.
+    access_log: bool = True
+    # Fraction of 404 responses that are logged. Clients probe for many files
+    # that don't exist, lower this if they flood the log.
+    access_log_not_found_sample_rate: float = 1
+
+    # Counter increments are summed per worker and written out (to the
+    # Prometheus multiprocess files) at this interval.
+    metrics_flush_interval_seconds: float = 5
+    # Repositories get their own metrics label after this many requests to a
+    # worker, up to max_repositories of them. The rest are counted as "other".
+    metrics_max_repositories: int = 500
+    metrics_repository_min_requests: int = 10
+
+    # Bearer token required by the /admin endpoints. Open if not set.
+    admin_token: Optional[str] = None
+
 
 settings = Settings()  # pyright: ignore[reportCallIssue], pydantic-settings will initialize or throw
@@ -0,0 +1,386 @@
+# Coalescing of concurrent identical upstream fetches ("single-flight").
+#
+# When many clients miss on the same file at the same time (eg. a new model
+# rolling out to many pods) we only want to download it from upstream once.
+#
+# The first request for a key becomes the leader and starts the upstream fetch
+# in a background task, which spools the body into a file on local disk. Every
+# client (including the first one) then streams the body by tailing that file
+# at its own pace, so a slow client never stalls the fetch or other clients.
+#
+# The spool directory is shared by all workers. Leadership is decided by an
+# exclusive flock on `<key>.lock`, which the leader holds until the spool files
+# are cleaned up. Other workers follow by polling the spool files. Files:
+#   - `<key>.lock`: lock, the leader writes the final result into it once the
+#     fetch is done, so followers can read it through their own descriptor.
+#   - `<key>.meta`: upstream status and headers, published with rename once
+#     the upstream response starts.
+#   - `<key>.body`: the body, growing while the fetch is in progress.
+#
+# Fetches always run to completion even if all clients go away, so that the
+# result can be reused by other clients arriving in the meantime.
+#
+# Responses larger than max_spool_bytes (or without a Content-Length) are not
+# spooled: the client that started the fetch streams it directly, the others
+# get FlightTooLarge and fetch it themselves.
+
+import asyncio
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+import anyio
+import anyio.to_thread
+
+# Spool files not modified for this long are leftovers from crashed workers.
+STALE_SECONDS = 60 * 60
+
+# Status, headers and body of an upstream response. The body iterator must
+# release the upstream response when done.
+UpstreamFetch = Callable[
+    [], Awaitable[tuple[int, list[tuple[str, str]], AsyncIterator[bytes]]]
+]
+
+
+class FlightError(Exception):
+    pass
+
+
+class FlightTooLarge(FlightError):
+    pass
+
+
+class Flight:
+    """State of one upstream fetch, shared by all clients of this worker."""
+
+    def __init__(self, key: str, spool_path: str):
+        self.key = key
+        self.spool_path = spool_path
+        self.status: Optional[int] = None
+        self.headers: list[tuple[str, str]] = []
+        self.size = 0
+        self.done = False
+        self.error: Optional[str] = None
+        self.too_large = False
+        # Body of a response that is too large to spool, for the client that
+        # started the fetch.
+        self.direct_body: Optional[AsyncIterator[bytes]] = None
+        self._changed = asyncio.Event()
+
+    @property
+    def meta_path(self) -> str:
+        return f"{self.spool_path}.meta"
+
+    @property
+    def body_path(self) -> str:
+        return f"{self.spool_path}.body"
+
+    def notify(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self):
+        await self._changed.wait()
+
+
+class Subscription:
+    """One client's view of a flight, reads the spooled body from its own descriptor."""
+
+    def __init__(
+        self,
+        flight: Flight,
+        status: int,
+        body_fd: Optional[int],
+        chunk_size: int,
+        direct_body: Optional[AsyncIterator[bytes]] = None,
+    ):
+        self.flight = flight
+        self.status = status
+        self.headers = flight.headers
+        self._body_fd = body_fd
+        self._chunk_size = chunk_size
+        self._direct_body = direct_body
+
+    async def body(self) -> AsyncIterator[bytes]:
+        if self._direct_body is not None:
+            async for chunk in self._direct_body:
+                yield chunk
+            return
+        assert self._body_fd is not None
+        flight = self.flight
+        offset = 0
+        try:
+            while True:
+                if offset < flight.size:
+                    length = min(self._chunk_size, flight.size - offset)
+                    chunk = await anyio.to_thread.run_sync(
+                        os.pread, self._body_fd, length, offset
+                    )
+                    if not chunk:
+                        raise FlightError(f"Spool file truncated for {flight.key}")
+                    offset += len(chunk)
+                    yield chunk
+                elif flight.error is not None:
+                    raise FlightError(f"Upstream fetch failed: {flight.error}")
+                elif flight.done:
+                    return
+                else:
+                    await flight.wait()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._body_fd is not None:
+            os.close(self._body_fd)
+            self._body_fd = None
+
+
+class SingleFlight:
+    def __init__(
+        self,
+        spool_directory: str,
+        chunk_size: int,
+        poll_interval: float = 0.05,
+        linger: float = 5,
+        max_spool_bytes: Optional[int] = None,
+    ):
+        self.spool_directory = spool_directory
+        self.chunk_size = chunk_size
+        # Larger responses are not spooled, see FlightTooLarge.
+        self.max_spool_bytes = max_spool_bytes
+        # How often followers check on fetches led by other workers.
+        self.poll_interval = poll_interval
+        # How long finished fetches stay around for late requests to reuse.
+        self.linger = linger
+        self._flights: dict[str, Flight] = {}
+        # Keep references to background tasks so they don't get collected.
+        self._tasks: set[asyncio.Task] = set()
+        os.makedirs(spool_directory, exist_ok=True)
+        self._remove_stale_files()
+
+    def _remove_stale_files(self):
+        # Leftovers from crashed workers. Files of running fetches are
+        # modified regularly so they won't be considered stale.
+        now = time.time()
+        with os.scandir(self.spool_directory) as entries:
+            for entry in entries:
+                with contextlib.suppress(FileNotFoundError):
+                    if now - entry.stat().st_mtime > STALE_SECONDS:
+                        os.remove(entry.path)
+
+    async def join(
+        self, key: str, fetch: UpstreamFetch
+    ) -> tuple[Subscription, Optional[str]]:
+        # Returns a subscription once the upstream status and headers are
+        # known, and who leads the fetch: None if this request started it,
+        # "worker" if it was already in flight in this worker, "remote" if
+        # another worker is fetching it.
+        flight = self._flights.get(key)
+        coalesced = "worker"
+        if flight is None:
+            flight, coalesced = self._start(key, fetch)
+
+        while flight.status is None and flight.error is None:
+            await flight.wait()
+        if flight.too_large and (flight.direct_body is None or coalesced is not None):
+            raise FlightTooLarge(f"Too large to coalesce: {flight.key}")
+        if flight.status is None:
+            raise FlightError(f"Upstream fetch failed: {flight.error}")
+        if flight.direct_body is not None:
+            # Too large to spool, ours to stream.
+            body, flight.direct_body = flight.direct_body, None
+            return Subscription(flight, flight.status, None, 0, body), coalesced
+
+        body_fd = None
+        if flight.status in (200, 206):
+            try:
+                body_fd = os.open(flight.body_path, os.O_RDONLY)
+            except FileNotFoundError:
+                # Cleaned up by the leader of another worker in the meantime.
+                raise FlightError(f"Spool file gone for {flight.key}")
+        return Subscription(flight, flight.status, body_fd, self.chunk_size), coalesced
+
+    def _start(self, key: str, fetch: UpstreamFetch) -> tuple[Flight, Optional[str]]:
+        spool_path = os.path.join(
+            self.spool_directory, hashlib.sha256(key.encode()).hexdigest()
+        )
+        flight = Flight(key, spool_path)
+        lock_fd = self._try_lock(f"{spool_path}.lock")
+        if lock_fd is not None:
+            coro = self._lead(flight, fetch, lock_fd)
+            coalesced = None
+        else:
+            coro = self._follow(flight)
+            coalesced = "remote"
+        self._flights[key] = flight
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return flight, coalesced
+
+    def _try_lock(self, lock_path: str) -> Optional[int]:
+        # Returns the locked descriptor if we are the leader.
+        while True:
+            fd = os.open(lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                return None
+            # The previous leader might have removed the file between our
+            # open and flock, in which case we locked an orphan. Retry.
+            try:
+                if os.stat(lock_path).st_ino == os.fstat(fd).st_ino:
+                    return fd
+            except FileNotFoundError:
+                pass
+            os.close(fd)
+
+    async def _lead(self, flight: Flight, fetch: UpstreamFetch, lock_fd: int):
+        try:
+            await self._fetch(flight, fetch, lock_fd)
+            await asyncio.sleep(self.linger if flight.done else 0)
+        finally:
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            # Remove while still holding the lock, see _try_lock.
+            for path in [
+                f"{flight.spool_path}.lock",
+                flight.meta_path,
+                flight.body_path,
+            ]:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+            os.close(lock_fd)
+
+    async def _fetch(self, flight: Flight, fetch: UpstreamFetch, lock_fd: int):
+        # Spools the body, and records the result for followers in the lock
+        # file. Followers are told about failures and cancellation too, they
+        # must not wait for a fetch that is gone.
+        result: dict = {}
+        try:
+            with contextlib.suppress(FileNotFoundError):
+                # Leftovers of an earlier fetch, followers from back then still
+                # have their own descriptors.
+                os.remove(flight.body_path)
+            body_fd = os.open(
+                flight.body_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644
+            )
+            try:
+                status, headers, body = await fetch()
+                if status in (200, 206) and self._too_large(headers):
+                    flight.headers = headers
+                    flight.direct_body = body
+                    flight.too_large = True
+                    flight.status = status
+                    result = {"error": "Too large to coalesce", "too_large": True}
+                    self._flights.pop(flight.key, None)
+                    return
+                flight.status, flight.headers = status, headers
+                await anyio.to_thread.run_sync(self._write_meta, flight)
+                flight.notify()
+                async for chunk in body:
+                    await anyio.to_thread.run_sync(os.write, body_fd, chunk)
+                    flight.size += len(chunk)
+                    flight.notify()
+            finally:
+                os.close(body_fd)
+            result = {"size": flight.size}
+            flight.done = True
+        except BaseException as e:
+            if isinstance(e, Exception):
+                logging.warning(
+                    f"Upstream fetch failed for {flight.key}", exc_info=True
+                )
+            flight.error = repr(e)
+            result = {"error": flight.error}
+            # Don't hand out failed fetches to new requests.
+            self._flights.pop(flight.key, None)
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            flight.notify()
+            try:
+                os.ftruncate(lock_fd, 0)
+                os.pwrite(lock_fd, json.dumps(result).encode(), 0)
+            except OSError:
+                logging.warning(f"Failed to record result for {flight.key}")
+
+    def _too_large(self, headers: list[tuple[str, str]]) -> bool:
+        if self.max_spool_bytes is None:
+            return False
+        for name, value in headers:
+            if name.lower() == "content-length":
+                return not value.isdigit() or int(value) > self.max_spool_bytes
+        return True
+
+    def _write_meta(self, flight: Flight):
+        temp_path = f"{flight.meta_path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"status": flight.status, "headers": flight.headers}, f)
+        os.rename(temp_path, flight.meta_path)
+
+    async def _follow(self, flight: Flight):
+        # Mirrors the state of a fetch led by another worker into our flight.
+        lock_fd = None
+        body_fd = None
+        try:
+            lock_fd = os.open(f"{flight.spool_path}.lock", os.O_RDONLY)
+            while True:
+                result = os.pread(lock_fd, 4096, 0)
+                if flight.status is None:
+                    with contextlib.suppress(FileNotFoundError):
+                        with open(flight.meta_path, "r") as f:
+                            meta = json.load(f)
+                        # Open now, the leader removes the files once done.
+                        body_fd = os.open(flight.body_path, os.O_RDONLY)
+                        flight.status = meta["status"]
+                        flight.headers = [
+                            (name, value) for name, value in meta["headers"]
+                        ]
+                if body_fd is not None:
+                    flight.size = os.fstat(body_fd).st_size
+                flight.notify()
+
+                if result:
+                    outcome = json.loads(result)
+                    if outcome.get("too_large"):
+                        flight.too_large = True
+                        raise FlightTooLarge(outcome["error"])
+                    if "error" in outcome:
+                        raise FlightError(outcome["error"])
+                    if flight.status is None:
+                        raise FlightError("Leader finished before we could follow")
+                    if flight.size != outcome["size"]:
+                        raise FlightError("Spooled body size mismatch")
+                    flight.done = True
+                    break
+                if self._leader_gone(lock_fd):
+                    raise FlightError("Leader exited without finishing")
+                await asyncio.sleep(self.poll_interval)
+        except BaseException as e:
+            # Also when cancelled, our subscribers must not wait forever.
+            flight.error = repr(e)
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            flight.notify()
+            if self._flights.get(flight.key) is flight:
+                del self._flights[flight.key]
+            # Subscribers read through their own descriptors.
+            for fd in [lock_fd, body_fd]:
+                if fd is not None:
+                    os.close(fd)
+
+    def _leader_gone(self, lock_fd: int) -> bool:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return False
+        fcntl.flock(lock_fd, fcntl.LOCK_UN)
+        return True
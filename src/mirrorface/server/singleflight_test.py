@@ -0,0 +1,135 @@
+import asyncio
+import os
+
+import anyio
+import pytest
+
+from mirrorface.server.singleflight import FlightError, FlightTooLarge, SingleFlight
+
+CHUNKS = [os.urandom(1000) for _ in range(5)]
+
+
+class FakeUpstream:
+    def __init__(self, status: int = 200, headers: list[tuple[str, str]] = []):
+        self.status = status
+        self.headers = [("ETag", '"abc"'), *headers]
+        self.calls = 0
+        self.release = asyncio.Event()
+
+    async def fetch(self):
+        self.calls += 1
+
+        async def body():
+            # Hold the fetch open until the test lets it finish, so that
+            # other requests can join it.
+            for chunk in CHUNKS:
+                await self.release.wait()
+                yield chunk
+
+        return self.status, self.headers, body()
+
+
+async def read_body(subscription) -> bytes:
+    return b"".join([chunk async for chunk in subscription.body()])
+
+
+def test_single_flight_coalesces_in_worker(tmp_path):
+    async def run():
+        single_flight = SingleFlight(str(tmp_path), chunk_size=300, linger=0)
+        upstream = FakeUpstream()
+        first, first_leader = await single_flight.join("key", upstream.fetch)
+        second, second_leader = await single_flight.join("key", upstream.fetch)
+        assert first_leader is None
+        assert second_leader == "worker"
+        assert first.headers == [("ETag", '"abc"')]
+
+        upstream.release.set()
+        bodies = await asyncio.gather(read_body(first), read_body(second))
+        assert bodies == [b"".join(CHUNKS)] * 2
+        assert upstream.calls == 1
+
+        # Spool files are cleaned up after the linger period.
+        await asyncio.sleep(0.1)
+        assert os.listdir(tmp_path) == []
+
+    anyio.run(run)
+
+
+def test_single_flight_coalesces_across_workers(tmp_path):
+    async def run():
+        # Separate instances behave like separate workers, flock conflicts
+        # between different open file descriptions even within one process.
+        worker1 = SingleFlight(str(tmp_path), chunk_size=300, poll_interval=0.01)
+        worker2 = SingleFlight(str(tmp_path), chunk_size=300, poll_interval=0.01)
+        upstream = FakeUpstream()
+        first, first_leader = await worker1.join("key", upstream.fetch)
+        second, second_leader = await worker2.join("key", upstream.fetch)
+        assert first_leader is None
+        assert second_leader == "remote"
+        assert second.headers == [("ETag", '"abc"')]
+
+        upstream.release.set()
+        bodies = await asyncio.gather(read_body(first), read_body(second))
+        assert bodies == [b"".join(CHUNKS)] * 2
+        assert upstream.calls == 1
+
+    anyio.run(run)
+
+
+def test_single_flight_error_status(tmp_path):
+    async def run():
+        single_flight = SingleFlight(str(tmp_path), chunk_size=300, linger=0)
+        upstream = FakeUpstream(status=404)
+        upstream.release.set()
+        subscription, _ = await single_flight.join("key", upstream.fetch)
+        assert subscription.status == 404
+        subscription.close()
+
+    anyio.run(run)
+
+
+def test_single_flight_too_large(tmp_path):
+    async def run():
+        single_flight = SingleFlight(
+            str(tmp_path), chunk_size=300, linger=0, max_spool_bytes=1000
+        )
+        upstream = FakeUpstream(headers=[("Content-Length", "5000")])
+        upstream.release.set()
+        first, second = await asyncio.gather(
+            single_flight.join("key", upstream.fetch),
+            single_flight.join("key", upstream.fetch),
+            return_exceptions=True,
+        )
+        # The first client streams it directly, the second fetches it itself.
+        assert not isinstance(first, BaseException)
+        assert await read_body(first[0]) == b"".join(CHUNKS)
+        assert isinstance(second, FlightTooLarge)
+        assert upstream.calls == 1
+
+        await asyncio.sleep(0.1)
+        assert os.listdir(tmp_path) == []
+
+    anyio.run(run)
+
+
+def test_single_flight_cancelled_leader(tmp_path):
+    async def run():
+        single_flight = SingleFlight(str(tmp_path), chunk_size=300, linger=0)
+        upstream = FakeUpstream()
+        subscription, _ = await single_flight.join("key", upstream.fetch)
+        # Eg. the worker shutting down.
+        for task in single_flight._tasks:
+            task.cancel()
+        with pytest.raises(FlightError):
+            await read_body(subscription)
+        await asyncio.sleep(0.1)
+        assert os.listdir(tmp_path) == []
+
+        # A new fetch is started, not the cancelled one joined.
+        upstream.release.set()
+        subscription, leader = await single_flight.join("key", upstream.fetch)
+        assert leader is None
+        assert await read_body(subscription) == b"".join(CHUNKS)
+        assert upstream.calls == 2
+
+    anyio.run(run)
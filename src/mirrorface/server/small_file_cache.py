@@ -0,0 +1,261 @@
+# Cache of small blobs in shared memory, used by all worker processes.
+#
+# Most requests are for small files like config.json or tokenizer.json, and
+# every one of them would otherwise open the blob on the FUSE mount in
+# whichever worker gets the request. Blobs up to max_file_bytes are copied
+# into a memory-backed directory (tmpfs, eg. /dev/shm) on their first read.
+# Every worker maps a cached blob into memory once, and serves it from the
+# mapping afterwards without touching the filesystem. The mappings of all
+# workers share the same physical pages.
+#
+# The index of cached blobs is a mapped file in the same directory, with a
+# fixed number of slots holding the blob hash, size and last use time. Slots
+# are only changed under a file lock, and have a sequence number that is
+# odd while the slot is being written and changes whenever the slot does.
+# Workers check the sequence number of the slot on every hit, so they notice
+# when a blob they have mapped was evicted. The least recently used blobs are
+# evicted when the cache would go over its byte budget.
+#
+# Evicted files stay in memory as long as some worker has them mapped. Before
+# a worker maps another blob that would take its mappings over the byte
+# budget (or the number of slots), it drops the mappings of evicted blobs, so
+# every worker maps at most the budget.
+
+import contextlib
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import time
+from typing import Callable, Iterator, Optional, Union
+
+from mirrorface.server import metrics
+
+INDEX_FILE = "index"
+LOCK_FILE = ".lock"
+TEMP_PREFIX = ".tmp-"
+# Index layout: magic and number of slots, then the slots.
+MAGIC = b"MFSFC001"
+HEADER = struct.Struct("<8sQ")
+# Sequence number, size, last use time and blob hash (zero-padded).
+SLOT = struct.Struct("<QQd128s")
+SLOT_HASH_OFFSET = 24
+DEFAULT_SLOTS = 8192
+
+
+class SmallFileCache:
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int,
+        max_file_bytes: int,
+        slots: int = DEFAULT_SLOTS,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_file_bytes = max_file_bytes
+        self.clock = clock
+        os.makedirs(directory, exist_ok=True)
+        with self._locked():
+            self._index = self._open_index(slots)
+        self.slots = HEADER.unpack_from(self._index)[1]
+        # Blobs mapped by this worker: slot, sequence number when mapped, data.
+        self._mapped: dict[str, tuple[int, int, memoryview]] = {}
+        self._mapped_bytes = 0
+
+    def should_cache(self, size: int) -> bool:
+        return size <= min(self.max_file_bytes, self.max_bytes)
+
+    def get(self, blob_hash: str) -> Optional[memoryview]:
+        mapped = self._mapped.get(blob_hash)
+        if mapped is not None:
+            slot, sequence, data = mapped
+            if self._sequence(slot) == sequence:
+                self._touch(slot)
+                return data
+            # Evicted since we mapped it. Responses still using the mapping
+            # keep it alive, it is unmapped once they are done.
+            self._unmap(blob_hash)
+
+        found = self._find(blob_hash)
+        if found is None:
+            return None
+        slot, sequence, size = found
+        try:
+            data = self._map(blob_hash, size)
+        except (FileNotFoundError, ValueError):
+            # Evicted (or replaced) in the meantime.
+            return None
+        if self._sequence(slot) != sequence:
+            return None
+        if (
+            self._mapped_bytes + size > self.max_bytes
+            or len(self._mapped) >= self.slots
+        ):
+            self._drop_stale()
+        self._mapped[blob_hash] = (slot, sequence, data)
+        self._mapped_bytes += size
+        self._touch(slot)
+        return data
+
+    def _unmap(self, blob_hash: str):
+        _, _, data = self._mapped.pop(blob_hash)
+        self._mapped_bytes -= len(data)
+
+    def _drop_stale(self):
+        # Drops the mappings of blobs evicted since they were mapped.
+        stale = [
+            blob_hash
+            for blob_hash, (slot, sequence, _) in self._mapped.items()
+            if self._sequence(slot) != sequence
+        ]
+        for blob_hash in stale:
+            self._unmap(blob_hash)
+
+    def put(self, blob_hash: str, data: Union[bytes, memoryview]):
+        # Blocking, call from a thread. Does nothing if already cached.
+        encoded_hash = blob_hash.encode()
+        if not self.should_cache(len(data)) or len(encoded_hash) > 128:
+            return
+        if self._find(blob_hash) is not None:
+            return
+        temp_path = os.path.join(
+            self.directory, f"{TEMP_PREFIX}{os.getpid()}-{blob_hash}"
+        )
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            with self._locked():
+                if self._find(blob_hash) is not None:
+                    return
+                slot = self._evict(len(data))
+                os.rename(temp_path, self._path(blob_hash))
+                self._write_slot(slot, len(data), encoded_hash)
+            metrics.small_file_cache_populated_bytes_inc(len(data))
+        except OSError:
+            logging.warning(
+                f"Failed to copy {blob_hash} into small file cache", exc_info=True
+            )
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def _path(self, blob_hash: str) -> str:
+        return os.path.join(self.directory, blob_hash)
+
+    @contextlib.contextmanager
+    def _locked(self) -> Iterator[None]:
+        with open(os.path.join(self.directory, LOCK_FILE), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _open_index(self, slots: int) -> mmap.mmap:
+        # Called under the lock. Starts over (dropping all cached blobs) if
+        # the index is missing or was written by an incompatible version.
+        index_path = os.path.join(self.directory, INDEX_FILE)
+        size = HEADER.size + slots * SLOT.size
+        try:
+            with open(index_path, "r+b") as f:
+                index = mmap.mmap(f.fileno(), 0)
+            if index[: len(MAGIC)] == MAGIC:
+                return index
+            index.close()
+        except (FileNotFoundError, ValueError):
+            pass
+
+        for name in os.listdir(self.directory):
+            if name != LOCK_FILE:
+                os.remove(os.path.join(self.directory, name))
+        temp_path = os.path.join(self.directory, f"{TEMP_PREFIX}{INDEX_FILE}")
+        with open(temp_path, "wb") as f:
+            f.truncate(size)
+            f.write(HEADER.pack(MAGIC, slots))
+        os.rename(temp_path, index_path)
+        with open(index_path, "r+b") as f:
+            return mmap.mmap(f.fileno(), 0)
+
+    def _slot_offset(self, slot: int) -> int:
+        return HEADER.size + slot * SLOT.size
+
+    def _sequence(self, slot: int) -> int:
+        return struct.unpack_from("<Q", self._index, self._slot_offset(slot))[0]
+
+    def _touch(self, slot: int):
+        # Not synchronized, last use times are only used to pick what to evict.
+        struct.pack_into("<d", self._index, self._slot_offset(slot) + 16, self.clock())
+
+    def _find(self, blob_hash: str) -> Optional[tuple[int, int, int]]:
+        # Returns the slot, its sequence number and the blob size. The hash is
+        # searched for in the whole index at once, which is much faster than
+        # reading the slots one by one.
+        needle = SLOT.pack(0, 0, 0, blob_hash.encode())[SLOT_HASH_OFFSET:]
+        position = self._index.find(needle, HEADER.size)
+        while position != -1:
+            slot, remainder = divmod(
+                position - HEADER.size - SLOT_HASH_OFFSET, SLOT.size
+            )
+            if remainder == 0:
+                sequence, size, _, slot_hash = SLOT.unpack_from(
+                    self._index, self._slot_offset(slot)
+                )
+                if (
+                    sequence % 2 == 0
+                    and slot_hash.rstrip(b"\0") == blob_hash.encode()
+                    and self._sequence(slot) == sequence
+                ):
+                    return slot, sequence, size
+                return None
+            position = self._index.find(needle, position + 1)
+        return None
+
+    def _map(self, blob_hash: str, size: int) -> memoryview:
+        if size == 0:
+            return memoryview(b"")
+        with open(self._path(blob_hash), "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+        if len(data) != size:
+            raise ValueError(f"Unexpected size of {blob_hash}")
+        return memoryview(data)
+
+    def _write_slot(self, slot: int, size: int, encoded_hash: bytes):
+        # Called under the lock.
+        sequence = self._sequence(slot)
+        offset = self._slot_offset(slot)
+        struct.pack_into("<Q", self._index, offset, sequence + 1)
+        SLOT.pack_into(
+            self._index, offset, sequence + 1, size, self.clock(), encoded_hash
+        )
+        struct.pack_into("<Q", self._index, offset, sequence + 2)
+
+    def _evict(self, reserve_bytes: int) -> int:
+        # Called under the lock. Evicts the least recently used blobs until
+        # reserve_bytes more fit into the budget, and returns a free slot.
+        used = []
+        free = []
+        total_bytes = 0
+        for slot in range(self.slots):
+            _, size, last_used, slot_hash = SLOT.unpack_from(
+                self._index, self._slot_offset(slot)
+            )
+            if slot_hash[0] == 0:
+                free.append(slot)
+            else:
+                used.append((last_used, slot, size, slot_hash.rstrip(b"\0").decode()))
+                total_bytes += size
+        used.sort()
+        for _, slot, size, blob_hash in used:
+            if total_bytes + reserve_bytes <= self.max_bytes and free:
+                break
+            self._write_slot(slot, 0, b"")
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(self._path(blob_hash))
+            free.append(slot)
+            total_bytes -= size
+            metrics.small_file_cache_eviction_inc(size)
+        metrics.small_file_cache_occupancy_set(total_bytes + reserve_bytes)
+        return free[0]
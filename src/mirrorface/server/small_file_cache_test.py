@@ -0,0 +1,111 @@
+import os
+
+from mirrorface.server.small_file_cache import SmallFileCache
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        self.now += 1
+        return self.now
+
+
+def test_small_file_cache_shared(tmp_path):
+    # Two instances on the same directory, like two worker processes.
+    writer = SmallFileCache(str(tmp_path), max_bytes=10_000, max_file_bytes=1000)
+    reader = SmallFileCache(str(tmp_path), max_bytes=10_000, max_file_bytes=1000)
+    data = os.urandom(500)
+
+    assert reader.get("hash1") is None
+    writer.put("hash1", data)
+    writer.put("empty", b"")
+
+    cached = reader.get("hash1")
+    assert cached is not None
+    assert bytes(cached) == data
+    # Mapped once, served from the same mapping afterwards.
+    assert reader.get("hash1") is cached
+    empty = reader.get("empty")
+    assert empty is not None and bytes(empty) == b""
+    # No temporary files left behind.
+    assert sorted(os.listdir(tmp_path)) == [".lock", "empty", "hash1", "index"]
+
+
+def test_small_file_cache_eviction_lru(tmp_path):
+    clock = FakeClock()
+    cache = SmallFileCache(
+        str(tmp_path), max_bytes=2500, max_file_bytes=1000, clock=clock
+    )
+    cache.put("hash1", b"1" * 1000)
+    cache.put("hash2", b"2" * 1000)
+    # Reading hash1 makes hash2 the least recently used.
+    assert cache.get("hash1") is not None
+    cache.put("hash3", b"3" * 1000)
+
+    assert cache.get("hash1") is not None
+    assert cache.get("hash2") is None
+    assert cache.get("hash3") is not None
+    assert not os.path.exists(tmp_path / "hash2")
+
+
+def test_small_file_cache_eviction_slots(tmp_path):
+    cache = SmallFileCache(
+        str(tmp_path), max_bytes=10_000, max_file_bytes=1000, slots=2
+    )
+    for blob_hash in ["hash1", "hash2", "hash3"]:
+        cache.put(blob_hash, b"x")
+    assert [cache.get(h) is not None for h in ["hash1", "hash2", "hash3"]] == [
+        False,
+        True,
+        True,
+    ]
+
+
+def test_small_file_cache_stale_mapping(tmp_path):
+    reader = SmallFileCache(str(tmp_path), max_bytes=1000, max_file_bytes=1000)
+    writer = SmallFileCache(str(tmp_path), max_bytes=1000, max_file_bytes=1000)
+    writer.put("hash1", b"1" * 1000)
+    assert reader.get("hash1") is not None
+
+    # Evicted by another worker, the reader notices without a filesystem call.
+    writer.put("hash2", b"2" * 1000)
+    assert reader.get("hash1") is None
+    cached = reader.get("hash2")
+    assert cached is not None and bytes(cached) == b"2" * 1000
+
+
+def test_small_file_cache_mapped_bytes(tmp_path):
+    reader, writer = [
+        SmallFileCache(str(tmp_path), max_bytes=10_000, max_file_bytes=1000, slots=64)
+        for _ in range(2)
+    ]
+    for i in range(1000):
+        writer.put(f"hash{i}", b"x" * 1000)
+        assert reader.get(f"hash{i}") is not None
+    # Evicted blobs are unmapped, never more than the budget mapped.
+    assert reader._mapped_bytes == sum(
+        len(data) for _, _, data in reader._mapped.values()
+    )
+    assert reader._mapped_bytes <= 10_000
+
+
+def test_small_file_cache_too_large(tmp_path):
+    cache = SmallFileCache(str(tmp_path), max_bytes=10_000, max_file_bytes=100)
+    assert not cache.should_cache(101)
+    cache.put("hash1", b"x" * 101)
+    assert cache.get("hash1") is None
+
+
+def test_small_file_cache_starts_over(tmp_path):
+    cache = SmallFileCache(str(tmp_path), max_bytes=1000, max_file_bytes=100)
+    cache.put("hash1", b"x")
+    with open(tmp_path / "index", "r+b") as f:
+        f.write(b"OLDMAGIC")
+    with open(tmp_path / ".tmp-leftover", "wb"):
+        pass
+
+    cache = SmallFileCache(str(tmp_path), max_bytes=1000, max_file_bytes=100)
+    assert cache.get("hash1") is None
+    assert sorted(os.listdir(tmp_path)) == [".lock", "index"]
@@ -0,0 +1,154 @@
+# Latency and throughput metrics of file responses, and the access log.
+#
+# The middleware times the ASGI messages of every response as they are sent:
+# time to the first body byte, time until the whole response was sent and
+# the effective throughput. Timing the messages covers every kind of response
+# in one place (chunked, pathsend and proxied upstream streams), and for
+# upstream fallbacks includes the time to the first upstream byte through any
+# redirect hops.
+#
+# Handlers record where a file was served from as the source of the request
+# (access_log.annotate(source=...)), only those responses go into the
+# metrics. 404 responses are their own source, whether the manifest or
+# upstream said the file doesn't exist. Every request except health checks
+# gets an access log record, with whatever the handlers annotated.
+
+import time
+from typing import Any, Callable, Optional
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from mirrorface.server import metrics
+from mirrorface.server.access_log import AccessLog, current_record
+
+# Throughput of smaller responses is mostly latency, not worth recording.
+THROUGHPUT_MIN_BYTES = 1024 * 1024
+UNLOGGED_PATHS = {"/health"}
+
+
+class ResponseTimer:
+    def __init__(self, scope: Scope, clock: Callable[[], float]):
+        self.scope = scope
+        self.clock = clock
+        self.started_at = clock()
+        self.record: dict[str, Any] = {
+            "method": scope["method"],
+            "path": scope["path"],
+        }
+        # Metrics label, set once the response starts if the handler
+        # recorded the source.
+        self.source: Optional[str] = None
+        self.status: Optional[int] = None
+        self.first_byte_at: Optional[float] = None
+        self.content_length = 0
+        self.sent_bytes = 0
+        self.finished = False
+
+    def start(self, message: Message):
+        self.status = message["status"]
+        for name, value in message.get("headers", []):
+            if name.lower() == b"content-length":
+                self.content_length = int(value)
+        source = self.record.get("source")
+        if source is None:
+            return
+        if self.status == 404:
+            source = "not_found"
+        self.source = source
+        metrics.in_flight_streams_inc(source)
+
+    def first_byte(self):
+        if self.first_byte_at is None:
+            self.first_byte_at = self.clock()
+
+    def body(self, body: bytes):
+        if body:
+            self.first_byte()
+        self.sent_bytes += len(body)
+
+    def finish(self) -> dict[str, Any]:
+        # Returns the access log record.
+        self.finished = True
+        finished_at = self.clock()
+        first_byte_at = (
+            self.first_byte_at if self.first_byte_at is not None else finished_at
+        )
+        duration = finished_at - self.started_at
+        if self.source is not None:
+            metrics.in_flight_streams_dec(self.source)
+            metrics.response_timing_observe(
+                self.source,
+                self.scope["method"],
+                time_to_first_byte=first_byte_at - self.started_at,
+                duration=duration,
+                bytes_per_second=self.sent_bytes / duration
+                if self.sent_bytes >= THROUGHPUT_MIN_BYTES and duration > 0
+                else None,
+            )
+        self.record.update(
+            status=self.status,
+            bytes=self.sent_bytes,
+            time_to_first_byte_seconds=round(first_byte_at - self.started_at, 6),
+            duration_seconds=round(duration, 6),
+        )
+        return self.record
+
+    def abort(self) -> dict[str, Any]:
+        # Client disconnected or the response failed midway, not timed.
+        if self.source is not None:
+            metrics.in_flight_streams_dec(self.source)
+        self.record.update(
+            status=self.status,
+            bytes=self.sent_bytes,
+            duration_seconds=round(self.clock() - self.started_at, 6),
+            completed=False,
+        )
+        return self.record
+
+
+class ResponseTimingMiddleware:
+    def __init__(
+        self,
+        app: ASGIApp,
+        access_log: Optional[AccessLog] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.app = app
+        self.access_log = access_log
+        self.clock = clock
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"] in UNLOGGED_PATHS:
+            await self.app(scope, receive, send)
+            return
+
+        timer = ResponseTimer(scope, self.clock)
+
+        async def timed_send(message: Message):
+            if message["type"] == "http.response.start":
+                timer.start(message)
+            if message["type"] == "http.response.body":
+                timer.body(message.get("body", b""))
+                await send(message)
+                if not message.get("more_body", False):
+                    self.emit(timer.finish())
+            elif message["type"] == "http.response.pathsend":
+                # The server sends the whole file, done once send returns.
+                timer.first_byte()
+                await send(message)
+                timer.sent_bytes = timer.content_length
+                self.emit(timer.finish())
+            else:
+                await send(message)
+
+        token = current_record.set(timer.record)
+        try:
+            await self.app(scope, receive, timed_send)
+        finally:
+            current_record.reset(token)
+            if not timer.finished:
+                self.emit(timer.abort())
+
+    def emit(self, record: dict[str, Any]):
+        if self.access_log is not None:
+            self.access_log.emit(record)
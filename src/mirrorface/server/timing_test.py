@@ -0,0 +1,151 @@
+from typing import Optional
+
+import anyio
+from prometheus_client import REGISTRY
+
+from mirrorface.server.access_log import AccessLog, annotate
+from mirrorface.server.timing import ResponseTimingMiddleware
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def sample(name: str, source: str, method: str = "GET") -> float:
+    value = REGISTRY.get_sample_value(name, {"source": source, "method": method})
+    return value or 0
+
+
+def in_flight(source: str) -> float:
+    return (
+        REGISTRY.get_sample_value("mirrorface_in_flight_streams", {"source": source})
+        or 0
+    )
+
+
+def run(
+    source: Optional[str],
+    status: int,
+    chunks: list[bytes],
+    clock: FakeClock,
+    method: str = "GET",
+    observed_in_flight: Optional[list[float]] = None,
+    access_log: Optional[AccessLog] = None,
+):
+    async def app(scope, receive, send):
+        if source is not None:
+            annotate(source=source)
+        annotate(resolution="test")
+        clock.now += 0.5
+        await send({"type": "http.response.start", "status": status, "headers": []})
+        for i, chunk in enumerate(chunks):
+            clock.now += 1
+            if observed_in_flight is not None:
+                observed_in_flight.append(in_flight(source or ""))
+            await send(
+                {
+                    "type": "http.response.body",
+                    "body": chunk,
+                    "more_body": i + 1 < len(chunks),
+                }
+            )
+
+    async def send(message):
+        pass
+
+    async def receive():
+        return {"type": "http.disconnect"}
+
+    middleware = ResponseTimingMiddleware(app, access_log=access_log, clock=clock)
+    scope = {"type": "http", "method": method, "path": "/mirror/test"}
+    anyio.run(middleware, scope, receive, send)
+
+
+def test_response_timing_upstream():
+    clock = FakeClock()
+    count = sample("mirrorface_time_to_first_byte_seconds_count", "upstream")
+    ttfb_sum = sample("mirrorface_time_to_first_byte_seconds_sum", "upstream")
+    duration_sum = sample("mirrorface_transfer_seconds_sum", "upstream")
+    throughput_sum = sample("mirrorface_transfer_bytes_per_second_sum", "upstream")
+    observed_in_flight = []
+
+    chunk = b"x" * (1024 * 1024)
+    run("upstream", 200, [chunk, chunk], clock, observed_in_flight=observed_in_flight)
+
+    assert (
+        sample("mirrorface_time_to_first_byte_seconds_count", "upstream") == count + 1
+    )
+    # Response started after 0.5s, first chunk a second later.
+    assert (
+        sample("mirrorface_time_to_first_byte_seconds_sum", "upstream")
+        == ttfb_sum + 1.5
+    )
+    assert sample("mirrorface_transfer_seconds_sum", "upstream") == duration_sum + 2.5
+    assert (
+        sample("mirrorface_transfer_bytes_per_second_sum", "upstream")
+        == throughput_sum + 2 * len(chunk) / 2.5
+    )
+    assert observed_in_flight[0] >= 1
+    assert in_flight("upstream") == observed_in_flight[0] - 1
+
+
+def test_response_timing_not_found_and_untimed():
+    clock = FakeClock()
+    not_found = sample("mirrorface_transfer_seconds_count", "not_found", "HEAD")
+    small = sample("mirrorface_transfer_bytes_per_second_count", "local")
+    local = sample("mirrorface_transfer_seconds_count", "local")
+
+    run("local", 404, [b""], clock, method="HEAD")
+    assert (
+        sample("mirrorface_transfer_seconds_count", "not_found", "HEAD")
+        == not_found + 1
+    )
+
+    # Too small for throughput.
+    run("local", 200, [b"small"], clock)
+    assert sample("mirrorface_transfer_seconds_count", "local") == local + 1
+    assert sample("mirrorface_transfer_bytes_per_second_count", "local") == small
+
+    # Not a file response.
+    run(None, 200, [b"OK"], clock)
+    assert sample("mirrorface_transfer_seconds_count", "local") == local + 1
+
+
+class RecordingAccessLog(AccessLog):
+    def __init__(self):
+        super().__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+def test_response_timing_access_log():
+    access_log = RecordingAccessLog()
+    run("local", 200, [b"abc", b"de"], FakeClock(), access_log=access_log)
+    run(None, 200, [b"OK"], FakeClock(), access_log=access_log)
+    assert access_log.records == [
+        {
+            "method": "GET",
+            "path": "/mirror/test",
+            "source": "local",
+            "resolution": "test",
+            "status": 200,
+            "bytes": 5,
+            "time_to_first_byte_seconds": 1.5,
+            "duration_seconds": 2.5,
+        },
+        {
+            "method": "GET",
+            "path": "/mirror/test",
+            "resolution": "test",
+            "status": 200,
+            "bytes": 2,
+            "time_to_first_byte_seconds": 1.5,
+            "duration_seconds": 1.5,
+        },
+    ]
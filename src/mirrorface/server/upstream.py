@@ -0,0 +1,78 @@
+# HTTP client for the upstream HF Hub.
+#
+# One long-lived session per worker process, created in the app lifespan, so
+# that fallback requests reuse DNS lookups and keep-alive TLS connections to
+# the Hub and its CDN instead of setting them up for every request.
+
+import asyncio
+import contextlib
+from types import SimpleNamespace
+from typing import AsyncIterator
+
+import aiohttp
+
+from mirrorface.server import metrics
+from mirrorface.server.settings import Settings
+
+
+async def on_connection_queued_start(
+    session: aiohttp.ClientSession,
+    context: SimpleNamespace,
+    params: aiohttp.TraceConnectionQueuedStartParams,
+):
+    context.queued_at = asyncio.get_running_loop().time()
+
+
+async def on_connection_queued_end(
+    session: aiohttp.ClientSession,
+    context: SimpleNamespace,
+    params: aiohttp.TraceConnectionQueuedEndParams,
+):
+    metrics.upstream_pool_wait_observe(
+        asyncio.get_running_loop().time() - context.queued_at
+    )
+
+
+async def on_connection_create_end(
+    session: aiohttp.ClientSession,
+    context: SimpleNamespace,
+    params: aiohttp.TraceConnectionCreateEndParams,
+):
+    metrics.upstream_connection_created_inc()
+
+
+async def on_connection_reuseconn(
+    session: aiohttp.ClientSession,
+    context: SimpleNamespace,
+    params: aiohttp.TraceConnectionReuseconnParams,
+):
+    metrics.upstream_connection_reused_inc()
+
+
+@contextlib.asynccontextmanager
+async def create_upstream_session(
+    settings: Settings,
+) -> AsyncIterator[aiohttp.ClientSession]:
+    connector = aiohttp.TCPConnector(
+        limit=settings.upstream_pool_size,
+        limit_per_host=settings.upstream_pool_size_per_host,
+        ttl_dns_cache=settings.upstream_dns_cache_ttl_seconds,
+        keepalive_timeout=settings.upstream_keepalive_timeout_seconds,
+    )
+    timeout = aiohttp.ClientTimeout(
+        # No total timeout, streaming large files can take a long time.
+        total=None,
+        connect=settings.upstream_connect_timeout_seconds,
+        sock_read=settings.upstream_read_timeout_seconds,
+    )
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_queued_start.append(on_connection_queued_start)
+    trace_config.on_connection_queued_end.append(on_connection_queued_end)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+    async with aiohttp.ClientSession(
+        connector=connector,
+        timeout=timeout,
+        trace_configs=[trace_config],
+    ) as session:
+        yield session
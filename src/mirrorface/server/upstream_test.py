@@ -0,0 +1,81 @@
+import asyncio
+
+import aiohttp
+import anyio
+from prometheus_client import REGISTRY
+
+from mirrorface.server import metrics
+from mirrorface.server.settings import settings
+from mirrorface.server.upstream import create_upstream_session
+from mirrorface.tools.fake_hub import FakeHub, Shaping, synthetic_repository
+
+REPOSITORY = "fake/model"
+
+
+def sample(name: str) -> float:
+    # Counter increments are buffered, flush them first.
+    metrics.flush()
+    return REGISTRY.get_sample_value(name) or 0
+
+
+async def get(session: aiohttp.ClientSession, hub: FakeHub) -> int:
+    url = f"{hub.url}/api/models/{REPOSITORY}/revision/main"
+    async with session.get(url) as response:
+        await response.read()
+        return response.status
+
+
+def test_settings_applied():
+    custom_settings = settings.model_copy(
+        update={
+            "upstream_pool_size": 7,
+            "upstream_pool_size_per_host": 3,
+            "upstream_connect_timeout_seconds": 2,
+            "upstream_read_timeout_seconds": 5,
+        }
+    )
+
+    async def run():
+        async with create_upstream_session(custom_settings) as session:
+            connector = session.connector
+            assert isinstance(connector, aiohttp.TCPConnector)
+            assert (connector.limit, connector.limit_per_host) == (7, 3)
+            assert session.timeout.total is None
+            assert (session.timeout.connect, session.timeout.sock_read) == (2, 5)
+
+    anyio.run(run)
+
+
+def test_connection_reused():
+    hub = FakeHub([synthetic_repository(REPOSITORY)])
+
+    async def run():
+        async with hub.serve():
+            async with create_upstream_session(settings) as session:
+                for _ in range(3):
+                    assert await get(session, hub) == 200
+
+    created = sample("mirrorface_upstream_connections_created_total")
+    reused = sample("mirrorface_upstream_connections_reused_total")
+    anyio.run(run)
+    # One keep-alive connection for the sequential requests.
+    assert sample("mirrorface_upstream_connections_created_total") == created + 1
+    assert sample("mirrorface_upstream_connections_reused_total") == reused + 2
+
+
+def test_pool_limit():
+    # Slow enough that all requests are waiting for the single connection.
+    hub = FakeHub([synthetic_repository(REPOSITORY)], Shaping(latency_seconds=0.05))
+
+    async def run():
+        async with hub.serve():
+            single = settings.model_copy(update={"upstream_pool_size": 1})
+            async with create_upstream_session(single) as session:
+                statuses = await asyncio.gather(*[get(session, hub) for _ in range(3)])
+                assert statuses == [200] * 3
+
+    created = sample("mirrorface_upstream_connections_created_total")
+    waits = sample("mirrorface_upstream_pool_wait_seconds_count")
+    anyio.run(run)
+    assert sample("mirrorface_upstream_connections_created_total") == created + 1
+    assert sample("mirrorface_upstream_pool_wait_seconds_count") == waits + 2
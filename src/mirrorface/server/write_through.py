@@ -0,0 +1,299 @@
+# Write-through population of the local directory from upstream fallbacks.
+#
+# Opt-in, requires the local directory to be writable. Upstream file bodies
+# are copied into a temporary file while they are streamed to the client,
+# hashed on the fly and published as blobs once complete.
+#
+# Each stored file is recorded in a per-commit ingest state file. Once every
+# file of the commit (according to the upstream file listing) is stored, the
+# manifests are written, and from then on the revision is served locally.
+#
+# All file operations run in threads, the local directory may be on slow
+# (network) storage and must not block the event loop.
+
+import asyncio
+import contextlib
+import fcntl
+import json
+import logging
+import os
+import urllib.parse
+from typing import AsyncIterator, Optional
+
+import aiohttp
+import anyio
+import anyio.to_thread
+
+from mirrorface.common.cache import TTLCache
+from mirrorface.common.hub import (
+    RepositoryRevision,
+    RepositoryRevisionPath,
+    is_commit_hash,
+)
+from mirrorface.common.storage import (
+    INGEST_DIRECTORY,
+    FileMetadata,
+    blob_hasher,
+    local_file_metadata,
+    publish_blob,
+    write_local_manifests,
+)
+from mirrorface.server import metrics
+from mirrorface.server.manifest_cache import ManifestCache
+
+
+class WriteThrough:
+    def __init__(
+        self,
+        local_directory: str,
+        upstream_url: str,
+        manifest_cache: ManifestCache,
+    ):
+        self.local_directory = local_directory
+        self.upstream_url = upstream_url
+        self.manifest_cache = manifest_cache
+        self.ingest_directory = os.path.join(local_directory, INGEST_DIRECTORY)
+        # File listings of commits we already fetched, they never change.
+        self._commit_files: TTLCache[tuple[str, str], dict[str, FileMetadata]] = (
+            TTLCache(1024)
+        )
+        self._tasks: set[asyncio.Task] = set()
+        os.makedirs(self.ingest_directory, exist_ok=True)
+
+    async def tee(
+        self,
+        session: aiohttp.ClientSession,
+        repository_revision_path: RepositoryRevisionPath,
+        commit: str,
+        expected_size: Optional[int],
+        body: AsyncIterator[bytes],
+    ) -> AsyncIterator[bytes]:
+        # Passes the body through, storing a copy. Problems with storing never
+        # affect the response.
+        temp_path = os.path.join(
+            self.ingest_directory, f".tmp-{os.getpid()}-{id(body)}"
+        )
+        temp_file = None
+        hasher = blob_hasher()
+        size = 0
+        try:
+            try:
+                temp_file = await anyio.to_thread.run_sync(
+                    lambda: open(temp_path, "wb")
+                )
+            except OSError:
+                logging.warning("Failed to start write-through", exc_info=True)
+
+            async for chunk in body:
+                if temp_file is not None:
+                    try:
+                        await anyio.to_thread.run_sync(
+                            self._write_chunk, temp_file, hasher, chunk
+                        )
+                        size += len(chunk)
+                    except OSError:
+                        logging.warning("Failed to write-through", exc_info=True)
+                        await anyio.to_thread.run_sync(temp_file.close)
+                        temp_file = None
+                yield chunk
+
+            if temp_file is not None:
+                await anyio.to_thread.run_sync(temp_file.close)
+                temp_file = None
+                if expected_size is not None and size != expected_size:
+                    logging.warning(
+                        f"Write-through size mismatch for {repository_revision_path}: {size} != {expected_size}"
+                    )
+                    await anyio.to_thread.run_sync(remove_if_exists, temp_path)
+                    return
+                self._start_task(
+                    self._publish(
+                        session,
+                        repository_revision_path,
+                        commit,
+                        temp_path,
+                        hasher.hexdigest(),
+                        size,
+                    )
+                )
+        finally:
+            if temp_file is not None:
+                # Also when the client went away, don't leave the file behind.
+                with anyio.CancelScope(shield=True):
+                    await anyio.to_thread.run_sync(
+                        self._discard_temp_file, temp_file, temp_path
+                    )
+
+    def _discard_temp_file(self, temp_file, temp_path: str):
+        temp_file.close()
+        remove_if_exists(temp_path)
+
+    def _write_chunk(self, temp_file, hasher, chunk: bytes):
+        temp_file.write(chunk)
+        hasher.update(chunk)
+
+    def _start_task(self, coro):
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _publish(
+        self,
+        session: aiohttp.ClientSession,
+        repository_revision_path: RepositoryRevisionPath,
+        commit: str,
+        temp_path: str,
+        blob_hash: str,
+        size: int,
+    ):
+        repository = repository_revision_path.repository_revision.repository
+        try:
+            await anyio.to_thread.run_sync(
+                publish_blob, self.local_directory, temp_path, blob_hash
+            )
+            logging.info(
+                f"Stored {repository_revision_path} as blob {blob_hash}: {size} bytes"
+            )
+            metrics.write_through_blob_inc(repository_revision_path, size)
+            stored_files = await anyio.to_thread.run_sync(
+                self._record_file,
+                repository,
+                commit,
+                repository_revision_path.path,
+                blob_hash,
+            )
+            await self._maybe_write_manifests(
+                session,
+                repository_revision_path,
+                commit,
+                stored_files,
+            )
+        except Exception:
+            logging.warning(
+                f"Write-through failed for {repository_revision_path}", exc_info=True
+            )
+        finally:
+            await anyio.to_thread.run_sync(remove_if_exists, temp_path)
+
+    def _state_path(self, repository: str, commit: str) -> Optional[str]:
+        name = RepositoryRevision(repository=repository, revision=commit)
+        safe_name = name.path_safe_string()
+        if safe_name is None:
+            return None
+        return os.path.join(self.ingest_directory, f"{safe_name}.json")
+
+    def _record_file(
+        self, repository: str, commit: str, path: str, blob_hash: str
+    ) -> dict[str, str]:
+        # Adds the file to the commit's ingest state, returns all files stored
+        # so far. Workers share the state file, so update it under a lock.
+        state_path = self._state_path(repository, commit)
+        if state_path is None:
+            return {}
+        with open(f"{state_path}.lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                with open(state_path, "r") as f:
+                    files = json.load(f)
+            except FileNotFoundError:
+                files = {}
+            files[path] = blob_hash
+            temp_path = f"{state_path}.tmp-{os.getpid()}"
+            with open(temp_path, "w") as f:
+                json.dump(files, f)
+            os.replace(temp_path, state_path)
+        return files
+
+    async def _maybe_write_manifests(
+        self,
+        session: aiohttp.ClientSession,
+        repository_revision_path: RepositoryRevisionPath,
+        commit: str,
+        stored_files: dict[str, str],
+    ):
+        repository_revision = repository_revision_path.repository_revision
+        repository = repository_revision.repository
+        commit_files = await self._get_commit_files(session, repository, commit)
+        if commit_files is None:
+            return
+        missing = [f for f in commit_files if f not in stored_files]
+        if missing:
+            logging.info(
+                f"Write-through of {repository}@{commit}: {len(missing)} of {len(commit_files)} files missing"
+            )
+            return
+
+        full_revision = RepositoryRevision(repository=repository, revision=commit)
+        files = {f: stored_files[f] for f in commit_files}
+        file_metadata = await anyio.to_thread.run_sync(
+            local_file_metadata, self.local_directory, files
+        )
+        for path, metadata in file_metadata.items():
+            upstream_metadata = commit_files[path]
+            if metadata.size != upstream_metadata.size:
+                logging.warning(
+                    f"Write-through of {repository}@{commit}: size mismatch for {path}, {metadata.size} != {upstream_metadata.size}"
+                )
+                return
+            metadata.blob_id = upstream_metadata.blob_id
+            metadata.lfs_sha256 = upstream_metadata.lfs_sha256
+            metadata.lfs_pointer_size = upstream_metadata.lfs_pointer_size
+        await anyio.to_thread.run_sync(
+            write_local_manifests,
+            full_revision,
+            repository_revision,
+            files,
+            self.local_directory,
+            file_metadata,
+        )
+        logging.info(f"Wrote manifests for {repository_revision} -> {commit}")
+        state_path = self._state_path(repository, commit)
+        if state_path is not None:
+            await anyio.to_thread.run_sync(remove_if_exists, state_path)
+        metrics.write_through_manifest_inc(repository_revision_path)
+        # Don't keep serving cached "missing" entries in this worker.
+        self.manifest_cache.invalidate(full_revision)
+        self.manifest_cache.invalidate(repository_revision)
+
+    async def _get_commit_files(
+        self, session: aiohttp.ClientSession, repository: str, commit: str
+    ) -> Optional[dict[str, FileMetadata]]:
+        key = (repository, commit)
+        with contextlib.suppress(KeyError):
+            return self._commit_files[key]
+
+        url = urllib.parse.urljoin(
+            self.upstream_url, f"api/models/{repository}/revision/{commit}"
+        )
+        # With blobs the listing includes sizes and blob ids of the files.
+        async with session.get(url, params={"blobs": "true"}) as response:
+            if response.status != 200:
+                logging.warning(
+                    f"Failed to list files of {repository}@{commit}: {response.status}"
+                )
+                return None
+            info = await response.json()
+        files = {
+            sibling["rfilename"]: FileMetadata(
+                size=sibling["size"],
+                blob_id=sibling.get("blobId"),
+                lfs_sha256=(sibling.get("lfs") or {}).get("sha256"),
+                lfs_pointer_size=(sibling.get("lfs") or {}).get("pointerSize"),
+            )
+            for sibling in info["siblings"]
+        }
+        self._commit_files.put(key, files)
+        return files
+
+
+def remove_if_exists(path: str):
+    with contextlib.suppress(FileNotFoundError):
+        os.remove(path)
+
+
+def upstream_commit(headers: dict[str, str]) -> Optional[str]:
+    # The commit the upstream response belongs to, if it is a valid hash.
+    for name, value in headers.items():
+        if name.lower() == "x-repo-commit" and is_commit_hash(value):
+            return value
+    return None
@@ -0,0 +1,73 @@
+import asyncio
+import os
+from typing import cast
+
+import aiohttp
+import anyio
+
+from mirrorface.common.hub import RepositoryRevision, RepositoryRevisionPath
+from mirrorface.common.storage import FileMetadata, get_file_hash, load_full_manifest
+from mirrorface.server.manifest_cache import ManifestCache
+from mirrorface.server.write_through import WriteThrough, upstream_commit
+
+COMMIT = "0123456789abcdef0123456789abcdef01234567"
+
+
+async def body(data: bytes):
+    for i in range(0, len(data), 100):
+        yield data[i : i + 100]
+
+
+def test_write_through(tmp_path):
+    storage_root = str(tmp_path)
+    manifest_cache = ManifestCache(storage_root, 100, 3600, 3600, 3600)
+    write_through = WriteThrough(storage_root, "http://upstream", manifest_cache)
+    # Pretend we already fetched the file listing, so no upstream requests.
+    files = {"a.json": b'{"a": 1}', "b.bin": os.urandom(1000)}
+    write_through._commit_files.put(
+        ("user/repo", COMMIT),
+        {
+            "a.json": FileMetadata(size=len(files["a.json"]), blob_id="1" * 40),
+            "b.bin": FileMetadata(size=1000, blob_id="2" * 40, lfs_sha256="3" * 64),
+        },
+    )
+    # Not used thanks to the above.
+    session = cast(aiohttp.ClientSession, None)
+    main = RepositoryRevision(repository="user/repo", revision="main")
+
+    async def run():
+        assert manifest_cache.load_full_manifest(main) is None
+        for path, data in files.items():
+            tee = write_through.tee(
+                session,
+                RepositoryRevisionPath(repository_revision=main, path=path),
+                COMMIT,
+                len(data),
+                body(data),
+            )
+            assert b"".join([chunk async for chunk in tee]) == data
+            # Wait for the background publishing.
+            while write_through._tasks:
+                await asyncio.sleep(0.01)
+
+    anyio.run(run)
+
+    manifest = load_full_manifest(storage_root, main)
+    assert manifest is not None
+    assert manifest.revision_hash == COMMIT
+    assert sorted(manifest.files) == ["a.json", "b.bin"]
+    assert manifest.file_metadata == write_through._commit_files[("user/repo", COMMIT)]
+    assert manifest.file_metadata["b.bin"].etag() == "3" * 64
+    for path, data in files.items():
+        blob = os.path.join(storage_root, "blob", manifest.files[path])
+        assert get_file_hash(blob) == manifest.files[path]
+        with open(blob, "rb") as f:
+            assert f.read() == data
+    # The negative cache entry was invalidated.
+    assert manifest_cache.load_full_manifest(main) == manifest
+
+
+def test_upstream_commit():
+    assert upstream_commit({"X-Repo-Commit": COMMIT}) == COMMIT
+    assert upstream_commit({"x-repo-commit": "main"}) is None
+    assert upstream_commit({}) is None
@@ -0,0 +1,373 @@
+# Mirrors many HuggingFace repositories in one run.
+#
+# Usage:
+#
+#     uv run bulk_mirror \
+#       --repositories_file=repositories.yaml \
+#       --local_directory=/tmp/mirrorface \
+#       --upload_destination=gs://mirrorface-bucket-name \
+#       --summary_file=summary.json
+#
+# The repositories file is either a text file with one `repository[@revision]`
+# per line (`#` starts a comment), or a YAML file (.yaml or .yml) with a list
+# of such strings or of `{repository: ..., revision: ...}` mappings. The
+# revision defaults to "main".
+#
+# All revisions are resolved to commit hashes first, then the repositories
+# are mirrored concurrently. Downloads share one concurrency and bandwidth
+# limit and uploads share one queue, files that appear in several
+# repositories are only downloaded and uploaded once. A repository that fails
+# doesn't stop the others, the summary (JSON) lists the result of each.
+
+import asyncio
+import functools
+import logging
+import os
+import sys
+import tempfile
+import time
+from typing import Literal, Optional, Union
+
+import yaml
+from pydantic import BaseModel
+from pydantic_settings import BaseSettings
+
+from mirrorface.common.chunking import AVERAGE_CHUNK_BYTES
+from mirrorface.common.hub import RepositoryRevision
+from mirrorface.common.storage import (
+    blob_path,
+    oid_index_paths,
+    write_local_manifests,
+)
+from mirrorface.tools.ingest import DownloadScheduler, ingest_repository
+from mirrorface.tools.mirror import (
+    chunk_large_files,
+    chunked_blobs,
+    find_destination_blobs,
+    keep_for_chunking,
+    keep_for_pack,
+    manifest_path_not_none,
+    normalize_repository_revision,
+    object_key,
+    pack_small_files,
+    plan_mirror,
+    upload_chunks,
+)
+from mirrorface.tools.upload.engine import UploadQueue, create_backend
+
+
+class Settings(BaseSettings, cli_parse_args=True):
+    repositories_file: str
+
+    local_directory: Optional[str] = None
+    # Where to upload the mirrored files, see the `mirror` command.
+    upload_destination: Optional[str] = None
+    # Where to write the summary, printed if not set.
+    summary_file: Optional[str] = None
+    # Only print what would be downloaded.
+    dry_run: bool = False
+
+    # Number of repositories mirrored at the same time.
+    repository_concurrency: int = 4
+    # Limits for all repositories together.
+    download_concurrency: int = 16
+    download_max_bytes_per_second: Optional[int] = None
+    upload_concurrency: int = 16
+
+    # Also write a pack of the files up to this size, see the `mirror` command.
+    pack_max_file_bytes: Optional[int] = None
+    # Store the files of at least this size as chunks, see the `mirror` command.
+    chunk_min_file_bytes: Optional[int] = None
+    chunk_average_bytes: int = AVERAGE_CHUNK_BYTES
+
+
+class RepositoryResult(BaseModel):
+    repository: str
+    revision: str
+    # Commit hash the revision resolved to.
+    revision_hash: Optional[str] = None
+    status: Literal["mirrored", "planned", "failed"] = "failed"
+    error: Optional[str] = None
+    files: int = 0
+    # Files that were already stored before the run.
+    stored_files: int = 0
+    # Size of the other files, the ones downloaded (or to be downloaded for
+    # a dry run). Files shared with other repositories count in each.
+    download_bytes: int = 0
+    duration_seconds: float = 0
+
+
+class Summary(BaseModel):
+    repositories: list[RepositoryResult]
+
+    def failed(self) -> list[RepositoryResult]:
+        return [r for r in self.repositories if r.status == "failed"]
+
+
+def parse_repository(entry: str) -> RepositoryRevision:
+    repository, _, revision = entry.strip().partition("@")
+    return RepositoryRevision(repository=repository, revision=revision or "main")
+
+
+def load_repositories(path: str) -> list[RepositoryRevision]:
+    with open(path, "r") as f:
+        content = f.read()
+    if path.endswith((".yaml", ".yml")):
+        entries = yaml.safe_load(content) or []
+        if not isinstance(entries, list):
+            raise ValueError(f"Expected a list of repositories in {path}")
+        repositories = [
+            parse_repository(entry)
+            if isinstance(entry, str)
+            else RepositoryRevision.model_validate(
+                {"revision": "main", **entry},
+            )
+            for entry in entries
+        ]
+    else:
+        lines = [line.split("#", 1)[0].strip() for line in content.splitlines()]
+        repositories = [parse_repository(line) for line in lines if line]
+    # Keep the order, but mirror every revision only once.
+    unique = []
+    for repository_revision in repositories:
+        if repository_revision not in unique:
+            unique.append(repository_revision)
+    return unique
+
+
+class BulkMirror:
+    """State shared by all repositories of a run."""
+
+    def __init__(
+        self,
+        settings: Settings,
+        local_directory: str,
+        queue: Optional[UploadQueue],
+    ):
+        self.settings = settings
+        self.local_directory = local_directory
+        self.queue = queue
+        self.scheduler = DownloadScheduler(
+            settings.download_concurrency, settings.download_max_bytes_per_second
+        )
+        self.semaphore = asyncio.Semaphore(settings.repository_concurrency)
+
+    async def mirror(
+        self,
+        original_repository_revision: RepositoryRevision,
+        repository_revision: RepositoryRevision,
+        result: RepositoryResult,
+    ):
+        plan = await asyncio.to_thread(
+            plan_mirror, repository_revision, self.local_directory
+        )
+        if self.queue is not None and plan.missing_files():
+            await find_destination_blobs(
+                self.queue.backend,
+                self.settings.upload_concurrency,
+                self.local_directory,
+                plan,
+                self.settings.pack_max_file_bytes,
+            )
+        result.files = len(plan.file_metadata)
+        result.stored_files = len(plan.stored_files)
+        result.download_bytes = plan.download_bytes()
+        if self.settings.dry_run:
+            result.status = "planned"
+            return
+
+        blob_uploads: list[asyncio.Task[None]] = []
+
+        def upload_blob(blob_hash: str):
+            if self.queue is None:
+                return
+            path = blob_path(self.local_directory, blob_hash)
+            # Local files in a temporary directory are not needed once
+            # uploaded, free up the disk space early.
+            on_done = (
+                None
+                if self.settings.local_directory
+                or keep_for_pack(self.settings.pack_max_file_bytes, path)
+                else functools.partial(os.remove, path)
+            )
+            blob_uploads.append(
+                self.queue.submit(
+                    object_key(self.local_directory, path), path, on_done=on_done
+                )
+            )
+
+        def on_blob(blob_hash: str):
+            path = blob_path(self.local_directory, blob_hash)
+            if keep_for_chunking(
+                self.settings.chunk_min_file_bytes, os.path.getsize(path)
+            ):
+                # Uploaded as chunks once all files are downloaded.
+                return
+            upload_blob(blob_hash)
+
+        for blob_hash in set(plan.local_files({}).values()):
+            on_blob(blob_hash)
+        downloaded_files = await ingest_repository(
+            repository_revision,
+            plan.missing_files(),
+            self.local_directory,
+            self.scheduler,
+            on_blob,
+        )
+        files = {**plan.stored_files, **downloaded_files}
+        local_files = plan.local_files(downloaded_files)
+        pack = await asyncio.to_thread(
+            pack_small_files,
+            self.settings.pack_max_file_bytes,
+            self.local_directory,
+            local_files,
+            plan.file_metadata,
+        )
+        if pack is not None:
+            upload_blob(pack.blob_hash)
+        chunking = await asyncio.to_thread(
+            chunk_large_files,
+            self.settings.chunk_min_file_bytes,
+            self.settings.chunk_average_bytes,
+            self.local_directory,
+            local_files,
+            plan.file_metadata,
+        )
+        if chunking is not None and self.queue is not None:
+            await upload_chunks(
+                self.queue,
+                self.local_directory,
+                chunking,
+                remove_uploaded=not self.settings.local_directory,
+            )
+        write_local_manifests(
+            repository_revision,
+            original_repository_revision,
+            files,
+            self.local_directory,
+            plan.file_metadata,
+            pack,
+            chunked_blobs(chunking, plan),
+        )
+
+        if self.queue is not None:
+            # Same order as the `mirror` command: blobs, the full manifest,
+            # then the redirect. Blobs can also be uploaded by other
+            # repositories, wait for those too.
+            await asyncio.gather(*blob_uploads)
+            # The upstream id index points at the blobs, see upload_manifests.
+            await asyncio.gather(
+                *[
+                    self.queue.submit(object_key(self.local_directory, path), path)
+                    for path in oid_index_paths(
+                        self.local_directory, files, plan.file_metadata
+                    )
+                ]
+            )
+            revisions = [repository_revision]
+            if repository_revision != original_repository_revision:
+                revisions.append(original_repository_revision)
+            for revision in revisions:
+                path = manifest_path_not_none(self.local_directory, revision)
+                await self.queue.submit(
+                    object_key(self.local_directory, path), path, overwrite=True
+                )
+        result.status = "mirrored"
+
+    async def run(
+        self,
+        original_repository_revision: RepositoryRevision,
+        resolved: Union[RepositoryRevision, Exception],
+    ) -> RepositoryResult:
+        result = RepositoryResult(
+            repository=original_repository_revision.repository,
+            revision=original_repository_revision.revision,
+        )
+        if isinstance(resolved, Exception):
+            result.error = f"Could not resolve: {type(resolved).__name__}: {resolved}"
+            return result
+        result.revision_hash = resolved.revision
+        started_at = time.monotonic()
+        try:
+            async with self.semaphore:
+                await self.mirror(original_repository_revision, resolved, result)
+        except Exception as e:
+            logging.exception(f"Mirroring {original_repository_revision} failed")
+            result.status = "failed"
+            result.error = f"{type(e).__name__}: {e}"
+        result.duration_seconds = round(time.monotonic() - started_at, 3)
+        return result
+
+    async def resolve(
+        self, repository_revision: RepositoryRevision
+    ) -> Union[RepositoryRevision, Exception]:
+        async with self.semaphore:
+            try:
+                return await asyncio.to_thread(
+                    normalize_repository_revision, repository_revision
+                )
+            except Exception as e:
+                return e
+
+
+async def bulk_mirror(
+    settings: Settings, repositories: list[RepositoryRevision]
+) -> Summary:
+    local_directory = settings.local_directory or tempfile.mkdtemp()
+    backend = (
+        create_backend(settings.upload_destination)
+        if settings.upload_destination and not settings.dry_run
+        else None
+    )
+    if backend is None:
+        return await _bulk_mirror(
+            BulkMirror(settings, local_directory, None), repositories
+        )
+    async with backend.session():
+        # Upload failures are reported per repository, not by the queue.
+        async with UploadQueue(
+            backend, settings.upload_concurrency, raise_errors=False
+        ) as queue:
+            return await _bulk_mirror(
+                BulkMirror(settings, local_directory, queue), repositories
+            )
+
+
+async def _bulk_mirror(
+    mirror: BulkMirror, repositories: list[RepositoryRevision]
+) -> Summary:
+    # All revisions are resolved before mirroring anything, so that the run
+    # mirrors the same point in time for every repository.
+    print(f"Resolving {len(repositories)} revisions...")
+    resolved = await asyncio.gather(*[mirror.resolve(r) for r in repositories])
+    results = await asyncio.gather(
+        *[mirror.run(r, hash) for r, hash in zip(repositories, resolved)]
+    )
+    return Summary(repositories=list(results))
+
+
+def main(settings: Settings) -> int:
+    repositories = load_repositories(settings.repositories_file)
+    summary = asyncio.run(bulk_mirror(settings, repositories))
+
+    summary_json = summary.model_dump_json(indent=2)
+    if settings.summary_file:
+        with open(settings.summary_file, "w") as f:
+            f.write(summary_json)
+    else:
+        print(summary_json)
+    failed = summary.failed()
+    print(
+        f"Mirrored {len(summary.repositories) - len(failed)} repositories, "
+        f"{len(failed)} failed."
+    )
+    return 1 if failed else 0
+
+
+def main_cli():
+    settings = Settings()  # pyright: ignore[reportCallIssue], pydantic-settings will initialize or throw
+    sys.exit(main(settings))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,130 @@
+import os
+
+import anyio
+
+from mirrorface.common.hub import RepositoryRevision
+from mirrorface.common.storage import FileMetadata, blob_path, load_full_manifest
+from mirrorface.tools.bulk_mirror import Settings, bulk_mirror, load_repositories
+
+COMMIT_A = "a" * 40
+COMMIT_B = "b" * 40
+
+
+def test_load_repositories(tmp_path):
+    text = tmp_path / "repositories.txt"
+    text.write_text(
+        "# Comment\nuser/a\n\nuser/b@v1.0  # Trailing comment\nuser/a@main\n"
+    )
+    assert load_repositories(str(text)) == [
+        RepositoryRevision(repository="user/a", revision="main"),
+        RepositoryRevision(repository="user/b", revision="v1.0"),
+    ]
+
+    yaml = tmp_path / "repositories.yaml"
+    yaml.write_text(
+        "- user/a\n- user/b@v1.0\n- repository: user/c\n- {repository: user/d, revision: dev}\n"
+    )
+    assert load_repositories(str(yaml)) == [
+        RepositoryRevision(repository="user/a", revision="main"),
+        RepositoryRevision(repository="user/b", revision="v1.0"),
+        RepositoryRevision(repository="user/c", revision="main"),
+        RepositoryRevision(repository="user/d", revision="dev"),
+    ]
+
+
+def test_bulk_mirror(tmp_path, monkeypatch):
+    shared = FileMetadata(size=6, blob_id="1" * 40, lfs_sha256="2" * 64)
+    upstream = {
+        "user/a": (
+            COMMIT_A,
+            {"model.bin": shared, "README.md": FileMetadata(size=1, blob_id="3" * 40)},
+        ),
+        "user/b": (COMMIT_B, {"model.bin": shared}),
+        "user/broken": (COMMIT_B, {"model.bin": FileMetadata(size=1)}),
+    }
+
+    def normalize_repository_revision(repository_revision):
+        if repository_revision.repository not in upstream:
+            raise ValueError("Repository not found")
+        commit, _ = upstream[repository_revision.repository]
+        return RepositoryRevision(
+            repository=repository_revision.repository, revision=commit
+        )
+
+    downloads = []
+
+    async def ingest_repository(
+        repository_revision, files, local_directory, scheduler, on_blob
+    ):
+        if repository_revision.repository == "user/broken":
+            raise ValueError("Download failed")
+        result = {}
+        for path, metadata in files.items():
+            # The real download is deduplicated by the scheduler.
+            file_hash = f"hash_{metadata.etag()}"
+            if file_hash not in downloads:
+                downloads.append(file_hash)
+                with open(blob_path(local_directory, file_hash), "w") as f:
+                    f.write("x" * metadata.size)
+            on_blob(file_hash)
+            result[path] = file_hash
+        return result
+
+    monkeypatch.setattr(
+        "mirrorface.tools.bulk_mirror.normalize_repository_revision",
+        normalize_repository_revision,
+    )
+    monkeypatch.setattr(
+        "mirrorface.tools.mirror.list_repository_files",
+        lambda repository_revision: upstream[repository_revision.repository][1],
+    )
+    monkeypatch.setattr(
+        "mirrorface.tools.bulk_mirror.ingest_repository", ingest_repository
+    )
+    local_directory = tmp_path / "local"
+    os.makedirs(local_directory / "blob")
+    bucket = tmp_path / "bucket"
+    settings = Settings.model_construct(
+        repositories_file="",
+        local_directory=str(local_directory),
+        upload_destination=str(bucket),
+        summary_file=None,
+        dry_run=False,
+        repository_concurrency=2,
+        download_concurrency=2,
+        download_max_bytes_per_second=None,
+        upload_concurrency=2,
+    )
+    repositories = [
+        RepositoryRevision(repository=r, revision="main")
+        for r in ["user/a", "user/missing", "user/b", "user/broken"]
+    ]
+    summary = anyio.run(bulk_mirror, settings, repositories)
+
+    results = {r.repository: r for r in summary.repositories}
+    assert list(results) == ["user/a", "user/missing", "user/b", "user/broken"]
+    assert results["user/a"].status == "mirrored"
+    assert results["user/a"].revision_hash == COMMIT_A
+    assert results["user/b"].status == "mirrored"
+    assert results["user/missing"].status == "failed"
+    assert results["user/missing"].error is not None
+    assert "Repository not found" in results["user/missing"].error
+    assert results["user/broken"].status == "failed"
+    assert results["user/broken"].error == "ValueError: Download failed"
+    assert [r.repository for r in summary.failed()] == ["user/missing", "user/broken"]
+
+    # The shared file was downloaded once.
+    assert sorted(downloads) == ["hash_" + "2" * 64, "hash_" + "3" * 40]
+    for repository, commit in [("user/a", COMMIT_A), ("user/b", COMMIT_B)]:
+        main = RepositoryRevision(repository=repository, revision="main")
+        manifest = load_full_manifest(str(bucket), main)
+        assert manifest is not None
+        assert manifest.revision_hash == commit
+        for file_hash in manifest.files.values():
+            assert os.path.exists(blob_path(str(bucket), file_hash))
+    assert (
+        load_full_manifest(
+            str(bucket), RepositoryRevision(repository="user/broken", revision="main")
+        )
+        is None
+    )
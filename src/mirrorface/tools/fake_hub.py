@@ -0,0 +1,442 @@
+# Local fake of the HuggingFace Hub, to test and benchmark without network.
+#
+# Usage:
+#
+#     uv run python -m mirrorface.tools.fake_hub --port=8081 --latency_seconds=0.05
+#
+# then point the server (MIRRORFACE_UPSTREAM_URL) or the mirror tool
+# (HF_ENDPOINT) at http://127.0.0.1:8081.
+#
+# Serves synthetic repositories with the endpoints MirrorFace and the
+# huggingface_hub client use:
+#
+#   /api/models/<repository>/refs                 branches and tags
+#   /api/models/<repository>[/revision/<rev>]     model info, ?blobs=true adds
+#                                                 sizes, blob ids and LFS info
+#   /<repository>/resolve/<revision>/<path>       file downloads (and HEAD)
+#
+# Like the real Hub, LFS files are answered with a 302 redirect to a separate
+# CDN host (another port). The redirect has X-Repo-Commit, X-Linked-Etag and
+# X-Linked-Size and the ETag of the LFS pointer, the CDN response only has
+# the content with its own ETag. Clients (and the proxy) have to combine the
+# headers of both. Range requests are supported on both.
+#
+# Shaping applies to every request: fixed latency, a bandwidth cap per
+# response, a fraction of requests failing with error_status, and a fraction
+# of resolve requests answered with 404. It can be changed while running.
+# All requests are recorded, so tests can check eg. that concurrent
+# downloads of the same file were coalesced into one upstream request.
+
+import asyncio
+import contextlib
+import hashlib
+import random
+import threading
+import time
+import urllib.parse
+from typing import AsyncIterator, Iterator, Optional
+
+from aiohttp import web
+from pydantic import BaseModel
+from pydantic_settings import BaseSettings
+
+from mirrorface.server.ranges import RangeNotSatisfiable, parse_range_header
+
+# Files at least this large are stored in LFS, like the Hub does for most
+# model weights.
+LFS_THRESHOLD_BYTES = 10 * 1024 * 1024
+WRITE_CHUNK_SIZE = 64 * 1024
+
+
+class FakeFile(BaseModel):
+    path: str
+    content: bytes
+    # Git blob of the file, or of the LFS pointer.
+    blob_id: str
+    # LFS files only.
+    lfs_sha256: Optional[str] = None
+    lfs_pointer_size: Optional[int] = None
+    # What the CDN returns as ETag, not the upstream identifier.
+    cdn_etag: Optional[str] = None
+
+    def sibling(self) -> dict:
+        sibling: dict = {
+            "rfilename": self.path,
+            "size": len(self.content),
+            "blobId": self.blob_id,
+        }
+        if self.lfs_sha256 is not None:
+            sibling["lfs"] = {
+                "size": len(self.content),
+                "sha256": self.lfs_sha256,
+                "pointerSize": self.lfs_pointer_size,
+            }
+        return sibling
+
+
+def git_blob_id(content: bytes) -> str:
+    return hashlib.sha1(b"blob %d\0" % len(content) + content).hexdigest()
+
+
+def fake_file(path: str, content: bytes, lfs: bool) -> FakeFile:
+    # Hashes are computed once here, not on every request.
+    if not lfs:
+        return FakeFile(path=path, content=content, blob_id=git_blob_id(content))
+    sha256 = hashlib.sha256(content).hexdigest()
+    pointer = (
+        "version https://git-lfs.github.com/spec/v1\n"
+        f"oid sha256:{sha256}\n"
+        f"size {len(content)}\n"
+    ).encode()
+    return FakeFile(
+        path=path,
+        content=content,
+        blob_id=git_blob_id(pointer),
+        lfs_sha256=sha256,
+        lfs_pointer_size=len(pointer),
+        cdn_etag=hashlib.md5(content).hexdigest(),
+    )
+
+
+class FakeRepository(BaseModel):
+    repository: str
+    # Commit hash of the only commit.
+    revision_hash: str
+    # Branch and tag names pointing to the commit.
+    branches: list[str] = ["main"]
+    tags: list[str] = []
+    files: dict[str, FakeFile]
+
+
+def synthetic_repository(
+    repository: str,
+    small_files: int = 3,
+    small_file_bytes: int = 1024,
+    large_files: int = 1,
+    large_file_bytes: int = 16 * 1024 * 1024,
+    seed: int = 0,
+) -> FakeRepository:
+    # Config-like small files and LFS weights, same content for the same seed.
+    rng = random.Random(f"{repository}:{seed}")
+    files = [
+        (f"config_{i}.json", rng.randbytes(small_file_bytes))
+        for i in range(small_files)
+    ]
+    files += [
+        (f"model-{i}.safetensors", rng.randbytes(large_file_bytes))
+        for i in range(large_files)
+    ]
+    return FakeRepository(
+        repository=repository,
+        revision_hash=rng.randbytes(20).hex(),
+        files={
+            path: fake_file(
+                path,
+                content,
+                lfs=path.endswith(".safetensors")
+                or len(content) >= LFS_THRESHOLD_BYTES,
+            )
+            for path, content in files
+        },
+    )
+
+
+class Shaping(BaseModel):
+    # Added to every request before it is answered.
+    latency_seconds: float = 0
+    # Per response body, unlimited if not set.
+    bytes_per_second: Optional[int] = None
+    # Fraction of requests answered with error_status.
+    error_rate: float = 0
+    error_status: int = 503
+    # Fraction of resolve requests for existing files answered with 404.
+    not_found_rate: float = 0
+
+
+class FakeHub:
+    def __init__(
+        self,
+        repositories: list[FakeRepository],
+        shaping: Optional[Shaping] = None,
+        seed: int = 0,
+    ):
+        self.repositories = {r.repository: r for r in repositories}
+        self.shaping = shaping or Shaping()
+        self.random = random.Random(seed)
+        # Method and path (with the query) of every request, hub and CDN.
+        self.requests: list[tuple[str, str]] = []
+        self.url = ""
+        self.cdn_url = ""
+        # By LFS SHA-256.
+        self._lfs_files = {
+            f.lfs_sha256: f
+            for r in repositories
+            for f in r.files.values()
+            if f.lfs_sha256 is not None
+        }
+
+    def hub_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._shape])
+        repository = "{repository:[^/]+/[^/]+}"
+        app.router.add_get(f"/api/models/{repository}/refs", self._refs)
+        app.router.add_get(f"/api/models/{repository}", self._model_info)
+        app.router.add_get(
+            f"/api/models/{repository}/revision/{{revision}}", self._model_info
+        )
+        app.router.add_route(
+            "*", f"/{repository}/resolve/{{revision}}/{{path:.+}}", self._resolve
+        )
+        return app
+
+    def cdn_app(self) -> web.Application:
+        app = web.Application(middlewares=[self._shape])
+        app.router.add_route("*", "/lfs/{sha256}", self._cdn)
+        return app
+
+    @contextlib.asynccontextmanager
+    async def serve(
+        self, host: str = "127.0.0.1", port: int = 0, cdn_port: int = 0
+    ) -> AsyncIterator["FakeHub"]:
+        # Port 0 picks a free one, see url and cdn_url.
+        runners = [
+            web.AppRunner(self.hub_app(), access_log=None),
+            web.AppRunner(self.cdn_app(), access_log=None),
+        ]
+        urls = []
+        try:
+            for runner, runner_port in zip(runners, [port, cdn_port]):
+                await runner.setup()
+                await web.TCPSite(runner, host, runner_port).start()
+                urls.append(f"http://{host}:{runner.addresses[-1][1]}")
+            self.url, self.cdn_url = urls
+            yield self
+        finally:
+            for runner in runners:
+                await runner.cleanup()
+
+    @contextlib.contextmanager
+    def run_in_thread(self, host: str = "127.0.0.1") -> Iterator["FakeHub"]:
+        # For synchronous code (eg. huggingface_hub), serves from a background
+        # thread with its own event loop.
+        started = threading.Event()
+        stop: Optional[asyncio.Event] = None
+        loop: Optional[asyncio.AbstractEventLoop] = None
+
+        async def run():
+            nonlocal stop, loop
+            stop = asyncio.Event()
+            loop = asyncio.get_running_loop()
+            async with self.serve(host):
+                started.set()
+                await stop.wait()
+
+        thread = threading.Thread(target=asyncio.run, args=(run(),), daemon=True)
+        thread.start()
+        started.wait()
+        try:
+            yield self
+        finally:
+            assert loop is not None and stop is not None
+            loop.call_soon_threadsafe(stop.set)
+            thread.join()
+
+    def _find(self, repository: str, revision: str) -> Optional[FakeRepository]:
+        r = self.repositories.get(repository)
+        if r is None:
+            return None
+        if revision in [r.revision_hash, *r.branches, *r.tags]:
+            return r
+        return None
+
+    @web.middleware
+    async def _shape(self, request: web.Request, handler) -> web.StreamResponse:
+        self.requests.append((request.method, request.path_qs))
+        if self.shaping.latency_seconds:
+            await asyncio.sleep(self.shaping.latency_seconds)
+        if self.random.random() < self.shaping.error_rate:
+            return web.Response(status=self.shaping.error_status, text="Injected error")
+        return await handler(request)
+
+    async def _refs(self, request: web.Request) -> web.StreamResponse:
+        r = self.repositories.get(request.match_info["repository"])
+        if r is None:
+            return error_response(404, "RepoNotFound")
+
+        def refs(names: list[str], prefix: str) -> list[dict]:
+            return [
+                {
+                    "name": name,
+                    "ref": f"{prefix}{name}",
+                    "targetCommit": r.revision_hash,
+                }
+                for name in names
+            ]
+
+        return web.json_response(
+            {
+                "branches": refs(r.branches, "refs/heads/"),
+                "tags": refs(r.tags, "refs/tags/"),
+                "converts": [],
+                "pullRequests": [],
+            }
+        )
+
+    async def _model_info(self, request: web.Request) -> web.StreamResponse:
+        revision = urllib.parse.unquote(request.match_info.get("revision", "main"))
+        r = self._find(request.match_info["repository"], revision)
+        if r is None:
+            return error_response(404, "RepoNotFound")
+        blobs = request.query.get("blobs", "").lower() == "true"
+        return web.json_response(
+            {
+                "_id": r.revision_hash[:24],
+                "id": r.repository,
+                "modelId": r.repository,
+                "sha": r.revision_hash,
+                "private": False,
+                "disabled": False,
+                "gated": False,
+                "tags": [],
+                "siblings": [
+                    f.sibling() if blobs else {"rfilename": f.path}
+                    for f in r.files.values()
+                ],
+            }
+        )
+
+    async def _resolve(self, request: web.Request) -> web.StreamResponse:
+        r = self._find(request.match_info["repository"], request.match_info["revision"])
+        if r is None:
+            return error_response(404, "RevisionNotFound")
+        f = r.files.get(request.match_info["path"])
+        if f is None or self.random.random() < self.shaping.not_found_rate:
+            return error_response(404, "EntryNotFound")
+        headers = {"X-Repo-Commit": r.revision_hash, "ETag": f'"{f.blob_id}"'}
+        if f.lfs_sha256 is not None:
+            headers.update(
+                {
+                    "Location": f"{self.cdn_url}/lfs/{f.lfs_sha256}",
+                    "X-Linked-Etag": f'"{f.lfs_sha256}"',
+                    "X-Linked-Size": str(len(f.content)),
+                }
+            )
+            return web.Response(status=302, headers=headers, text="Found")
+        return await self._send(request, f.content, headers)
+
+    async def _cdn(self, request: web.Request) -> web.StreamResponse:
+        f = self._lfs_files.get(request.match_info["sha256"])
+        if f is None:
+            return web.Response(status=403, text="AccessDenied")
+        return await self._send(request, f.content, {"ETag": f'"{f.cdn_etag}"'})
+
+    async def _send(
+        self, request: web.Request, content: bytes, headers: dict[str, str]
+    ) -> web.StreamResponse:
+        headers = {
+            **headers,
+            "Accept-Ranges": "bytes",
+            "Content-Type": "application/octet-stream",
+        }
+        status = 200
+        start, end = 0, len(content)
+        range_header = request.headers.get("Range")
+        if range_header is not None:
+            try:
+                ranges = parse_range_header(range_header, len(content))
+            except RangeNotSatisfiable:
+                headers["Content-Range"] = f"bytes */{len(content)}"
+                return web.Response(status=416, headers=headers)
+            if ranges is not None and len(ranges) == 1:
+                status = 206
+                start, end = ranges[0]
+                headers["Content-Range"] = f"bytes {start}-{end - 1}/{len(content)}"
+
+        response = web.StreamResponse(status=status, headers=headers)
+        response.content_length = end - start
+        await response.prepare(request)
+        if request.method == "HEAD":
+            return response
+        started_at = time.monotonic()
+        for offset in range(start, end, WRITE_CHUNK_SIZE):
+            chunk = content[offset : min(offset + WRITE_CHUNK_SIZE, end)]
+            await response.write(chunk)
+            if self.shaping.bytes_per_second:
+                # Sleep until the bytes sent so far are within the cap.
+                sent = offset + len(chunk) - start
+                delay = sent / self.shaping.bytes_per_second - (
+                    time.monotonic() - started_at
+                )
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        await response.write_eof()
+        return response
+
+
+def error_response(status: int, error_code: str) -> web.Response:
+    # huggingface_hub raises specific exceptions based on X-Error-Code.
+    return web.Response(
+        status=status, headers={"X-Error-Code": error_code}, text=error_code
+    )
+
+
+class Settings(BaseSettings, cli_parse_args=True):
+    host: str = "127.0.0.1"
+    port: int = 8081
+    cdn_port: int = 8082
+
+    # Synthetic repositories, all with the same layout.
+    repositories: list[str] = ["fake/tiny-model"]
+    small_files: int = 3
+    small_file_bytes: int = 1024
+    large_files: int = 1
+    large_file_mb: int = 16
+
+    latency_seconds: float = 0
+    bytes_per_second: Optional[int] = None
+    error_rate: float = 0
+    error_status: int = 503
+    not_found_rate: float = 0
+    # For the generated content and the injected failures.
+    seed: int = 0
+
+
+def create_hub(settings: Settings) -> FakeHub:
+    return FakeHub(
+        [
+            synthetic_repository(
+                repository,
+                small_files=settings.small_files,
+                small_file_bytes=settings.small_file_bytes,
+                large_files=settings.large_files,
+                large_file_bytes=settings.large_file_mb * 1024 * 1024,
+                seed=settings.seed,
+            )
+            for repository in settings.repositories
+        ],
+        Shaping(
+            latency_seconds=settings.latency_seconds,
+            bytes_per_second=settings.bytes_per_second,
+            error_rate=settings.error_rate,
+            error_status=settings.error_status,
+            not_found_rate=settings.not_found_rate,
+        ),
+        seed=settings.seed,
+    )
+
+
+async def serve_forever(settings: Settings):
+    hub = create_hub(settings)
+    async with hub.serve(settings.host, settings.port, settings.cdn_port):
+        for r in hub.repositories.values():
+            print(f"Serving {r.repository}@{r.revision_hash} ({len(r.files)} files)")
+        print(f"Hub at {hub.url}, CDN at {hub.cdn_url}", flush=True)
+        await asyncio.Event().wait()
+
+
+def main(settings: Settings):
+    with contextlib.suppress(KeyboardInterrupt):
+        asyncio.run(serve_forever(settings))
+
+
+if __name__ == "__main__":
+    main(Settings())  # pyright: ignore[reportCallIssue], pydantic-settings will initialize or throw
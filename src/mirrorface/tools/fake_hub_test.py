@@ -0,0 +1,119 @@
+import time
+
+import aiohttp
+import anyio
+import huggingface_hub
+import pytest
+from huggingface_hub.errors import EntryNotFoundError
+
+from mirrorface.common.storage import FileMetadata
+from mirrorface.tools.fake_hub import FakeHub, Shaping, synthetic_repository
+from mirrorface.tools.ingest import DownloadScheduler, ingest_files
+
+REPOSITORY = "fake/model"
+
+
+def create_hub(**shaping) -> FakeHub:
+    repository = synthetic_repository(
+        REPOSITORY, small_files=2, large_files=1, large_file_bytes=300_000
+    )
+    return FakeHub([repository], Shaping(**shaping))
+
+
+def test_fake_hub_huggingface_client(tmp_path):
+    hub = create_hub()
+    repository = hub.repositories[REPOSITORY]
+    with hub.run_in_thread():
+        api = huggingface_hub.HfApi(endpoint=hub.url)
+        refs = api.list_repo_refs(REPOSITORY)
+        assert [(b.name, b.target_commit) for b in refs.branches] == [
+            ("main", repository.revision_hash)
+        ]
+
+        info = api.model_info(REPOSITORY, revision="main", files_metadata=True)
+        assert info.sha == repository.revision_hash
+        siblings = {s.rfilename: s for s in info.siblings or []}
+        assert sorted(siblings) == sorted(repository.files)
+        model = siblings["model-0.safetensors"]
+        assert model.size == 300_000 and model.lfs is not None
+
+        # The client verifies the headers, LFS files go through the CDN.
+        for path, f in repository.files.items():
+            downloaded = huggingface_hub.hf_hub_download(
+                REPOSITORY, path, endpoint=hub.url, cache_dir=str(tmp_path)
+            )
+            with open(downloaded, "rb") as file:
+                assert file.read() == f.content
+        assert any(path.startswith("/lfs/") for _, path in hub.requests)
+
+        with pytest.raises(EntryNotFoundError):
+            huggingface_hub.hf_hub_download(
+                REPOSITORY, "missing.json", endpoint=hub.url, cache_dir=str(tmp_path)
+            )
+
+
+def test_fake_hub_ingest(tmp_path):
+    # Hashes match what the mirror tool verifies against.
+    hub = create_hub()
+    repository = hub.repositories[REPOSITORY]
+    files = {
+        path: FileMetadata(
+            size=len(f.content),
+            blob_id=f.blob_id,
+            lfs_sha256=f.lfs_sha256,
+            lfs_pointer_size=f.lfs_pointer_size,
+        )
+        for path, f in repository.files.items()
+    }
+
+    async def run():
+        async with hub.serve():
+            async with aiohttp.ClientSession() as session:
+                return await ingest_files(
+                    session,
+                    files,
+                    lambda path: f"{hub.url}/{REPOSITORY}/resolve/"
+                    f"{repository.revision_hash}/{path}",
+                    str(tmp_path),
+                    DownloadScheduler(concurrency=2),
+                )
+
+    result = anyio.run(run)
+    assert sorted(result) == sorted(repository.files)
+
+
+def test_fake_hub_shaping():
+    hub = create_hub()
+    repository = hub.repositories[REPOSITORY]
+    model = repository.files["model-0.safetensors"]
+
+    async def get(path: str, headers=None):
+        async with aiohttp.ClientSession() as session:
+            async with session.get(f"{hub.url}/{path}", headers=headers) as r:
+                return r.status, r.headers.copy(), await r.read()
+
+    async def run():
+        async with hub.serve():
+            model_path = f"{REPOSITORY}/resolve/main/model-0.safetensors"
+            status, headers, body = await get(model_path, {"Range": "bytes=10-19"})
+            assert status == 206 and body == model.content[10:20]
+            # The CDN response has its own ETag and no commit, the proxy takes
+            # those from the redirect.
+            assert headers["ETag"] == f'"{model.cdn_etag}"'
+            assert "X-Repo-Commit" not in headers
+
+            hub.shaping = Shaping(bytes_per_second=1_000_000)
+            started_at = time.monotonic()
+            status, _, body = await get(model_path)
+            assert status == 200 and body == model.content
+            assert time.monotonic() - started_at >= 0.25
+
+            hub.shaping = Shaping(not_found_rate=1)
+            status, headers, _ = await get(f"{REPOSITORY}/resolve/main/config_0.json")
+            assert status == 404 and headers["X-Error-Code"] == "EntryNotFound"
+
+            hub.shaping = Shaping(error_rate=1, error_status=502)
+            status, _, _ = await get(f"api/models/{REPOSITORY}/refs")
+            assert status == 502
+
+    anyio.run(run)
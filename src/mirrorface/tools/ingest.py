@@ -0,0 +1,291 @@
+# Streaming ingestion of a repository from the Hub.
+#
+# Instead of downloading a snapshot and then reading every file again to hash
+# it, each file is hashed while it is downloaded and written directly into the
+# blob directory. Several files are downloaded at a time, and every blob is
+# handed to the caller (eg. to upload it) as soon as it is complete, so
+# download, hashing and upload of different files overlap. Limits on
+# concurrency and bandwidth can be shared between several repositories.
+#
+# Downloads are verified against the upstream metadata: the size, and the
+# SHA-256 for LFS files or the git blob SHA-1 for the others.
+
+import asyncio
+import hashlib
+import itertools
+import logging
+import os
+import time
+from typing import Callable, Optional
+
+import aiohttp
+import huggingface_hub
+
+from mirrorface.common.hub import RepositoryRevision
+from mirrorface.common.storage import (
+    INGEST_DIRECTORY,
+    FileMetadata,
+    blob_hasher,
+    publish_blob,
+)
+
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+DOWNLOAD_ATTEMPTS = 3
+# Grows with every failed attempt.
+RETRY_DELAY_SECONDS = 1.0
+
+
+class DownloadError(Exception):
+    pass
+
+
+def list_repository_files(
+    repository_revision: RepositoryRevision,
+) -> dict[str, FileMetadata]:
+    # Files of the repository with their upstream metadata.
+    info = huggingface_hub.model_info(
+        repository_revision.repository,
+        revision=repository_revision.revision,
+        files_metadata=True,
+    )
+    files = {}
+    for sibling in info.siblings or []:
+        if sibling.size is None:
+            raise ValueError(f"No size for {sibling.rfilename}")
+        files[sibling.rfilename] = FileMetadata(
+            size=sibling.size,
+            blob_id=sibling.blob_id,
+            lfs_sha256=sibling.lfs.sha256 if sibling.lfs else None,
+            lfs_pointer_size=sibling.lfs.pointer_size if sibling.lfs else None,
+        )
+    return files
+
+
+class DownloadProgress:
+    """Prints download progress as files complete."""
+
+    def __init__(self, files: dict[str, FileMetadata]):
+        self.total_files = len(files)
+        self.total_bytes = sum(m.size for m in files.values())
+        self.files = 0
+        self.bytes = 0
+        self.started_at = time.monotonic()
+
+    def file_done(self, path: str, size: int):
+        self.files += 1
+        self.bytes += size
+        elapsed = time.monotonic() - self.started_at
+        throughput = self.bytes / elapsed if elapsed > 0 else 0
+        print(
+            f"Downloaded {self.files}/{self.total_files} files, "
+            f"{self.bytes / 2**30:.2f}/{self.total_bytes / 2**30:.2f} GiB, "
+            f"{throughput / 2**20:.1f} MiB/s: {path}"
+        )
+
+
+class HashingWriter:
+    """Writes a file while computing the blob hash and the upstream hash."""
+
+    def __init__(self, path: str, metadata: FileMetadata):
+        self.file = open(path, "wb")
+        self.size = 0
+        self.blob_hash = blob_hasher()
+        if metadata.lfs_sha256 is not None:
+            self.upstream_hash = hashlib.sha256()
+            self.expected_upstream_hash = metadata.lfs_sha256
+        else:
+            # Git blob id, hash of a header followed by the contents.
+            self.upstream_hash = hashlib.sha1(f"blob {metadata.size}\0".encode())
+            self.expected_upstream_hash = metadata.blob_id
+
+    def write(self, chunk: bytes):
+        self.file.write(chunk)
+        self.blob_hash.update(chunk)
+        self.upstream_hash.update(chunk)
+        self.size += len(chunk)
+
+    def close(self):
+        self.file.close()
+
+    def verify(self, path: str, metadata: FileMetadata):
+        if self.size != metadata.size:
+            raise DownloadError(f"Size mismatch for {path}: {self.size}")
+        if self.expected_upstream_hash is None:
+            return
+        if self.upstream_hash.hexdigest() != self.expected_upstream_hash:
+            raise DownloadError(f"Hash mismatch for {path}")
+
+
+class RateLimiter:
+    """Limits the combined throughput of concurrent transfers."""
+
+    def __init__(self, bytes_per_second: int):
+        self.bytes_per_second = bytes_per_second
+        self._next_free = time.monotonic()
+
+    async def consume(self, size: int):
+        # Called after transferring size bytes, waits until the transfer would
+        # have finished at the allowed rate.
+        now = time.monotonic()
+        self._next_free = max(self._next_free, now) + size / self.bytes_per_second
+        await asyncio.sleep(self._next_free - now)
+
+
+class DownloadScheduler:
+    """Download limits and deduplication, shared by all downloads of a run.
+
+    Files with the same upstream id (also in different repositories) are
+    only downloaded once, by whichever download starts first.
+    """
+
+    def __init__(self, concurrency: int, max_bytes_per_second: Optional[int] = None):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rate_limiter = (
+            RateLimiter(max_bytes_per_second) if max_bytes_per_second else None
+        )
+        # Upstream id to the download of the blob, resolving to its hash.
+        self.downloads: dict[str, asyncio.Task[str]] = {}
+        self._temp_names = itertools.count()
+
+    def temp_name(self) -> str:
+        return f".download-{os.getpid()}-{next(self._temp_names)}"
+
+
+async def download_file(
+    session: aiohttp.ClientSession,
+    url: str,
+    path: str,
+    metadata: FileMetadata,
+    temp_path: str,
+    rate_limiter: Optional[RateLimiter] = None,
+) -> str:
+    # Downloads into temp_path, verifies it and returns the blob hash.
+    writer = HashingWriter(temp_path, metadata)
+    try:
+        async with session.get(url) as response:
+            response.raise_for_status()
+            async for chunk in response.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                await asyncio.to_thread(writer.write, chunk)
+                if rate_limiter is not None:
+                    await rate_limiter.consume(len(chunk))
+    finally:
+        writer.close()
+    writer.verify(path, metadata)
+    return writer.blob_hash.hexdigest()
+
+
+async def download_file_with_retries(
+    session: aiohttp.ClientSession,
+    url: str,
+    path: str,
+    metadata: FileMetadata,
+    temp_path: str,
+    rate_limiter: Optional[RateLimiter] = None,
+) -> str:
+    for attempt in range(1, DOWNLOAD_ATTEMPTS):
+        try:
+            return await download_file(
+                session, url, path, metadata, temp_path, rate_limiter
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError, DownloadError):
+            logging.warning(f"Download of {path} failed, retrying", exc_info=True)
+            await asyncio.sleep(attempt * RETRY_DELAY_SECONDS)
+    return await download_file(session, url, path, metadata, temp_path, rate_limiter)
+
+
+async def ingest_files(
+    session: aiohttp.ClientSession,
+    files: dict[str, FileMetadata],
+    url_for: Callable[[str], str],
+    local_directory: str,
+    scheduler: DownloadScheduler,
+    on_blob: Optional[Callable[[str], None]] = None,
+) -> dict[str, str]:
+    # Downloads the files into local_directory/blob and returns the mapping
+    # from path to blob hash. on_blob is called once for every blob of these
+    # files as soon as it is in place, including blobs that were downloaded
+    # for another call sharing the scheduler.
+    ingest_directory = os.path.join(local_directory, INGEST_DIRECTORY)
+    os.makedirs(ingest_directory, exist_ok=True)
+    progress = DownloadProgress(files)
+    seen_blobs: set[str] = set()
+
+    async def download(path: str, metadata: FileMetadata) -> str:
+        temp_path = os.path.join(ingest_directory, scheduler.temp_name())
+        try:
+            async with scheduler.semaphore:
+                blob_hash = await download_file_with_retries(
+                    session,
+                    url_for(path),
+                    path,
+                    metadata,
+                    temp_path,
+                    scheduler.rate_limiter,
+                )
+                await asyncio.to_thread(
+                    publish_blob, local_directory, temp_path, blob_hash
+                )
+            progress.file_done(path, metadata.size)
+            return blob_hash
+        finally:
+            # Leftovers of a failed download.
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    async def ingest(path: str) -> str:
+        metadata = files[path]
+        oid = metadata.etag()
+        if oid is None:
+            blob_hash = await download(path, metadata)
+        else:
+            task = scheduler.downloads.get(oid)
+            if task is None:
+                task = asyncio.create_task(download(path, metadata))
+                scheduler.downloads[oid] = task
+            try:
+                blob_hash = await asyncio.shield(task)
+            except BaseException:
+                # Let a later caller try again.
+                if scheduler.downloads.get(oid) is task:
+                    del scheduler.downloads[oid]
+                raise
+        if blob_hash not in seen_blobs:
+            seen_blobs.add(blob_hash)
+            if on_blob is not None:
+                on_blob(blob_hash)
+        return blob_hash
+
+    paths = sorted(files)
+    results = await asyncio.gather(
+        *[ingest(path) for path in paths], return_exceptions=True
+    )
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        raise DownloadError(f"{len(errors)} downloads failed") from errors[0]
+    return {path: str(blob_hash) for path, blob_hash in zip(paths, results)}
+
+
+async def ingest_repository(
+    repository_revision: RepositoryRevision,
+    files: dict[str, FileMetadata],
+    local_directory: str,
+    scheduler: DownloadScheduler,
+    on_blob: Optional[Callable[[str], None]] = None,
+) -> dict[str, str]:
+    # Downloads the given files (with their upstream metadata, from
+    # list_repository_files) of the repository and returns the mapping from
+    # path to blob hash. The revision must be a commit hash.
+    def url_for(path: str) -> str:
+        return huggingface_hub.hf_hub_url(
+            repository_revision.repository, path, revision=repository_revision.revision
+        )
+
+    # Same auth token (if any) as the Hub client library.
+    token = huggingface_hub.get_token()
+    async with aiohttp.ClientSession(
+        headers={"Authorization": f"Bearer {token}"} if token else None,
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300),
+    ) as session:
+        return await ingest_files(
+            session, files, url_for, local_directory, scheduler, on_blob
+        )
@@ -0,0 +1,99 @@
+import hashlib
+import os
+
+import aiohttp
+import anyio
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from mirrorface.common.storage import INGEST_DIRECTORY, FileMetadata, blob_path
+from mirrorface.tools.ingest import DownloadError, DownloadScheduler, ingest_files
+
+
+def git_blob_id(data: bytes) -> str:
+    return hashlib.sha1(f"blob {len(data)}\0".encode() + data).hexdigest()
+
+
+def blob_hash(data: bytes) -> str:
+    return hashlib.sha512(data).hexdigest()
+
+
+def run_ingest(tmp_path, contents, files, fail_first=(), on_blob=None):
+    requests: list[str] = []
+
+    async def handler(request: web.Request) -> web.Response:
+        path = request.match_info["path"]
+        requests.append(path)
+        if path in fail_first and requests.count(path) == 1:
+            # Truncated response, fails verification.
+            return web.Response(body=contents[path][:-1])
+        return web.Response(body=contents[path])
+
+    async def run():
+        app = web.Application()
+        app.router.add_get("/{path:.*}", handler)
+        async with TestServer(app) as server:
+            async with aiohttp.ClientSession() as session:
+                return await ingest_files(
+                    session,
+                    files,
+                    lambda path: str(server.make_url(f"/{path}")),
+                    str(tmp_path),
+                    DownloadScheduler(concurrency=2),
+                    on_blob=on_blob,
+                )
+
+    return anyio.run(run), requests
+
+
+def test_ingest_files(tmp_path, monkeypatch):
+    # No waiting between retries.
+    monkeypatch.setattr("mirrorface.tools.ingest.RETRY_DELAY_SECONDS", 0)
+    contents = {
+        "config.json": b'{"a": 1}',
+        "model.bin": os.urandom(100_000),
+        "copy.json": b'{"a": 1}',
+    }
+    files = {
+        "config.json": FileMetadata(
+            size=8, blob_id=git_blob_id(contents["config.json"])
+        ),
+        "copy.json": FileMetadata(size=8, blob_id=git_blob_id(contents["copy.json"])),
+        "model.bin": FileMetadata(
+            size=100_000,
+            blob_id="0" * 40,
+            lfs_sha256=hashlib.sha256(contents["model.bin"]).hexdigest(),
+        ),
+    }
+    blobs = []
+    result, requests = run_ingest(
+        tmp_path, contents, files, fail_first=["model.bin"], on_blob=blobs.append
+    )
+
+    assert result == {path: blob_hash(data) for path, data in contents.items()}
+    # Retried after the failed verification.
+    assert requests.count("model.bin") == 2
+    # Same upstream id, only downloaded once.
+    assert requests.count("config.json") + requests.count("copy.json") == 1
+    # Once per distinct blob.
+    assert sorted(blobs) == sorted(set(result.values()))
+    for path, data in contents.items():
+        with open(blob_path(str(tmp_path), result[path]), "rb") as f:
+            assert f.read() == data
+    assert os.listdir(tmp_path / INGEST_DIRECTORY) == []
+
+
+def test_ingest_files_mismatch(tmp_path, monkeypatch):
+    monkeypatch.setattr("mirrorface.tools.ingest.RETRY_DELAY_SECONDS", 0)
+    contents = {"good.json": b"good", "bad.json": b"bad"}
+    files = {
+        "good.json": FileMetadata(size=4, blob_id=git_blob_id(b"good")),
+        "bad.json": FileMetadata(size=3, blob_id=git_blob_id(b"not bad")),
+    }
+    with pytest.raises(DownloadError, match="1 downloads failed"):
+        run_ingest(tmp_path, contents, files)
+    # The good file is still stored, nothing is left behind for the bad one.
+    assert os.path.exists(blob_path(str(tmp_path), blob_hash(b"good")))
+    assert not os.path.exists(blob_path(str(tmp_path), blob_hash(b"bad")))
+    assert os.listdir(tmp_path / INGEST_DIRECTORY) == []
@@ -14,25 +14,70 @@
 # not set a temporary directory will be used. This mostly makes sense when
 # using gcs_bucket and don't care about the local files.
 #
-# When setting `gcs_bucket` you must have the `gcloud` CLI tool installed
+# Instead of `gcs_bucket` you can set `upload_destination` to upload to
+# gs://bucket, s3://bucket (credentials from the AWS_* environment variables)
+# or a local directory, optionally with a prefix (eg. gs://bucket/prefix).
+#
+# Set `pack_max_file_bytes` to also write a pack of the files up to that
+# size (config, tokenizer and similar files), which the server can read all
+# at once instead of opening every small blob separately.
+#
+# Set `chunk_min_file_bytes` to store the files of at least that size as
+# content-defined chunks instead of whole blobs. Revisions that change only
+# part of a large file then share the chunks of the rest, only the changed
+# chunks are uploaded. The dedup ratio is printed.
+#
+# Files whose contents are already stored are not downloaded again: found
+# through the upstream id index (oid/) in local_directory, or, for a temporary
+# local_directory, in the upload destination, where the index is uploaded
+# along with the manifests.
+#
+# When uploading to GCS you must have the `gcloud` CLI tool installed
 # and authenticated so it has write access to the bucket.
 
 
+import asyncio
+import functools
+import glob
 import os
-import subprocess
 import tempfile
+import threading
 from typing import Optional
 
 import huggingface_hub
-from pydantic import Field
+from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings
 
+from mirrorface.common.chunking import AVERAGE_CHUNK_BYTES
 from mirrorface.common.hub import RepositoryRevision
 from mirrorface.common.storage import (
+    ChunkList,
+    FileMetadata,
+    Pack,
     blob_path,
+    chunk_list_path,
+    find_stored_blob,
+    load_full_manifest,
+    local_file_metadata,
     manifest_path,
     move_local_blobs,
+    oid_index_path,
+    oid_index_paths,
+    snapshot_files,
+    write_chunks,
     write_local_manifests,
+    write_pack,
+)
+from mirrorface.tools.ingest import (
+    DownloadScheduler,
+    ingest_repository,
+    list_repository_files,
+)
+from mirrorface.tools.upload.engine import (
+    UploadBackend,
+    UploadQueue,
+    create_backend,
+    upload_files,
 )
 
 
@@ -41,7 +86,33 @@ class Settings(BaseSettings, cli_parse_args=True):
     revision: str = Field(default="main")
 
     local_directory: Optional[str] = None
+    # Where to upload the mirrored files: gs://bucket[/prefix],
+    # s3://bucket[/prefix] or a local directory. gcs_bucket is a shorthand
+    # for gs://gcs_bucket.
+    upload_destination: Optional[str] = None
     gcs_bucket: Optional[str] = None
+    # Number of concurrent uploads.
+    upload_concurrency: int = 16
+
+    # Only print what would be downloaded.
+    dry_run: bool = False
+
+    # Download, hash and upload files in a single pass, without a snapshot
+    # copy on disk. Set to false to download a snapshot and hash it after.
+    streaming: bool = True
+    # Number of concurrent downloads when streaming.
+    download_concurrency: int = 8
+
+    # Threads hashing the downloaded snapshot, defaults to the number of CPUs.
+    hash_workers: Optional[int] = None
+    hash_read_size: int = 8 * 1024 * 1024
+
+    # Also write a pack of the files up to this size, not written if not set.
+    pack_max_file_bytes: Optional[int] = None
+    # Store the files of at least this size as chunks, not chunked if not set.
+    chunk_min_file_bytes: Optional[int] = None
+    # Average size of the chunks, a power of two.
+    chunk_average_bytes: int = AVERAGE_CHUNK_BYTES
 
 
 def normalize_repository_revision(
@@ -68,7 +139,9 @@ def normalize_repository_revision(
     return repository_revision
 
 
-def download_repo(repository_revision: RepositoryRevision) -> str:
+def download_repo(
+    repository_revision: RepositoryRevision, paths: Optional[list[str]] = None
+) -> str:
     # Create temporary target directory.
     target_dir = tempfile.mkdtemp()
     print(f"Downloading {repository_revision} to {target_dir}...")
@@ -76,70 +149,571 @@ def download_repo(repository_revision: RepositoryRevision) -> str:
         repo_id=repository_revision.repository,
         revision=repository_revision.revision,
         local_dir=target_dir,
+        # Patterns are fnmatch-style, escape them to match only these paths.
+        allow_patterns=None if paths is None else [glob.escape(p) for p in paths],
     )
     print("Download complete.")
     return target_dir
 
 
-# Note: Using `gcloud storage cp` via subprocess rather than the Python client
-# library because that one doesn't have a progress bar which is useful for the
-# large files.
-def upload_many_files_to_gcs(files: list[str], gcs_target_directory: str):
-    # Don't do too many at once, to avoid long command lines.
-    FILES_PER_BATCH = 20
-    for i in range(0, len(files), FILES_PER_BATCH):
-        batch = files[i : i + FILES_PER_BATCH]
-        print(f"Uploading {i}..{i + len(batch)} / {len(files)}:")
-        subprocess.run(
-            [
-                "gcloud",
-                "storage",
-                "cp",
-                # Content-addressed, if it exists it is the same, don't overwrite.
-                "--no-clobber",
-            ]
-            + batch
-            + [gcs_target_directory],
+class MirrorPlan(BaseModel):
+    # Upstream metadata of every file in the revision.
+    file_metadata: dict[str, FileMetadata]
+    # Files whose contents we already have as blobs, path to blob hash.
+    stored_files: dict[str, str]
+    # Stored blobs that are only in the upload destination, not in the local
+    # directory. They are not uploaded, packed or chunked again.
+    destination_blobs: list[str] = []
+    # Of those, the ones stored as chunks.
+    destination_chunked_blobs: list[str] = []
+
+    def missing_files(self) -> dict[str, FileMetadata]:
+        return {
+            path: metadata
+            for path, metadata in self.file_metadata.items()
+            if path not in self.stored_files
+        }
+
+    def local_files(self, downloaded_files: dict[str, str]) -> dict[str, str]:
+        # Files whose blobs are in the local directory.
+        destination_blobs = set(self.destination_blobs)
+        return {
+            path: file_hash
+            for path, file_hash in {**self.stored_files, **downloaded_files}.items()
+            if file_hash not in destination_blobs
+        }
+
+    def download_bytes(self) -> int:
+        return sum(metadata.size for metadata in self.missing_files().values())
+
+
+def plan_mirror(
+    repository_revision: RepositoryRevision, local_directory: str
+) -> MirrorPlan:
+    # Only files we don't have are downloaded, eg. when mirroring a new commit
+    # where only a few files changed. Relies on the upstream id index, which
+    # is only there if local_directory is kept between runs, see
+    # find_destination_blobs otherwise.
+    file_metadata = list_repository_files(repository_revision)
+    stored_files = {}
+    for path, metadata in file_metadata.items():
+        file_hash = find_stored_blob(local_directory, metadata)
+        if file_hash is not None:
+            stored_files[path] = file_hash
+    plan = MirrorPlan(file_metadata=file_metadata, stored_files=stored_files)
+    print(
+        f"{len(file_metadata)} files, {len(stored_files)} already stored, "
+        f"{len(plan.missing_files())} to download: "
+        f"{plan.download_bytes()} bytes ({plan.download_bytes() / 2**30:.2f} GiB)."
+    )
+    return plan
+
+
+async def find_destination_blobs(
+    backend: UploadBackend,
+    concurrency: int,
+    local_directory: str,
+    plan: MirrorPlan,
+    pack_max_file_bytes: Optional[int] = None,
+):
+    # Adds the missing files that are stored in the upload destination to the
+    # plan, eg. when local_directory is temporary. Uses the upstream id index
+    # in the destination, which is uploaded after the blobs it points at.
+    # Files that go into the pack are small, they are downloaded again to
+    # write it. Call within backend.session().
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def find(oid: str) -> Optional[tuple[str, bool]]:
+        # Blob hash, and whether it is stored as chunks.
+        async with semaphore:
+            entry = await backend.read(
+                object_key(local_directory, oid_index_path(local_directory, oid))
+            )
+            if entry is None:
+                return None
+            file_hash = entry.decode().strip()
+            for path, chunked in [
+                (blob_path(local_directory, file_hash), False),
+                (chunk_list_path(local_directory, file_hash), True),
+            ]:
+                if await backend.exists(object_key(local_directory, path)):
+                    return file_hash, chunked
+            return None
+
+    oids = {
+        path: metadata.etag()
+        for path, metadata in plan.missing_files().items()
+        if pack_max_file_bytes is None or metadata.size > pack_max_file_bytes
+    }
+    unique_oids = sorted({oid for oid in oids.values() if oid is not None})
+    found = dict(
+        zip(unique_oids, await asyncio.gather(*[find(oid) for oid in unique_oids]))
+    )
+    destination_blobs = set()
+    chunked_blobs = set()
+    for path, oid in oids.items():
+        stored = found.get(oid) if oid is not None else None
+        if stored is None:
+            continue
+        file_hash, chunked = stored
+        plan.stored_files[path] = file_hash
+        if not os.path.exists(blob_path(local_directory, file_hash)):
+            destination_blobs.add(file_hash)
+            if chunked:
+                chunked_blobs.add(file_hash)
+    plan.destination_blobs = sorted(set(plan.destination_blobs) | destination_blobs)
+    plan.destination_chunked_blobs = sorted(
+        set(plan.destination_chunked_blobs) | chunked_blobs
+    )
+    print(
+        f"{len(plan.stored_files)} files stored locally or in the upload "
+        f"destination, {len(plan.missing_files())} to download: "
+        f"{plan.download_bytes()} bytes ({plan.download_bytes() / 2**30:.2f} GiB)."
+    )
+
+
+class HashProgress:
+    """Prints hashing progress, called from multiple threads."""
+
+    def __init__(self, local_snapshot: str):
+        relative_paths = snapshot_files(local_snapshot)
+        self.total_files = len(relative_paths)
+        self.total_bytes = sum(
+            os.path.getsize(os.path.join(local_snapshot, path))
+            for path in relative_paths
+        )
+        self.files = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, relative_path: str, size: int):
+        with self.lock:
+            self.files += 1
+            self.bytes += size
+            print(
+                f"Hashed {self.files}/{self.total_files} files, "
+                f"{self.bytes / 2**30:.2f}/{self.total_bytes / 2**30:.2f} GiB: {relative_path}"
+            )
+
+
+def manifest_path_not_none(
+    storage_root: str, repository_revision: RepositoryRevision
+) -> str:
+    s = manifest_path(storage_root, repository_revision)
+    assert s is not None
+    return s
+
+
+def object_key(local_directory: str, path: str) -> str:
+    # Same layout in the object store as in the local directory.
+    return os.path.relpath(path, local_directory)
+
+
+def pack_small_files(
+    pack_max_file_bytes: Optional[int],
+    local_directory: str,
+    files: dict[str, str],
+    file_metadata: dict[str, FileMetadata],
+) -> Optional[Pack]:
+    if pack_max_file_bytes is None:
+        return None
+    pack = write_pack(local_directory, files, file_metadata, pack_max_file_bytes)
+    if pack is not None:
+        print(f"Packed {len(pack.entries)} small files into {pack.blob_hash}")
+    return pack
+
+
+def keep_for_pack(pack_max_file_bytes: Optional[int], path: str) -> bool:
+    # Whether a blob must stay on local disk after it is uploaded, because
+    # it will be packed once all files are downloaded.
+    return (
+        pack_max_file_bytes is not None and os.path.getsize(path) <= pack_max_file_bytes
+    )
+
+
+class Chunking(BaseModel):
+    # Chunk lists of the chunked blobs, by blob hash.
+    chunk_lists: dict[str, ChunkList]
+    # Bytes of the chunks that were not in the local directory before.
+    new_bytes: int
+
+    def chunk_hashes(self) -> set[str]:
+        return {
+            chunk.blob_hash
+            for chunk_list in self.chunk_lists.values()
+            for chunk in chunk_list.chunks
+        }
+
+    def report(self) -> str:
+        total_bytes = sum(chunk_list.size for chunk_list in self.chunk_lists.values())
+        unique_chunks = {
+            chunk.blob_hash: chunk.size
+            for chunk_list in self.chunk_lists.values()
+            for chunk in chunk_list.chunks
+        }
+        unique_bytes = sum(unique_chunks.values())
+        return (
+            f"Chunked {len(self.chunk_lists)} files "
+            f"({total_bytes / 2**30:.2f} GiB) into {len(unique_chunks)} chunks: "
+            f"{unique_bytes / 2**30:.2f} GiB unique "
+            f"(dedup ratio {total_bytes / max(unique_bytes, 1):.2f}), "
+            f"{self.new_bytes / 2**30:.2f} GiB not stored before "
+            f"(dedup ratio {total_bytes / max(self.new_bytes, 1):.2f})."
         )
 
 
-# Upload files to GCS.
+def chunk_large_files(
+    chunk_min_file_bytes: Optional[int],
+    chunk_average_bytes: int,
+    local_directory: str,
+    files: dict[str, str],
+    file_metadata: dict[str, FileMetadata],
+) -> Optional[Chunking]:
+    # Blobs are picked by the sizes in file_metadata, the other blobs may be
+    # uploaded and removed already.
+    if chunk_min_file_bytes is None:
+        return None
+    sizes = {
+        files[path]: metadata.size
+        for path, metadata in file_metadata.items()
+        if path in files
+    }
+    chunk_lists = {}
+    new_bytes = 0
+    for file_hash in sorted(sizes):
+        if not keep_for_chunking(chunk_min_file_bytes, sizes[file_hash]):
+            continue
+        chunk_lists[file_hash], file_new_bytes = write_chunks(
+            local_directory, file_hash, chunk_average_bytes
+        )
+        new_bytes += file_new_bytes
+    if not chunk_lists:
+        return None
+    chunking = Chunking(chunk_lists=chunk_lists, new_bytes=new_bytes)
+    print(chunking.report())
+    return chunking
+
+
+def keep_for_chunking(chunk_min_file_bytes: Optional[int], size: int) -> bool:
+    # Whether a blob of this size is stored as chunks, it is not uploaded
+    # itself but must stay on local disk until chunked.
+    return chunk_min_file_bytes is not None and size >= chunk_min_file_bytes
+
+
+def chunked_blobs(
+    chunking: Optional[Chunking], plan: MirrorPlan
+) -> Optional[list[str]]:
+    # Chunked now, or before and only in the upload destination.
+    blobs = set(plan.destination_chunked_blobs)
+    if chunking is not None:
+        blobs |= set(chunking.chunk_lists)
+    return sorted(blobs) or None
+
+
+async def upload_chunks(
+    queue: UploadQueue,
+    local_directory: str,
+    chunking: Chunking,
+    remove_uploaded: bool,
+):
+    # Chunks first, then the chunk lists referencing them. Chunks can be
+    # removed from local disk once uploaded, eg. in a temporary directory.
+    uploads = []
+    for chunk_hash in chunking.chunk_hashes():
+        path = blob_path(local_directory, chunk_hash)
+        on_done = functools.partial(os.remove, path) if remove_uploaded else None
+        uploads.append(
+            queue.submit(object_key(local_directory, path), path, on_done=on_done)
+        )
+    await asyncio.gather(*uploads)
+    await asyncio.gather(
+        *[
+            queue.submit(object_key(local_directory, path), path)
+            for path in [
+                chunk_list_path(local_directory, file_hash)
+                for file_hash in chunking.chunk_lists
+            ]
+        ]
+    )
+
+
+# Upload the mirrored files to the object store.
 # Important: upload in the right order, all blobs before manifests, and
-# full manifests before redirects. Otherwise the server might try to
-# read blobs that are not yet uploaded or follow an invalid redirect.
-def upload_to_gcs(
-    gcs_bucket: str,
+# full manifests before redirects (and chunks before chunk lists). Otherwise
+# the server might try to read blobs that are not yet uploaded or follow an
+# invalid redirect.
+async def upload(
+    backend: UploadBackend,
+    concurrency: int,
     local_directory: str,
     files: dict[str, str],
     repository_revision: RepositoryRevision,
     original_repository_revision: RepositoryRevision,
+    pack: Optional[Pack] = None,
+    chunking: Optional[Chunking] = None,
 ):
-    def manifest_path_not_none(
-        storage_root: str, repository_revision: RepositoryRevision
-    ) -> str:
-        s = manifest_path(storage_root, repository_revision)
-        assert s is not None
-        return s
-
-    print(f"Uploading to GCS bucket {gcs_bucket}...")
-    gcs_root = f"gs://{gcs_bucket}"
-    # Upload blobs.
-    upload_many_files_to_gcs(
-        list(set(blob_path(local_directory, hash) for hash in files.values())),
-        os.path.dirname(blob_path(gcs_root, "dummy")),
+    async with backend.session():
+        # Blobs are content-addressed, skip the ones that are already there.
+        print("Uploading blobs...")
+        blob_hashes = set(files.values())
+        if pack is not None:
+            blob_hashes.add(pack.blob_hash)
+        if chunking is not None:
+            blob_hashes -= set(chunking.chunk_lists)
+            blob_hashes |= chunking.chunk_hashes()
+        blob_paths = [blob_path(local_directory, hash) for hash in blob_hashes]
+        await upload_files(
+            backend,
+            {object_key(local_directory, path): path for path in blob_paths},
+            concurrency,
+        )
+        if chunking is not None:
+            # Content-addressed by the blob hash, like the blobs.
+            chunk_list_paths = [
+                chunk_list_path(local_directory, file_hash)
+                for file_hash in chunking.chunk_lists
+            ]
+            await upload_files(
+                backend,
+                {object_key(local_directory, path): path for path in chunk_list_paths},
+                concurrency,
+            )
+        await upload_manifests(
+            backend,
+            concurrency,
+            local_directory,
+            repository_revision,
+            original_repository_revision,
+        )
+
+
+async def upload_manifests(
+    backend: UploadBackend,
+    concurrency: int,
+    local_directory: str,
+    repository_revision: RepositoryRevision,
+    original_repository_revision: RepositoryRevision,
+):
+    # Manifests are always overwritten, the redirect manifest changes
+    # whenever the branch moves. Must be called after all blobs are uploaded.
+    # The upstream id index goes first, its entries point at the blobs.
+    manifest = load_full_manifest(local_directory, repository_revision)
+    assert manifest is not None
+    index_paths = oid_index_paths(
+        local_directory, manifest.files, manifest.file_metadata
     )
-    # Main manifest.
-    upload_many_files_to_gcs(
-        [manifest_path_not_none(local_directory, repository_revision)],
-        manifest_path_not_none(gcs_root, repository_revision),
+    await upload_files(
+        backend,
+        {object_key(local_directory, path): path for path in index_paths},
+        concurrency,
+        report_interval=None,
     )
-    # Redirect manifest.
+    print("Uploading manifests...")
+    revisions = [repository_revision]
     if repository_revision != original_repository_revision:
-        upload_many_files_to_gcs(
-            [manifest_path_not_none(local_directory, original_repository_revision)],
-            manifest_path_not_none(gcs_root, original_repository_revision),
+        revisions.append(original_repository_revision)
+    for revision in revisions:
+        path = manifest_path_not_none(local_directory, revision)
+        await upload_files(
+            backend,
+            {object_key(local_directory, path): path},
+            concurrency,
+            overwrite=True,
+        )
+    print("Upload complete!")
+
+
+def mirror_snapshot(
+    settings: Settings,
+    backend: Optional[UploadBackend],
+    local_directory: str,
+    plan: MirrorPlan,
+    repository_revision: RepositoryRevision,
+    original_repository_revision: RepositoryRevision,
+):
+    files = dict(plan.stored_files)
+    downloaded_files = {}
+    missing_files = plan.missing_files()
+    if missing_files:
+        # Download the raw repository, only the files we don't have.
+        local_snapshot = download_repo(
+            repository_revision,
+            None if not plan.stored_files else list(missing_files),
+        )
+
+        # Convert to mirrorable format - blobs and manifests.
+        print(f"Converting to mirrorable format in {local_directory}...")
+        downloaded_files = move_local_blobs(
+            local_snapshot,
+            local_directory,
+            workers=settings.hash_workers,
+            read_size=settings.hash_read_size,
+            progress=HashProgress(local_snapshot),
+        )
+        check_sizes(
+            local_file_metadata(local_directory, downloaded_files), plan.file_metadata
+        )
+        files.update(downloaded_files)
+    local_files = plan.local_files(downloaded_files)
+    pack = pack_small_files(
+        settings.pack_max_file_bytes, local_directory, local_files, plan.file_metadata
+    )
+    chunking = chunk_large_files(
+        settings.chunk_min_file_bytes,
+        settings.chunk_average_bytes,
+        local_directory,
+        local_files,
+        plan.file_metadata,
+    )
+    write_local_manifests(
+        repository_revision,
+        original_repository_revision,
+        files,
+        local_directory,
+        plan.file_metadata,
+        pack,
+        chunked_blobs(chunking, plan),
+    )
+
+    if backend is not None:
+        asyncio.run(
+            upload(
+                backend,
+                settings.upload_concurrency,
+                local_directory,
+                local_files,
+                repository_revision,
+                original_repository_revision,
+                pack,
+                chunking,
+            )
+        )
+
+
+def check_sizes(
+    local_metadata: dict[str, FileMetadata], upstream_metadata: dict[str, FileMetadata]
+):
+    for path, metadata in local_metadata.items():
+        upstream = upstream_metadata.get(path)
+        if upstream is None:
+            raise ValueError(f"Unexpected file {path} in the snapshot")
+        if upstream.size != metadata.size:
+            raise ValueError(
+                f"Size mismatch for {path}: {metadata.size} != {upstream.size}"
+            )
+
+
+async def mirror_streaming(
+    settings: Settings,
+    backend: Optional[UploadBackend],
+    local_directory: str,
+    plan: MirrorPlan,
+    repository_revision: RepositoryRevision,
+    original_repository_revision: RepositoryRevision,
+):
+    # Downloads straight into the blob directory, each blob is uploaded as soon
+    # as it is complete while the other files are still downloading.
+    print(f"Downloading {repository_revision} to {local_directory}...")
+    if backend is None:
+        downloaded_files = await ingest_repository(
+            repository_revision,
+            plan.missing_files(),
+            local_directory,
+            DownloadScheduler(settings.download_concurrency),
+        )
+        pack = pack_small_files(
+            settings.pack_max_file_bytes,
+            local_directory,
+            plan.local_files(downloaded_files),
+            plan.file_metadata,
+        )
+        chunking = chunk_large_files(
+            settings.chunk_min_file_bytes,
+            settings.chunk_average_bytes,
+            local_directory,
+            plan.local_files(downloaded_files),
+            plan.file_metadata,
         )
-    print("GCS upload complete!")
+    else:
+        async with backend.session():
+            async with UploadQueue(backend, settings.upload_concurrency) as queue:
+
+                def upload_blob(blob_hash: str):
+                    path = blob_path(local_directory, blob_hash)
+                    # Local files in a temporary directory are not needed once
+                    # uploaded, free up the disk space early.
+                    on_done = (
+                        None
+                        if settings.local_directory
+                        or keep_for_pack(settings.pack_max_file_bytes, path)
+                        else functools.partial(os.remove, path)
+                    )
+                    queue.submit(
+                        object_key(local_directory, path), path, on_done=on_done
+                    )
+
+                def on_blob(blob_hash: str):
+                    path = blob_path(local_directory, blob_hash)
+                    if keep_for_chunking(
+                        settings.chunk_min_file_bytes, os.path.getsize(path)
+                    ):
+                        # Uploaded as chunks once all files are downloaded.
+                        return
+                    upload_blob(blob_hash)
+
+                # Might not be uploaded yet, the queue skips them if they are.
+                for blob_hash in set(plan.local_files({}).values()):
+                    on_blob(blob_hash)
+                downloaded_files = await ingest_repository(
+                    repository_revision,
+                    plan.missing_files(),
+                    local_directory,
+                    DownloadScheduler(settings.download_concurrency),
+                    on_blob,
+                )
+                pack = pack_small_files(
+                    settings.pack_max_file_bytes,
+                    local_directory,
+                    plan.local_files(downloaded_files),
+                    plan.file_metadata,
+                )
+                if pack is not None:
+                    upload_blob(pack.blob_hash)
+                chunking = await asyncio.to_thread(
+                    chunk_large_files,
+                    settings.chunk_min_file_bytes,
+                    settings.chunk_average_bytes,
+                    local_directory,
+                    plan.local_files(downloaded_files),
+                    plan.file_metadata,
+                )
+                if chunking is not None:
+                    await upload_chunks(
+                        queue,
+                        local_directory,
+                        chunking,
+                        remove_uploaded=not settings.local_directory,
+                    )
+
+    write_local_manifests(
+        repository_revision,
+        original_repository_revision,
+        {**plan.stored_files, **downloaded_files},
+        local_directory,
+        plan.file_metadata,
+        pack,
+        chunked_blobs(chunking, plan),
+    )
+    if backend is not None:
+        # All blobs are uploaded by now, the queue waited for them.
+        async with backend.session():
+            await upload_manifests(
+                backend,
+                settings.upload_concurrency,
+                local_directory,
+                repository_revision,
+                original_repository_revision,
+            )
 
 
 def main(settings: Settings):
@@ -147,24 +721,51 @@ def main(settings: Settings):
         repository=settings.repository, revision=settings.revision
     )
     repository_revision = normalize_repository_revision(original_repository_revision)
-
-    # Download the raw repository.
-    local_snapshot = download_repo(repository_revision)
-
-    # Convert to mirrorable format - blobs and manifests.
     local_directory = settings.local_directory or tempfile.mkdtemp()
-    print(f"Converting to mirrorable format in {local_directory}...")
-    files = move_local_blobs(local_snapshot, local_directory)
-    write_local_manifests(
-        repository_revision, original_repository_revision, files, local_directory
-    )
 
-    # Upload to GCS if requested.
+    destination = settings.upload_destination
     if settings.gcs_bucket:
-        upload_to_gcs(
-            settings.gcs_bucket,
+        if destination:
+            raise ValueError("Set only one of gcs_bucket and upload_destination.")
+        destination = f"gs://{settings.gcs_bucket}"
+    backend = create_backend(destination) if destination else None
+
+    plan = plan_mirror(repository_revision, local_directory)
+    if backend is not None and plan.missing_files():
+
+        async def find_in_destination():
+            async with backend.session():
+                await find_destination_blobs(
+                    backend,
+                    settings.upload_concurrency,
+                    local_directory,
+                    plan,
+                    settings.pack_max_file_bytes,
+                )
+
+        asyncio.run(find_in_destination())
+    if settings.dry_run:
+        return
+    if destination:
+        print(f"Uploading to {destination}.")
+
+    if settings.streaming:
+        asyncio.run(
+            mirror_streaming(
+                settings,
+                backend,
+                local_directory,
+                plan,
+                repository_revision,
+                original_repository_revision,
+            )
+        )
+    else:
+        mirror_snapshot(
+            settings,
+            backend,
             local_directory,
-            files,
+            plan,
             repository_revision,
             original_repository_revision,
         )
@@ -0,0 +1,279 @@
+import asyncio
+import os
+
+import anyio
+
+from mirrorface.common.hub import RepositoryRevision
+from mirrorface.common.storage import (
+    FileMetadata,
+    blob_path,
+    load_full_manifest,
+    read_chunk_list,
+    write_local_manifests,
+)
+from mirrorface.tools.mirror import (
+    MirrorPlan,
+    Settings,
+    find_destination_blobs,
+    mirror_streaming,
+    plan_mirror,
+    upload,
+)
+from mirrorface.tools.upload.local import LocalBackend
+
+
+class RecordingBackend(LocalBackend):
+    def __init__(self, directory: str):
+        super().__init__(directory)
+        self.uploaded: list[str] = []
+
+    async def upload(self, key, path, overwrite, progress):
+        await super().upload(key, path, overwrite, progress)
+        self.uploaded.append(key)
+
+
+def test_upload_order(tmp_path):
+    local_directory = str(tmp_path / "local")
+    os.makedirs(os.path.join(local_directory, "blob"))
+    files = {"a": "hash_a", "b": "hash_b", "copy_of_a": "hash_a"}
+    for hash in set(files.values()):
+        with open(os.path.join(local_directory, "blob", hash), "w") as f:
+            f.write(hash)
+    revision = RepositoryRevision(repository="user/repo", revision="hash1")
+    main = RepositoryRevision(repository="user/repo", revision="main")
+    write_local_manifests(revision, main, files, local_directory)
+
+    backend = RecordingBackend(str(tmp_path / "bucket"))
+    anyio.run(upload, backend, 4, local_directory, files, revision, main)
+    # Blobs first, then the full manifest, then the redirect.
+    assert sorted(backend.uploaded[:2]) == ["blob/hash_a", "blob/hash_b"]
+    assert backend.uploaded[2:] == [
+        "manifest/user--repo__hash1.json",
+        "manifest/user--repo__main.json",
+    ]
+    assert load_full_manifest(backend.directory, main) == load_full_manifest(
+        local_directory, main
+    )
+
+    # Mirroring a new commit of the branch replaces the redirect.
+    revision2 = RepositoryRevision(repository="user/repo", revision="hash2")
+    write_local_manifests(revision2, main, files, local_directory)
+    backend.uploaded.clear()
+    anyio.run(upload, backend, 4, local_directory, files, revision2, main)
+    assert backend.uploaded == [
+        "manifest/user--repo__hash2.json",
+        "manifest/user--repo__main.json",
+    ]
+    manifest = load_full_manifest(backend.directory, main)
+    assert manifest is not None and manifest.revision_hash == "hash2"
+
+
+def test_incremental_mirror(tmp_path, monkeypatch):
+    local_directory = str(tmp_path / "local")
+    os.makedirs(os.path.join(local_directory, "blob"))
+    with open(blob_path(local_directory, "hash_model"), "w") as f:
+        f.write("model")
+    main = RepositoryRevision(repository="user/repo", revision="main")
+    revision1 = RepositoryRevision(repository="user/repo", revision="hash1")
+    model = FileMetadata(size=5, blob_id="1" * 40, lfs_sha256="2" * 64)
+    write_local_manifests(
+        revision1,
+        main,
+        {"model.bin": "hash_model"},
+        local_directory,
+        {"model.bin": model},
+    )
+
+    # New commit, only the README changed.
+    revision2 = RepositoryRevision(repository="user/repo", revision="hash2")
+    readme = FileMetadata(size=6, blob_id="3" * 40)
+    monkeypatch.setattr(
+        "mirrorface.tools.mirror.list_repository_files",
+        lambda _: {"model.bin": model, "README.md": readme},
+    )
+    plan = plan_mirror(revision2, local_directory)
+    assert plan.stored_files == {"model.bin": "hash_model"}
+    assert plan.missing_files() == {"README.md": readme}
+    assert plan.download_bytes() == 6
+
+    async def ingest_repository(revision, files, local_directory, scheduler, on_blob):
+        assert files == {"README.md": readme}
+        with open(blob_path(local_directory, "hash_readme"), "w") as f:
+            f.write("readme")
+        on_blob("hash_readme")
+        return {"README.md": "hash_readme"}
+
+    monkeypatch.setattr("mirrorface.tools.mirror.ingest_repository", ingest_repository)
+    backend = RecordingBackend(str(tmp_path / "bucket"))
+    settings = Settings.model_construct(
+        repository="user/repo", local_directory=local_directory
+    )
+    anyio.run(
+        mirror_streaming, settings, backend, local_directory, plan, revision2, main
+    )
+    # The stored blob was never uploaded, so it is uploaded with the new one.
+    assert sorted(backend.uploaded[:2]) == ["blob/hash_model", "blob/hash_readme"]
+    # Then the upstream id index, pointing at the blobs.
+    assert sorted(backend.uploaded[2:4]) == [f"oid/{'2' * 64}", f"oid/{'3' * 40}"]
+    assert backend.uploaded[4:] == [
+        "manifest/user--repo__hash2.json",
+        "manifest/user--repo__main.json",
+    ]
+    manifest = load_full_manifest(backend.directory, main)
+    assert manifest is not None
+    assert manifest.files == {"model.bin": "hash_model", "README.md": "hash_readme"}
+    assert manifest.file_metadata == {"model.bin": model, "README.md": readme}
+
+    # Another commit, mirrored through a new temporary directory: the model is
+    # found in the destination and neither downloaded nor uploaded again.
+    revision3 = RepositoryRevision(repository="user/repo", revision="hash3")
+    temporary_directory = str(tmp_path / "temporary")
+    os.makedirs(os.path.join(temporary_directory, "blob"))
+    plan = plan_mirror(revision3, temporary_directory)
+    assert plan.stored_files == {}
+    anyio.run(find_destination_blobs_in_session, backend, temporary_directory, plan)
+    assert plan.stored_files == {"model.bin": "hash_model", "README.md": "hash_readme"}
+    assert plan.destination_blobs == ["hash_model", "hash_readme"]
+    assert plan.missing_files() == {}
+
+    async def ingest_nothing(revision, files, local_directory, scheduler, on_blob):
+        assert files == {}
+        return {}
+
+    monkeypatch.setattr("mirrorface.tools.mirror.ingest_repository", ingest_nothing)
+    backend.uploaded.clear()
+    anyio.run(
+        mirror_streaming,
+        Settings.model_construct(repository="user/repo"),
+        backend,
+        temporary_directory,
+        plan,
+        revision3,
+        main,
+    )
+    assert backend.uploaded == [
+        "manifest/user--repo__hash3.json",
+        "manifest/user--repo__main.json",
+    ]
+    manifest = load_full_manifest(backend.directory, main)
+    assert manifest is not None and manifest.revision_hash == "hash3"
+    assert manifest.files == {"model.bin": "hash_model", "README.md": "hash_readme"}
+
+
+async def find_destination_blobs_in_session(
+    backend: LocalBackend, local_directory: str, plan: MirrorPlan
+):
+    async with backend.session():
+        await find_destination_blobs(backend, 4, local_directory, plan)
+
+
+def test_mirror_streaming_pack(tmp_path, monkeypatch):
+    local_directory = str(tmp_path / "local")
+    os.makedirs(os.path.join(local_directory, "blob"))
+    revision = RepositoryRevision(repository="user/repo", revision="hash1")
+    contents = {"model.bin": b"x" * 100, "config.json": b"{}", "vocab.txt": b"a b c"}
+
+    async def ingest_repository(revision, files, local_directory, scheduler, on_blob):
+        downloaded = {}
+        for path, data in contents.items():
+            with open(blob_path(local_directory, f"hash_{path}"), "wb") as f:
+                f.write(data)
+            on_blob(f"hash_{path}")
+            downloaded[path] = f"hash_{path}"
+            # Like a real download, lets the uploads run (and the model blob
+            # be removed) before the pack is written.
+            await asyncio.sleep(0.01)
+        return downloaded
+
+    monkeypatch.setattr("mirrorface.tools.mirror.ingest_repository", ingest_repository)
+    plan = MirrorPlan(
+        file_metadata={p: FileMetadata(size=len(d)) for p, d in contents.items()},
+        stored_files={},
+    )
+    backend = RecordingBackend(str(tmp_path / "bucket"))
+    # Temporary local directory, uploaded blobs are removed unless packed.
+    settings = Settings.model_construct(repository="user/repo", pack_max_file_bytes=10)
+    anyio.run(
+        mirror_streaming, settings, backend, local_directory, plan, revision, revision
+    )
+
+    manifest = load_full_manifest(backend.directory, revision)
+    assert manifest is not None and manifest.pack is not None
+    assert sorted(manifest.pack.entries) == ["hash_config.json", "hash_vocab.txt"]
+    pack_key = f"blob/{manifest.pack.blob_hash}"
+    assert backend.uploaded.index(pack_key) < backend.uploaded.index(
+        "manifest/user--repo__hash1.json"
+    )
+    assert not os.path.exists(blob_path(local_directory, "hash_model.bin"))
+
+
+def test_mirror_streaming_chunks(tmp_path, monkeypatch):
+    local_directory = str(tmp_path / "local")
+    os.makedirs(os.path.join(local_directory, "blob"))
+    model = os.urandom(64 * 1024)
+    backend = RecordingBackend(str(tmp_path / "bucket"))
+    # Temporary local directory, chunks are removed once uploaded.
+    settings = Settings.model_construct(
+        repository="user/repo", chunk_min_file_bytes=1000, chunk_average_bytes=1024
+    )
+
+    def mirror(revision: RepositoryRevision, contents: dict[str, bytes]):
+        async def ingest_repository(
+            revision, files, local_directory, scheduler, on_blob
+        ):
+            downloaded = {}
+            for path, data in contents.items():
+                file_hash = f"hash_{path}_{revision.revision}"
+                with open(blob_path(local_directory, file_hash), "wb") as f:
+                    f.write(data)
+                on_blob(file_hash)
+                downloaded[path] = file_hash
+                # Lets the uploads run, small blobs are removed before the
+                # large ones are chunked.
+                await asyncio.sleep(0.01)
+            return downloaded
+
+        monkeypatch.setattr(
+            "mirrorface.tools.mirror.ingest_repository", ingest_repository
+        )
+        plan = MirrorPlan(
+            file_metadata={p: FileMetadata(size=len(d)) for p, d in contents.items()},
+            stored_files={},
+        )
+        backend.uploaded.clear()
+        anyio.run(
+            mirror_streaming,
+            settings,
+            backend,
+            local_directory,
+            plan,
+            revision,
+            revision,
+        )
+
+    revision1 = RepositoryRevision(repository="user/repo", revision="hash1")
+    mirror(revision1, {"config.json": b"{}", "model.bin": model})
+    manifest = load_full_manifest(backend.directory, revision1)
+    assert manifest is not None
+    assert manifest.chunked_blobs == ["hash_model.bin_hash1"]
+    # Small files are uploaded as they are, the model only as chunks.
+    assert "blob/hash_config.json_hash1" in backend.uploaded
+    assert "blob/hash_model.bin_hash1" not in backend.uploaded
+    chunk_list = read_chunk_list(backend.directory, "hash_model.bin_hash1")
+    assert backend.uploaded.index(
+        "chunks/hash_model.bin_hash1.json"
+    ) < backend.uploaded.index("manifest/user--repo__hash1.json")
+    stored = b""
+    for chunk in chunk_list.chunks:
+        with open(blob_path(backend.directory, chunk.blob_hash), "rb") as f:
+            stored += f.read()
+    assert stored == model
+    assert not os.path.exists(
+        blob_path(local_directory, chunk_list.chunks[0].blob_hash)
+    )
+
+    # A few bytes changed: only the chunks around them are uploaded.
+    revision2 = RepositoryRevision(repository="user/repo", revision="hash2")
+    mirror(revision2, {"model.bin": model[:30000] + b"changed" + model[30007:]})
+    uploaded_chunks = [key for key in backend.uploaded if key.startswith("blob/")]
+    assert 0 < len(uploaded_chunks) <= 3 < len(chunk_list.chunks)
@@ -0,0 +1,107 @@
+# Prewarms a mirrored revision on a MirrorFace server, eg. before a rollout.
+#
+# Usage:
+#
+#     uv run prewarm \
+#       --server=http://mirrorface-hostname:port \
+#       --repository=prajjwal1/bert-tiny \
+#       --revision=main
+#
+# Starts the prewarm job on the server (see /admin/prewarm) and prints its
+# progress until it is done. Interrupting the command cancels the job. Set
+# `admin_token` if the server requires one. With several server replicas every
+# one of them has its own caches, run the command for each.
+
+import asyncio
+import sys
+from typing import Optional
+
+import aiohttp
+from pydantic import Field
+from pydantic_settings import BaseSettings
+
+
+class Settings(BaseSettings, cli_parse_args=True):
+    server: str
+    repository: str
+    revision: str = Field(default="main")
+    admin_token: Optional[str] = None
+    # Seconds between status requests.
+    poll_interval: float = 5
+    # Give up after this many status requests in a row found no job, eg. if
+    # the server restarted.
+    max_not_found: int = 10
+    # Only start the job, don't wait for it.
+    detach: bool = False
+
+
+def print_status(status: dict):
+    total_bytes = status["total_bytes"] or 1
+    print(
+        f"{status['state']}: {status['read_blobs']}/{status['total_blobs']} blobs, "
+        f"{status['read_bytes'] / 2**30:.2f}/{status['total_bytes'] / 2**30:.2f} GiB "
+        f"({100 * status['read_bytes'] / total_bytes:.0f}%)"
+    )
+
+
+async def prewarm(settings: Settings) -> bool:
+    # Returns whether the job finished successfully.
+    url = f"{settings.server.rstrip('/')}/admin/prewarm"
+    params = {"repository": settings.repository, "revision": settings.revision}
+    headers = (
+        {"Authorization": f"Bearer {settings.admin_token}"}
+        if settings.admin_token
+        else {}
+    )
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async with session.post(url, params=params) as r:
+            if r.status != 202:
+                print(f"Failed to start prewarming: {r.status} {await r.text()}")
+                return False
+            status = await r.json()
+        print(f"Prewarming {settings.repository}@{status['revision_hash']}")
+        print_status(status)
+        if settings.detach:
+            return True
+
+        try:
+            not_found = 0
+            while status["state"] == "running":
+                await asyncio.sleep(settings.poll_interval)
+                async with session.get(url, params=params) as r:
+                    if r.status == 404:
+                        # Not (yet) visible to the worker that got the request.
+                        not_found += 1
+                        print(f"No status: {await r.text()}")
+                        if not_found >= settings.max_not_found:
+                            return False
+                        continue
+                    r.raise_for_status()
+                    status = await r.json()
+                not_found = 0
+                print_status(status)
+        except asyncio.CancelledError:
+            print("Interrupted, cancelling...")
+            async with session.delete(url, params=params) as r:
+                if r.ok:
+                    print_status(await r.json())
+            raise
+        if status["error"]:
+            print(f"Error: {status['error']}")
+        return status["state"] == "done"
+
+
+def main(settings: Settings) -> int:
+    try:
+        return 0 if asyncio.run(prewarm(settings)) else 1
+    except KeyboardInterrupt:
+        return 130
+
+
+def main_cli():
+    settings = Settings()  # pyright: ignore[reportCallIssue], pydantic-settings will initialize or throw
+    sys.exit(main(settings))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,269 @@
+# Concurrent uploads of mirrored files to an object store.
+#
+# Each store has its own backend (GCS, S3, local directory), the engine here
+# is shared: it checks which objects already exist up front, with one listing
+# per directory of the keys instead of a request per object, then uploads the
+# rest with a bounded number of concurrent uploads and prints progress and
+# throughput while doing so. When files become available one by one (eg.
+# while they are being downloaded) use UploadQueue instead.
+#
+# Destinations are URLs: `gs://bucket[/prefix]`, `s3://bucket[/prefix]`, or a
+# local directory path (also `file:///path`).
+
+import asyncio
+import contextlib
+import os
+import posixpath
+import threading
+import time
+import urllib.parse
+from typing import AsyncContextManager, AsyncIterator, Callable, Optional, Protocol
+
+
+class UploadBackend(Protocol):
+    def session(self) -> AsyncContextManager[None]:
+        """Sets up the backend (eg. HTTP session), uploads happen inside it."""
+        ...
+
+    async def exists(self, key: str) -> bool: ...
+
+    async def list_existing(self, prefix: str) -> set[str]:
+        """Keys of all objects that start with prefix."""
+        ...
+
+    async def read(self, key: str) -> Optional[bytes]:
+        """Contents of a (small) object, None if it doesn't exist."""
+        ...
+
+    async def upload(
+        self,
+        key: str,
+        path: str,
+        overwrite: bool,
+        progress: Callable[[int], None],
+    ) -> None:
+        """Uploads the file, calling progress with the number of bytes sent as it goes.
+
+        Without overwrite, an object that already exists is left as is.
+        """
+        ...
+
+
+def create_backend(destination: str) -> UploadBackend:
+    # Imported here, backends only need to be loaded when used.
+    from mirrorface.tools.upload.gcs import GCSBackend
+    from mirrorface.tools.upload.local import LocalBackend
+    from mirrorface.tools.upload.s3 import S3Backend
+
+    url = urllib.parse.urlparse(destination)
+    prefix = url.path.strip("/")
+    if url.scheme == "gs":
+        return GCSBackend(url.netloc, prefix)
+    if url.scheme == "s3":
+        return S3Backend.from_environment(url.netloc, prefix)
+    if url.scheme == "file":
+        return LocalBackend(url.path)
+    if url.scheme == "":
+        return LocalBackend(destination)
+    raise ValueError(f"Unsupported upload destination: {destination}")
+
+
+class UploadProgress:
+    """Upload statistics, updated by concurrent uploads (and backend threads)."""
+
+    def __init__(self, total_files: int, total_bytes: int, skipped_files: int):
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.skipped_files = skipped_files
+        self.uploaded_files = 0
+        self.uploaded_bytes = 0
+        self.started_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def add_total(self, size: int):
+        with self._lock:
+            self.total_files += 1
+            self.total_bytes += size
+
+    def add_skipped(self, size: int):
+        with self._lock:
+            self.total_files -= 1
+            self.total_bytes -= size
+            self.skipped_files += 1
+
+    def add_bytes(self, size: int):
+        with self._lock:
+            self.uploaded_bytes += size
+
+    def add_file(self):
+        with self._lock:
+            self.uploaded_files += 1
+
+    def report(self) -> str:
+        elapsed = time.monotonic() - self.started_at
+        throughput = self.uploaded_bytes / elapsed if elapsed > 0 else 0
+        return (
+            f"Uploaded {self.uploaded_files}/{self.total_files} files "
+            f"({self.skipped_files} already present), "
+            f"{self.uploaded_bytes / 2**30:.2f}/{self.total_bytes / 2**30:.2f} GiB, "
+            f"{throughput / 2**20:.1f} MiB/s"
+        )
+
+
+async def upload_files(
+    backend: UploadBackend,
+    files: dict[str, str],
+    concurrency: int,
+    overwrite: bool = False,
+    report_interval: Optional[float] = 10,
+) -> UploadProgress:
+    # Uploads files (object key -> local path) and returns the statistics.
+    # Without overwrite, objects that already exist are skipped. Raises if any
+    # upload fails, after the others are done.
+    semaphore = asyncio.Semaphore(concurrency)
+    keys = sorted(files)
+    if overwrite:
+        to_upload = keys
+    else:
+        present = await existing_keys(backend, keys, semaphore)
+        to_upload = [key for key in keys if key not in present]
+
+    progress = UploadProgress(
+        total_files=len(to_upload),
+        total_bytes=sum(os.path.getsize(files[key]) for key in to_upload),
+        skipped_files=len(keys) - len(to_upload),
+    )
+
+    async def upload(key: str):
+        async with semaphore:
+            await backend.upload(key, files[key], overwrite, progress.add_bytes)
+            progress.add_file()
+
+    async with _reporter(progress, report_interval):
+        results = await asyncio.gather(
+            *[upload(key) for key in to_upload], return_exceptions=True
+        )
+    _raise_errors(results)
+    return progress
+
+
+async def existing_keys(
+    backend: UploadBackend, keys: list[str], semaphore: asyncio.Semaphore
+) -> set[str]:
+    # The keys that already exist, listing each directory they are in once.
+    async def list_directory(directory: str) -> set[str]:
+        async with semaphore:
+            return await backend.list_existing(f"{directory}/" if directory else "")
+
+    directories = sorted({posixpath.dirname(key) for key in keys})
+    listings = await asyncio.gather(*[list_directory(d) for d in directories])
+    return set(keys).intersection(set().union(*listings))
+
+
+@contextlib.asynccontextmanager
+async def _reporter(
+    progress: UploadProgress, interval: Optional[float]
+) -> AsyncIterator[None]:
+    # Prints the progress periodically while active, and once at the end.
+    async def report_periodically(interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            print(progress.report())
+
+    task = (
+        asyncio.create_task(report_periodically(interval))
+        if interval is not None
+        else None
+    )
+    try:
+        yield
+    finally:
+        if task is not None:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task
+    print(progress.report())
+
+
+def _raise_errors(results: list):
+    errors = [r for r in results if isinstance(r, BaseException)]
+    if errors:
+        raise Exception(f"{len(errors)} uploads failed") from errors[0]
+
+
+class UploadQueue:
+    """Uploads files as they are submitted, at most `concurrency` at a time.
+
+    Files are checked for existence individually (skipped unless overwrite),
+    use as `async with UploadQueue(...) as queue`, leaving waits for all
+    uploads and raises if any of them failed (unless raise_errors is false,
+    for callers that check the returned tasks themselves).
+    """
+
+    def __init__(
+        self,
+        backend: UploadBackend,
+        concurrency: int,
+        report_interval: Optional[float] = 10,
+        raise_errors: bool = True,
+    ):
+        self.backend = backend
+        self.progress = UploadProgress(0, 0, 0)
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._report_interval = report_interval
+        self._raise_errors = raise_errors
+        self._tasks: list[asyncio.Task] = []
+        # Uploads without overwrite, by key. Submitting the same key again
+        # returns the same upload.
+        self._uploads: dict[str, asyncio.Task[None]] = {}
+
+    async def __aenter__(self) -> "UploadQueue":
+        self._reporter = _reporter(self.progress, self._report_interval)
+        await self._reporter.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        try:
+            results = await asyncio.gather(*self._tasks, return_exceptions=True)
+        finally:
+            await self._reporter.__aexit__(None, None, None)
+        if exc_info[0] is None and self._raise_errors:
+            _raise_errors(results)
+
+    def submit(
+        self,
+        key: str,
+        path: str,
+        overwrite: bool = False,
+        on_done: Optional[Callable[[], None]] = None,
+    ) -> asyncio.Task[None]:
+        # on_done is called once the object is in the store (uploaded or
+        # already present), eg. to remove the local file. Returns the upload,
+        # to wait for it before uploading something that depends on it. A key
+        # that is already queued is not uploaded again (and on_done is not
+        # called for it).
+        if not overwrite and key in self._uploads:
+            return self._uploads[key]
+        task = asyncio.create_task(self._upload(key, path, overwrite, on_done))
+        self._tasks.append(task)
+        if not overwrite:
+            self._uploads[key] = task
+        return task
+
+    async def _upload(
+        self,
+        key: str,
+        path: str,
+        overwrite: bool,
+        on_done: Optional[Callable[[], None]],
+    ):
+        size = os.path.getsize(path)
+        self.progress.add_total(size)
+        async with self._semaphore:
+            if not overwrite and await self.backend.exists(key):
+                self.progress.add_skipped(size)
+            else:
+                await self.backend.upload(key, path, overwrite, self.progress.add_bytes)
+                self.progress.add_file()
+        if on_done is not None:
+            on_done()
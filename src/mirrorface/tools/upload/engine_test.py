@@ -0,0 +1,120 @@
+import os
+
+import anyio
+import pytest
+
+from mirrorface.tools.upload.engine import UploadQueue, create_backend, upload_files
+from mirrorface.tools.upload.gcs import GCSBackend
+from mirrorface.tools.upload.local import LocalBackend
+from mirrorface.tools.upload.s3 import S3Backend
+
+
+def make_files(directory, contents: dict[str, bytes]) -> dict[str, str]:
+    files = {}
+    for key, content in contents.items():
+        path = os.path.join(directory, key.replace("/", "_"))
+        with open(path, "wb") as f:
+            f.write(content)
+        files[key] = path
+    return files
+
+
+def test_upload_files_local(tmp_path):
+    source = tmp_path / "source"
+    target = tmp_path / "target"
+    os.makedirs(source)
+    files = make_files(
+        source, {"blob/a": b"a" * 1000, "blob/b": b"b" * 10, "manifest/m.json": b"{}"}
+    )
+    backend = LocalBackend(str(target))
+
+    async def run():
+        async with backend.session():
+            progress = await upload_files(backend, files, concurrency=2)
+            assert progress.uploaded_files == 3
+            assert progress.uploaded_bytes == 1012
+            assert progress.skipped_files == 0
+
+            assert await backend.list_existing("blob/") == {"blob/a", "blob/b"}
+            assert await backend.list_existing("blob/a") == {"blob/a"}
+            assert await backend.list_existing("missing/") == set()
+
+            # Existing objects are skipped, unless overwriting.
+            with open(target / "blob/a", "wb") as f:
+                f.write(b"changed")
+            progress = await upload_files(backend, files, concurrency=2)
+            assert progress.uploaded_files == 0
+            assert progress.skipped_files == 3
+            progress = await upload_files(
+                backend, {"blob/a": files["blob/a"]}, concurrency=2, overwrite=True
+            )
+            assert progress.uploaded_files == 1
+
+    anyio.run(run)
+    for key, path in files.items():
+        with open(path, "rb") as f, open(target / key, "rb") as g:
+            assert f.read() == g.read()
+    assert sorted(os.listdir(target / "blob")) == ["a", "b"]
+
+
+def test_upload_files_failure(tmp_path):
+    files = make_files(tmp_path, {"good": b"x", "bad": b"y"})
+    uploaded = []
+
+    class FailingBackend(LocalBackend):
+        async def upload(self, key, path, overwrite, progress):
+            if key == "bad":
+                raise OSError("no space left")
+            uploaded.append(key)
+
+    with pytest.raises(Exception, match="1 uploads failed"):
+        anyio.run(upload_files, FailingBackend(str(tmp_path / "target")), files, 2)
+    # The other uploads still finish.
+    assert uploaded == ["good"]
+
+
+def test_create_backend(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "key")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "secret")
+    monkeypatch.setenv("AWS_REGION", "eu-west-1")
+    monkeypatch.delenv("AWS_ENDPOINT_URL", raising=False)
+
+    gcs = create_backend("gs://bucket/some/prefix")
+    assert isinstance(gcs, GCSBackend)
+    assert gcs.object_name("blob/a") == "some/prefix/blob/a"
+    s3 = create_backend("s3://bucket")
+    assert isinstance(s3, S3Backend)
+    assert s3.object_url("blob/a") == "https://s3.eu-west-1.amazonaws.com/bucket/blob/a"
+    local = create_backend("/tmp/mirror")
+    assert isinstance(local, LocalBackend) and local.directory == "/tmp/mirror"
+    local = create_backend("file:///tmp/mirror")
+    assert isinstance(local, LocalBackend) and local.directory == "/tmp/mirror"
+    with pytest.raises(ValueError):
+        create_backend("ftp://host/dir")
+
+
+def test_upload_queue(tmp_path):
+    source = tmp_path / "source"
+    target = tmp_path / "target"
+    os.makedirs(source)
+    files = make_files(source, {"blob/a": b"a" * 100, "blob/b": b"b" * 10})
+    backend = LocalBackend(str(target))
+    os.makedirs(target / "blob")
+    with open(target / "blob/b", "wb") as f:
+        f.write(b"b" * 10)
+    done = []
+
+    async def run():
+        async with backend.session():
+            async with UploadQueue(backend, concurrency=1) as queue:
+                for key, path in files.items():
+                    queue.submit(key, path, on_done=lambda key=key: done.append(key))
+            assert queue.progress.uploaded_files == 1
+            assert queue.progress.uploaded_bytes == 100
+            assert queue.progress.skipped_files == 1
+
+    anyio.run(run)
+    # Called for skipped objects too.
+    assert sorted(done) == ["blob/a", "blob/b"]
+    with open(target / "blob/a", "rb") as f:
+        assert f.read() == b"a" * 100
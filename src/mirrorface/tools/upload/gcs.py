@@ -0,0 +1,161 @@
+# Upload backend for Google Cloud Storage, using the JSON API.
+#
+# Files are uploaded with a resumable upload session and a single streaming
+# PUT, which works for any file size. Access tokens come from the `gcloud` CLI
+# (must be authenticated with write access to the bucket), and are refreshed
+# when they expire during long uploads.
+
+import asyncio
+import contextlib
+import json
+import os
+import subprocess
+import urllib.parse
+from typing import AsyncIterator, Callable, Optional
+
+import aiohttp
+
+GCS_ENDPOINT = "https://storage.googleapis.com"
+READ_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def gcloud_access_token() -> str:
+    result = subprocess.run(
+        ["gcloud", "auth", "print-access-token"],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout.strip()
+
+
+async def read_file(path: str, progress: Callable[[int], None]) -> AsyncIterator[bytes]:
+    with open(path, "rb") as f:
+        while chunk := await asyncio.to_thread(f.read, READ_CHUNK_SIZE):
+            yield chunk
+            progress(len(chunk))
+
+
+class GCSBackend:
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str = "",
+        endpoint: str = GCS_ENDPOINT,
+        token_provider: Callable[[], str] = gcloud_access_token,
+    ):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint = endpoint.rstrip("/")
+        self.token_provider = token_provider
+        self._token: Optional[str] = None
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @contextlib.asynccontextmanager
+    async def session(self) -> AsyncIterator[None]:
+        async with aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300)
+        ) as session:
+            self._session = session
+            try:
+                yield
+            finally:
+                self._session = None
+
+    def object_name(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    async def _headers(self, refresh: bool = False) -> dict[str, str]:
+        if self._token is None or refresh:
+            self._token = await asyncio.to_thread(self.token_provider)
+        return {"Authorization": f"Bearer {self._token}"}
+
+    async def _request(self, method: str, url: str, **kwargs) -> aiohttp.ClientResponse:
+        # Request with auth, retried once with a fresh token if it expired.
+        # Only for requests without a (streaming) body.
+        assert self._session is not None, "Use within session()"
+        headers = kwargs.pop("headers", {})
+        response = await self._session.request(
+            method, url, headers={**headers, **await self._headers()}, **kwargs
+        )
+        if response.status == 401:
+            response.release()
+            response = await self._session.request(
+                method,
+                url,
+                headers={**headers, **await self._headers(refresh=True)},
+                **kwargs,
+            )
+        return response
+
+    async def exists(self, key: str) -> bool:
+        name = urllib.parse.quote(self.object_name(key), safe="")
+        url = f"{self.endpoint}/storage/v1/b/{self.bucket}/o/{name}"
+        async with await self._request("GET", url, params={"fields": "name"}) as r:
+            if r.status == 404:
+                return False
+            r.raise_for_status()
+            return True
+
+    async def list_existing(self, prefix: str) -> set[str]:
+        # Paged listing with only the names, much less to transfer than the
+        # full object resources.
+        name_prefix = self.object_name(prefix)
+        strip = len(self.object_name(""))
+        url = f"{self.endpoint}/storage/v1/b/{self.bucket}/o"
+        params = {"prefix": name_prefix, "fields": "items(name),nextPageToken"}
+        keys = set()
+        while True:
+            async with await self._request("GET", url, params=params) as r:
+                r.raise_for_status()
+                page = await r.json()
+            keys.update(item["name"][strip:] for item in page.get("items", []))
+            if "nextPageToken" not in page:
+                return keys
+            params["pageToken"] = page["nextPageToken"]
+
+    async def read(self, key: str) -> Optional[bytes]:
+        name = urllib.parse.quote(self.object_name(key), safe="")
+        url = f"{self.endpoint}/storage/v1/b/{self.bucket}/o/{name}"
+        async with await self._request("GET", url, params={"alt": "media"}) as r:
+            if r.status == 404:
+                return None
+            r.raise_for_status()
+            return await r.read()
+
+    async def upload(
+        self,
+        key: str,
+        path: str,
+        overwrite: bool,
+        progress: Callable[[int], None],
+    ) -> None:
+        assert self._session is not None, "Use within session()"
+        params = {"uploadType": "resumable", "name": self.object_name(key)}
+        if not overwrite:
+            # Only create, never replace. Blobs are content-addressed so an
+            # existing one has the same content.
+            params["ifGenerationMatch"] = "0"
+        url = f"{self.endpoint}/upload/storage/v1/b/{self.bucket}/o"
+        async with await self._request(
+            "POST",
+            url,
+            params=params,
+            data=json.dumps({"name": self.object_name(key)}),
+            headers={"Content-Type": "application/json; charset=UTF-8"},
+        ) as r:
+            if r.status == 412:
+                return
+            r.raise_for_status()
+            upload_url = urllib.parse.urljoin(str(r.url), r.headers["Location"])
+
+        # The session URL is the authorization, no token needed.
+        size = await asyncio.to_thread(os.path.getsize, path)
+        async with self._session.put(
+            upload_url,
+            data=read_file(path, progress),
+            headers={"Content-Length": str(size)},
+        ) as r:
+            if r.status == 412:
+                return
+            r.raise_for_status()
@@ -0,0 +1,122 @@
+import os
+
+import anyio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from mirrorface.tools.upload.engine import upload_files
+from mirrorface.tools.upload.gcs import GCSBackend
+
+
+class FakeGCS:
+    """Just enough of the GCS JSON API for uploads."""
+
+    def __init__(self):
+        self.objects: dict[str, bytes] = {}
+        self.sessions: dict[str, tuple[str, bool]] = {}
+        self.valid_token = "token-2"
+        # Small pages, so listings need several requests.
+        self.page_size = 2
+        self.requests: list[tuple[str, str]] = []
+        self.app = web.Application(middlewares=[self.record])
+        self.app.router.add_get("/storage/v1/b/bucket/o", self.list)
+        self.app.router.add_get("/storage/v1/b/bucket/o/{name}", self.get)
+        self.app.router.add_post("/upload/storage/v1/b/bucket/o", self.start)
+        self.app.router.add_put("/session/{id}", self.put)
+
+    def authorized(self, request: web.Request) -> bool:
+        return request.headers.get("Authorization") == f"Bearer {self.valid_token}"
+
+    @web.middleware
+    async def record(self, request: web.Request, handler):
+        self.requests.append((request.method, request.path))
+        return await handler(request)
+
+    async def list(self, request: web.Request):
+        if not self.authorized(request):
+            return web.Response(status=401)
+        assert request.query["fields"] == "items(name),nextPageToken"
+        names = sorted(n for n in self.objects if n.startswith(request.query["prefix"]))
+        start = int(request.query.get("pageToken", 0))
+        page: dict[str, object] = {
+            "items": [{"name": n} for n in names[start : start + self.page_size]]
+        }
+        if start + self.page_size < len(names):
+            page["nextPageToken"] = str(start + self.page_size)
+        return web.json_response(page)
+
+    async def get(self, request: web.Request):
+        if not self.authorized(request):
+            return web.Response(status=401)
+        if request.match_info["name"] not in self.objects:
+            return web.Response(status=404)
+        if request.query.get("alt") == "media":
+            return web.Response(body=self.objects[request.match_info["name"]])
+        return web.json_response({"name": request.match_info["name"]})
+
+    async def start(self, request: web.Request):
+        if not self.authorized(request):
+            return web.Response(status=401)
+        assert request.query["uploadType"] == "resumable"
+        name = request.query["name"]
+        create_only = request.query.get("ifGenerationMatch") == "0"
+        if create_only and name in self.objects:
+            return web.Response(status=412)
+        session_id = str(len(self.sessions))
+        self.sessions[session_id] = (name, create_only)
+        return web.Response(headers={"Location": f"/session/{session_id}"})
+
+    async def put(self, request: web.Request):
+        name, create_only = self.sessions.pop(request.match_info["id"])
+        if create_only and name in self.objects:
+            return web.Response(status=412)
+        self.objects[name] = await request.read()
+        return web.json_response({"name": name})
+
+
+def test_gcs_upload(tmp_path):
+    fake = FakeGCS()
+    tokens = iter(["token-1", "token-2"])
+    files = {}
+    contents = {
+        "blob/a": os.urandom(1000),
+        "blob/b": b"b",
+        "blob/c": b"c",
+        "manifest/m": b"{}",
+    }
+    for key, content in contents.items():
+        files[key] = str(tmp_path / key.replace("/", "_"))
+        with open(files[key], "wb") as f:
+            f.write(content)
+
+    async def run():
+        async with TestServer(fake.app) as server:
+            backend = GCSBackend(
+                "bucket",
+                "prefix",
+                endpoint=str(server.make_url("")),
+                token_provider=lambda: next(tokens),
+            )
+            async with backend.session():
+                # First token is expired, gets refreshed.
+                progress = await upload_files(backend, files, concurrency=1)
+                assert progress.uploaded_files == 4
+                assert progress.uploaded_bytes == 1004
+                fake.requests.clear()
+                progress = await upload_files(backend, files, concurrency=1)
+                assert progress.skipped_files == 4
+                # Listings of blob/ (two pages) and manifest/, no request per
+                # object.
+                assert fake.requests == [("GET", "/storage/v1/b/bucket/o")] * 3
+                assert await backend.list_existing("blob/") == {
+                    "blob/a",
+                    "blob/b",
+                    "blob/c",
+                }
+                assert await backend.read("manifest/m") == b"{}"
+                assert await backend.read("manifest/missing") is None
+
+    anyio.run(run)
+    for key, path in files.items():
+        with open(path, "rb") as f:
+            assert fake.objects[f"prefix/{key}"] == f.read()
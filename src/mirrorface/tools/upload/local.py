@@ -0,0 +1,79 @@
+# Upload backend writing to a local directory.
+#
+# Useful as a fake object store in tests, and for mirroring into a directory
+# that is already mounted (eg. a bucket through FUSE, or a shared volume).
+
+import asyncio
+import contextlib
+import os
+import posixpath
+import threading
+from typing import AsyncIterator, Callable, Optional
+
+COPY_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+class LocalBackend:
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    @contextlib.asynccontextmanager
+    async def session(self) -> AsyncIterator[None]:
+        yield
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    async def exists(self, key: str) -> bool:
+        return await asyncio.to_thread(os.path.exists, self.path(key))
+
+    async def list_existing(self, prefix: str) -> set[str]:
+        return await asyncio.to_thread(self._list_existing, prefix)
+
+    def _list_existing(self, prefix: str) -> set[str]:
+        # Keys are paths, walk the directory the prefix is in.
+        keys = set()
+        for root, _, names in os.walk(self.path(posixpath.dirname(prefix))):
+            for name in names:
+                key = os.path.relpath(os.path.join(root, name), self.directory)
+                if key.startswith(prefix):
+                    keys.add(key)
+        return keys
+
+    async def read(self, key: str) -> Optional[bytes]:
+        return await asyncio.to_thread(self._read, key)
+
+    def _read(self, key: str) -> Optional[bytes]:
+        try:
+            with open(self.path(key), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    async def upload(
+        self,
+        key: str,
+        path: str,
+        overwrite: bool,
+        progress: Callable[[int], None],
+    ) -> None:
+        await asyncio.to_thread(self._copy, key, path, overwrite, progress)
+
+    def _copy(
+        self, key: str, path: str, overwrite: bool, progress: Callable[[int], None]
+    ):
+        target_path = self.path(key)
+        if not overwrite and os.path.exists(target_path):
+            return
+        os.makedirs(os.path.dirname(target_path), exist_ok=True)
+        # Readers never see partially written objects, same as object stores.
+        temp_path = f"{target_path}.tmp-{os.getpid()}-{threading.get_ident()}"
+        try:
+            with open(path, "rb") as source, open(temp_path, "wb") as target:
+                for chunk in iter(lambda: source.read(COPY_CHUNK_SIZE), b""):
+                    target.write(chunk)
+                    progress(len(chunk))
+            os.replace(temp_path, target_path)
+        finally:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(temp_path)
@@ -0,0 +1,322 @@
+# Upload backend for S3 and S3-compatible object stores (MinIO, R2, ...).
+#
+# Requests are signed with AWS Signature Version 4. Credentials, region and
+# endpoint come from the usual AWS environment variables: AWS_ACCESS_KEY_ID,
+# AWS_SECRET_ACCESS_KEY, AWS_SESSION_TOKEN (optional), AWS_REGION and
+# AWS_ENDPOINT_URL (for non-AWS stores). Buckets are addressed path-style.
+#
+# Single PUTs are limited to 5 GB, larger files use multipart uploads. Object
+# contents are sent unsigned (UNSIGNED-PAYLOAD) so we don't have to read every
+# file twice, TLS protects them in transit.
+
+import asyncio
+import contextlib
+import datetime
+import hashlib
+import hmac
+import os
+import urllib.parse
+import xml.etree.ElementTree as ET
+from typing import AsyncIterator, Callable, Mapping, Optional
+
+import aiohttp
+import yarl
+
+UNSIGNED_PAYLOAD = "UNSIGNED-PAYLOAD"
+EMPTY_PAYLOAD = hashlib.sha256(b"").hexdigest()
+# Files larger than this are uploaded in parts of this size.
+DEFAULT_PART_SIZE = 256 * 1024 * 1024
+READ_CHUNK_SIZE = 8 * 1024 * 1024
+
+
+def _uri_encode(value: str, safe: str = "") -> str:
+    return urllib.parse.quote(value, safe="-_.~" + safe)
+
+
+def sign_v4(
+    method: str,
+    url: str,
+    headers: Mapping[str, str],
+    payload_hash: str,
+    access_key: str,
+    secret_key: str,
+    region: str,
+    now: datetime.datetime,
+    service: str = "s3",
+) -> dict[str, str]:
+    # Returns headers with the x-amz-* and Authorization headers added. The URL
+    # path and query must already be URI-encoded the way S3 expects.
+    parsed = urllib.parse.urlsplit(url)
+    amz_date = now.strftime("%Y%m%dT%H%M%SZ")
+    date = now.strftime("%Y%m%d")
+    signed = {
+        **{name.lower(): value.strip() for name, value in headers.items()},
+        "host": parsed.netloc,
+        "x-amz-date": amz_date,
+        "x-amz-content-sha256": payload_hash,
+    }
+    signed_headers = ";".join(sorted(signed))
+    query = sorted(
+        (_uri_encode(urllib.parse.unquote(k)), _uri_encode(urllib.parse.unquote(v)))
+        for k, _, v in (p.partition("=") for p in parsed.query.split("&") if p)
+    )
+    canonical_request = "\n".join(
+        [
+            method,
+            parsed.path or "/",
+            "&".join(f"{k}={v}" for k, v in query),
+            "".join(f"{name}:{signed[name]}\n" for name in sorted(signed)),
+            signed_headers,
+            payload_hash,
+        ]
+    )
+    scope = f"{date}/{region}/{service}/aws4_request"
+    string_to_sign = "\n".join(
+        [
+            "AWS4-HMAC-SHA256",
+            amz_date,
+            scope,
+            hashlib.sha256(canonical_request.encode()).hexdigest(),
+        ]
+    )
+    key = f"AWS4{secret_key}".encode()
+    for part in [date, region, service, "aws4_request"]:
+        key = hmac.new(key, part.encode(), hashlib.sha256).digest()
+    signature = hmac.new(key, string_to_sign.encode(), hashlib.sha256).hexdigest()
+
+    result = {name: value for name, value in signed.items() if name != "host"}
+    result["authorization"] = (
+        f"AWS4-HMAC-SHA256 Credential={access_key}/{scope}, "
+        f"SignedHeaders={signed_headers}, Signature={signature}"
+    )
+    return result
+
+
+async def read_file_range(
+    path: str, start: int, end: int, progress: Callable[[int], None]
+) -> AsyncIterator[bytes]:
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = await asyncio.to_thread(f.read, min(READ_CHUNK_SIZE, remaining))
+            if not chunk:
+                raise EOFError(f"Unexpected end of {path}")
+            remaining -= len(chunk)
+            yield chunk
+            progress(len(chunk))
+
+
+class S3Backend:
+    def __init__(
+        self,
+        bucket: str,
+        prefix: str,
+        endpoint: str,
+        region: str,
+        access_key: str,
+        secret_key: str,
+        session_token: Optional[str] = None,
+        part_size: int = DEFAULT_PART_SIZE,
+    ):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.endpoint = endpoint.rstrip("/")
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.session_token = session_token
+        self.part_size = part_size
+        self._session: Optional[aiohttp.ClientSession] = None
+
+    @classmethod
+    def from_environment(cls, bucket: str, prefix: str) -> "S3Backend":
+        region = os.environ.get("AWS_REGION") or os.environ.get(
+            "AWS_DEFAULT_REGION", "us-east-1"
+        )
+        return cls(
+            bucket,
+            prefix,
+            endpoint=os.environ.get(
+                "AWS_ENDPOINT_URL", f"https://s3.{region}.amazonaws.com"
+            ),
+            region=region,
+            access_key=os.environ["AWS_ACCESS_KEY_ID"],
+            secret_key=os.environ["AWS_SECRET_ACCESS_KEY"],
+            session_token=os.environ.get("AWS_SESSION_TOKEN"),
+        )
+
+    @contextlib.asynccontextmanager
+    async def session(self) -> AsyncIterator[None]:
+        async with aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=300)
+        ) as session:
+            self._session = session
+            try:
+                yield
+            finally:
+                self._session = None
+
+    def object_name(self, key: str) -> str:
+        return f"{self.prefix}/{key}" if self.prefix else key
+
+    def object_url(self, key: str, query: str = "") -> str:
+        name = self.object_name(key)
+        url = f"{self.endpoint}/{self.bucket}/{_uri_encode(name, safe='/')}"
+        return f"{url}?{query}" if query else url
+
+    def _request(
+        self,
+        method: str,
+        url: str,
+        payload_hash: str = EMPTY_PAYLOAD,
+        headers: Optional[dict[str, str]] = None,
+        data=None,
+    ):
+        assert self._session is not None, "Use within session()"
+        headers = dict(headers or {})
+        if self.session_token is not None:
+            headers["x-amz-security-token"] = self.session_token
+        signed_headers = sign_v4(
+            method,
+            url,
+            headers,
+            payload_hash,
+            self.access_key,
+            self.secret_key,
+            self.region,
+            datetime.datetime.now(datetime.timezone.utc),
+        )
+        # Already encoded for signing, make sure it's sent exactly like that.
+        return self._session.request(
+            method, yarl.URL(url, encoded=True), headers=signed_headers, data=data
+        )
+
+    async def exists(self, key: str) -> bool:
+        async with self._request("HEAD", self.object_url(key)) as r:
+            if r.status == 404:
+                return False
+            r.raise_for_status()
+            return True
+
+    async def list_existing(self, prefix: str) -> set[str]:
+        # ListObjectsV2, up to 1000 keys per page.
+        strip = len(self.object_name(""))
+        name_prefix = _uri_encode(self.object_name(prefix))
+        list_url = f"{self.endpoint}/{self.bucket}?list-type=2&prefix={name_prefix}"
+        url = list_url
+        keys = set()
+        while True:
+            async with self._request("GET", url) as r:
+                r.raise_for_status()
+                page = await r.read()
+            keys.update(key[strip:] for key in _xml_find_all(page, "Key"))
+            tokens = _xml_find_all(page, "NextContinuationToken")
+            if not tokens:
+                return keys
+            url = f"{list_url}&continuation-token={_uri_encode(tokens[0])}"
+
+    async def read(self, key: str) -> Optional[bytes]:
+        async with self._request("GET", self.object_url(key)) as r:
+            if r.status == 404:
+                return None
+            r.raise_for_status()
+            return await r.read()
+
+    async def upload(
+        self,
+        key: str,
+        path: str,
+        overwrite: bool,
+        progress: Callable[[int], None],
+    ) -> None:
+        size = await asyncio.to_thread(os.path.getsize, path)
+        # Conditional write, fails with 412 if the object already exists.
+        conditional = {} if overwrite else {"if-none-match": "*"}
+        if size <= self.part_size:
+            async with self._request(
+                "PUT",
+                self.object_url(key),
+                UNSIGNED_PAYLOAD,
+                {**conditional, "content-length": str(size)},
+                read_file_range(path, 0, size, progress),
+            ) as r:
+                if r.status == 412:
+                    return
+                r.raise_for_status()
+            return
+        await self._upload_multipart(key, path, size, conditional, progress)
+
+    async def _upload_multipart(
+        self,
+        key: str,
+        path: str,
+        size: int,
+        conditional: dict[str, str],
+        progress: Callable[[int], None],
+    ):
+        async with self._request("POST", self.object_url(key, "uploads=")) as r:
+            r.raise_for_status()
+            upload_id = _xml_find(await r.read(), "UploadId")
+        upload_query = f"uploadId={_uri_encode(upload_id)}"
+        try:
+            etags = []
+            for number, start in enumerate(range(0, size, self.part_size), start=1):
+                end = min(start + self.part_size, size)
+                async with self._request(
+                    "PUT",
+                    self.object_url(key, f"partNumber={number}&{upload_query}"),
+                    UNSIGNED_PAYLOAD,
+                    {"content-length": str(end - start)},
+                    read_file_range(path, start, end, progress),
+                ) as r:
+                    r.raise_for_status()
+                    etags.append(r.headers["ETag"])
+
+            body = (
+                "<CompleteMultipartUpload>"
+                + "".join(
+                    f"<Part><PartNumber>{number}</PartNumber><ETag>{etag}</ETag></Part>"
+                    for number, etag in enumerate(etags, start=1)
+                )
+                + "</CompleteMultipartUpload>"
+            ).encode()
+            async with self._request(
+                "POST",
+                self.object_url(key, upload_query),
+                hashlib.sha256(body).hexdigest(),
+                conditional,
+                body,
+            ) as r:
+                if r.status == 412:
+                    await self._abort_multipart(key, upload_query)
+                    return
+                r.raise_for_status()
+                # Errors can also be reported in a 200 response.
+                response = await r.read()
+                if b"<Error>" in response:
+                    raise Exception(f"Multipart upload of {key} failed: {response!r}")
+        except BaseException:
+            await self._abort_multipart(key, upload_query)
+            raise
+
+    async def _abort_multipart(self, key: str, upload_query: str):
+        with contextlib.suppress(aiohttp.ClientError):
+            async with self._request("DELETE", self.object_url(key, upload_query)):
+                pass
+
+
+def _xml_find_all(document: bytes, tag: str) -> list[str]:
+    # S3 responses use a default namespace, match on the local name.
+    return [
+        element.text
+        for element in ET.fromstring(document).iter()
+        if element.tag.rsplit("}", 1)[-1] == tag and element.text
+    ]
+
+
+def _xml_find(document: bytes, tag: str) -> str:
+    values = _xml_find_all(document, tag)
+    if not values:
+        raise ValueError(f"{tag} not found in response")
+    return values[0]